@@ -1,29 +1,80 @@
-from flask import Flask
+from flask import Flask, jsonify
 from flask_sqlalchemy import SQLAlchemy
+from PIL import Image as PILImage
 from config import Config
+from .model_session import ModelSessionManager
+from .jobs import JobQueue
+from .inference import InferenceExecutor
+from .storage import Storage
 
 db = SQLAlchemy()
+model_sessions = ModelSessionManager()
+jobs = JobQueue()
+inference = InferenceExecutor()
+storage = Storage()
 
 
-def create_app():
+def create_app(config=Config):
     app = Flask(__name__, instance_relative_config=True)
-    app.config.from_object(Config)
-    Config.ensure_dirs()
+    app.config.from_object(config)
+    config.ensure_dirs()
+    # Anything past the downscale ceiling is treated as a decompression bomb.
+    PILImage.MAX_IMAGE_PIXELS = app.config["UPLOAD_DOWNSCALE_MAX_PIXELS"]
 
     db.init_app(app)
+    storage.init_app(app)
 
     with app.app_context():
         from . import models
+        from .migrations import upgrade_schema
+        from .sqlite import configure_sqlite
+        configure_sqlite(app, db.engine)
+        from .metrics import init_metrics
+        init_metrics(app, db.engine)
         db.create_all()
+        upgrade_schema()
 
     from .auth.routes import auth_bp
     from .gallery.routes import gallery_bp
+    from .media import media_bp
+    from .api import api_bp
 
     app.register_blueprint(auth_bp)
     app.register_blueprint(gallery_bp)
+    app.register_blueprint(media_bp)
+    app.register_blueprint(api_bp)
+
+    from .auth.routes import init_user_cache
+    from .gallery.render import init_render_cache
+    from .gallery.compositor import init_background_cache
+    from .gallery.fragments import init_gallery_cache
+    init_user_cache(app)
+    init_render_cache(app)
+    init_background_cache(app)
+    init_gallery_cache(app)
+
+    model_sessions.init_app(app)
+    inference.init_app(app)
+    jobs.init_app(app)
+
+    from .cleanup import init_cleanup
+    init_cleanup(app)
+
+    from .cli import thumbs_cli, schema_cli, media_cli, storage_cli, api_cli, maintenance_cli
+    app.cli.add_command(thumbs_cli)
+    app.cli.add_command(schema_cli)
+    app.cli.add_command(media_cli)
+    app.cli.add_command(storage_cli)
+    app.cli.add_command(api_cli)
+    app.cli.add_command(maintenance_cli)
 
     @app.route("/ping")
     def ping():
         return "OK"
 
+    @app.route("/ready")
+    def ready():
+        status = inference.status()
+        return jsonify(status), 200 if status["ready"] else 503
+
     return app
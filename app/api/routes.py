@@ -0,0 +1,332 @@
+import gzip
+import hashlib
+import json
+
+from flask import abort, current_app, g, jsonify, request, url_for
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge
+
+from . import api_bp
+from .tokens import user_for_token
+from .. import db
+from ..auth.routes import can_edit_resource
+from ..media import media_url
+from ..models import Background, Composition, Image, Job
+from ..gallery.compositor import FIT_MODES
+from ..gallery.fragments import visible_compositions
+from ..gallery.pagination import keyset_page
+from ..gallery.routes import job_download
+from ..gallery.urls import composition_url, thumb_url
+from ..gallery.utils import (
+    allowed_file, megabytes, owned_background, recompose_with_background, recompose_with_new_background,
+    submit_batch_job, submit_composition_job, UploadRejected,
+)
+
+COMPOSITION_FIELDS = {
+    "id": lambda comp: comp.id,
+    "image_id": lambda comp: comp.image_id,
+    "background_id": lambda comp: comp.background_id,
+    "fit_mode": lambda comp: comp.fit_mode,
+    "is_public": lambda comp: comp.is_public,
+    "like_count": lambda comp: comp.like_count,
+    "comment_count": lambda comp: comp.comment_count,
+    "created_at": lambda comp: comp.created_at.isoformat(),
+    "url": composition_url,
+    "thumbs": lambda comp: {str(w): thumb_url(comp, w) for w in current_app.config["THUMB_WIDTHS"]},
+    "links": lambda comp: {
+        "self": url_for("api.get_composition", comp_id=comp.id),
+        "html": url_for("gallery.composition_detail", comp_id=comp.id),
+    },
+}
+# Thumbnails are opt-in to keep list responses small.
+DEFAULT_FIELDS = tuple(name for name in COMPOSITION_FIELDS if name != "thumbs")
+
+
+def _error(message: str, status: int = 400):
+    return jsonify({"error": message}), status
+
+
+@api_bp.errorhandler(HTTPException)
+def api_error(exc):
+    return _error(exc.description, exc.code)
+
+
+@api_bp.errorhandler(RequestEntityTooLarge)
+def api_too_large(exc):
+    return _error(f"Upload is larger than {megabytes(current_app.config['MAX_CONTENT_LENGTH'])}.", 413)
+
+
+@api_bp.before_request
+def authenticate():
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() == "bearer" and token.strip():
+        g.user = user_for_token(token.strip())
+        if g.user is None:
+            resp, status = _error("Invalid API token.", 401)
+            resp.headers["WWW-Authenticate"] = 'Bearer error="invalid_token"'
+            return resp, status
+    elif g.user is None or request.method not in ("GET", "HEAD", "OPTIONS"):
+        # The session cookie is enough to read, but writes need a token so a
+        # cross-site form cannot make them on a signed-in user's behalf.
+        message = "Authentication required." if g.user is None else "Changes need an API token."
+        resp, status = _error(message, 401)
+        resp.headers["WWW-Authenticate"] = "Bearer"
+        return resp, status
+
+
+@api_bp.after_request
+def compress(resp):
+    resp.vary.update(("Accept-Encoding", "Authorization", "Cookie"))
+    resp.cache_control.private = True
+
+    cfg = current_app.config
+    if (
+        resp.status_code not in (200, 201, 202)
+        or resp.direct_passthrough
+        or resp.is_streamed
+        or "Content-Encoding" in resp.headers
+        or not request.accept_encodings["gzip"]
+    ):
+        return resp
+    data = resp.get_data()
+    if len(data) < cfg["API_GZIP_MIN_BYTES"]:
+        return resp
+    resp.set_data(gzip.compress(data, cfg["API_GZIP_LEVEL"], mtime=0))
+    resp.headers["Content-Encoding"] = "gzip"
+    return resp
+
+
+def _conditional(data: dict):
+    resp = jsonify(data)
+    # Weak, because the gzip'd and identity bodies share the tag.
+    resp.set_etag(hashlib.sha1(resp.get_data()).hexdigest(), weak=True)
+    return resp.make_conditional(request)
+
+
+def _choice(name: str, options):
+    value = request.values.get(name)
+    return value if value in options else None
+
+
+def _fields() -> tuple:
+    requested = request.args.get("fields")
+    if not requested:
+        return DEFAULT_FIELDS
+    fields = tuple(name.strip() for name in requested.split(",") if name.strip())
+    unknown = [name for name in fields if name not in COMPOSITION_FIELDS]
+    if unknown:
+        abort(400, f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(COMPOSITION_FIELDS)}.")
+    return fields
+
+
+def _composition_json(comp: Composition, fields) -> dict:
+    return {name: COMPOSITION_FIELDS[name](comp) for name in fields}
+
+
+def _job_json(job: Job) -> dict:
+    payload = json.loads(job.payload)
+    data = {
+        "id": job.id,
+        "kind": job.kind,
+        "tier": payload.get("tier"),
+        "model": payload.get("model"),
+        "status": job.status,
+        "error": job.error,
+        "total": job.total,
+        "done": job.done,
+        "links": {"self": url_for("api.get_job", job_id=job.id)},
+    }
+    if job.kind == "batch":
+        data["composition_ids"] = json.loads(job.result) if job.result else []
+        if job.status == "done":
+            data["links"]["download"] = url_for("api.job_download", job_id=job.id)
+    else:
+        data["composition_id"] = job.composition_id
+        if job.composition_id:
+            data["links"]["composition"] = url_for("api.get_composition", comp_id=job.composition_id)
+    return data
+
+
+def _accepted(job: Job):
+    resp = jsonify(_job_json(job))
+    resp.status_code = 202
+    resp.headers["Location"] = url_for("api.get_job", job_id=job.id)
+    return resp
+
+
+def _background_from_request():
+    background_id = request.values.get("background_id")
+    if not background_id:
+        return None
+    background = owned_background(background_id, g.user.id)
+    if background is None:
+        abort(404, "Background not found in your library.")
+    return background
+
+
+def _check_background_file(background_file):
+    if background_file and background_file.filename and not allowed_file(background_file.filename):
+        abort(400, "Background image type not supported.")
+
+
+@api_bp.post("/compositions")
+def create_composition():
+    subject_file = request.files.get("subject")
+    background_file = request.files.get("background")
+
+    if not subject_file or subject_file.filename == "":
+        return _error("Missing 'subject' file.")
+    if not allowed_file(subject_file.filename):
+        return _error("Subject image type not supported.")
+    _check_background_file(background_file)
+
+    try:
+        job = submit_composition_job(
+            subject_file,
+            background_file,
+            g.user.id,
+            is_public=request.form.get("visibility", "public") == "public",
+            fit_mode=_choice("fit", FIT_MODES),
+            tier=_choice("tier", current_app.config["MODEL_TIERS"]),
+            background_obj=_background_from_request(),
+        )
+    except UploadRejected as exc:
+        return _error(str(exc))
+    return _accepted(job)
+
+
+@api_bp.post("/batches")
+def create_batch():
+    cfg = current_app.config
+    subject_files = [f for f in request.files.getlist("subjects") if f and f.filename]
+    background_file = request.files.get("background")
+
+    if not subject_files:
+        return _error("Missing 'subjects' files.")
+    if len(subject_files) > cfg["BATCH_MAX_FILES"]:
+        return _error(f"At most {cfg['BATCH_MAX_FILES']} images per batch.")
+    if not all(allowed_file(f.filename) for f in subject_files):
+        return _error("Subject image type not supported.")
+    _check_background_file(background_file)
+
+    try:
+        job = submit_batch_job(
+            subject_files,
+            background_file,
+            g.user.id,
+            is_public=request.form.get("visibility", "public") == "public",
+            fit_mode=_choice("fit", FIT_MODES),
+            tier=_choice("tier", cfg["MODEL_TIERS"]),
+            background_obj=_background_from_request(),
+        )
+    except UploadRejected as exc:
+        return _error(str(exc))
+    return _accepted(job)
+
+
+@api_bp.get("/jobs/<job_id>")
+def get_job(job_id):
+    job = db.session.get(Job, job_id)
+    if job is None or not can_edit_resource(job.user_id, g.user):
+        abort(404, "Job not found.")
+    return jsonify(_job_json(job))
+
+
+# The ZIP view only needs g.user, which token auth has already set.
+api_bp.add_url_rule("/jobs/<job_id>/download", "job_download", job_download)
+
+
+@api_bp.get("/compositions")
+def list_compositions():
+    """One page of compositions, newest first; ``mine=1`` limits it to the caller's own."""
+    cfg = current_app.config
+    fields = _fields()
+    limit = min(request.args.get("limit", cfg["API_PAGE_SIZE"], type=int), cfg["API_MAX_PAGE_SIZE"])
+    if limit < 1:
+        return _error("'limit' must be positive.")
+
+    if request.args.get("mine") == "1":
+        query = Composition.query.join(Image).filter(Image.user_id == g.user.id)
+    else:
+        query = visible_compositions(g.user)
+    # URLs and thumbnail keys read each composition's image.
+    rows, next_cursor = keyset_page(query.options(joinedload(Composition.image)), request.args.get("cursor"), limit)
+
+    data = {"items": [_composition_json(comp, fields) for comp in rows], "next_cursor": next_cursor}
+    if next_cursor:
+        args = request.args.to_dict()
+        args["cursor"] = next_cursor
+        data["next"] = url_for("api.list_compositions", **args)
+    return _conditional(data)
+
+
+def _get_visible_composition(comp_id: int) -> Composition:
+    comp = db.session.get(Composition, comp_id)
+    if comp is None:
+        abort(404, "Composition not found.")
+    owner_id = comp.image.user_id if comp.image else None
+    if not comp.is_public and not can_edit_resource(owner_id, g.user):
+        abort(404, "Composition not found.")
+    return comp
+
+
+@api_bp.get("/compositions/<int:comp_id>")
+def get_composition(comp_id):
+    return _conditional(_composition_json(_get_visible_composition(comp_id), _fields()))
+
+
+@api_bp.post("/compositions/<int:comp_id>/background")
+def change_background(comp_id):
+    comp = _get_visible_composition(comp_id)
+    owner_id = comp.image.user_id if comp.image else None
+    if not can_edit_resource(owner_id, g.user):
+        abort(403, "You cannot change the background of this composition.")
+
+    values = request.get_json(silent=True) or request.form
+    fit_mode = values.get("fit") if values.get("fit") in FIT_MODES else None
+    background_file = request.files.get("background")
+
+    if background_file and background_file.filename:
+        _check_background_file(background_file)
+        try:
+            recompose_with_new_background(comp, background_file, fit_mode=fit_mode)
+        except UploadRejected as exc:
+            return _error(str(exc))
+    elif values.get("background_id"):
+        background = owned_background(values["background_id"], owner_id)
+        if background is None:
+            abort(404, "Background not found in your library.")
+        recompose_with_background(comp, background, fit_mode=fit_mode)
+    else:
+        return _error("Send a 'background' file or a 'background_id'.")
+    return jsonify(_composition_json(comp, _fields()))
+
+
+@api_bp.get("/backgrounds")
+def list_backgrounds():
+    """The caller's background library, newest first; ``cursor`` is the last id seen."""
+    cfg = current_app.config
+    limit = min(request.args.get("limit", cfg["API_PAGE_SIZE"], type=int), cfg["API_MAX_PAGE_SIZE"])
+    if limit < 1:
+        return _error("'limit' must be positive.")
+
+    query = Background.query.filter(Background.user_id == g.user.id)
+    cursor = request.args.get("cursor", type=int)
+    if cursor:
+        query = query.filter(Background.id < cursor)
+    rows = query.order_by(Background.id.desc()).limit(limit + 1).all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+
+    data = {
+        "items": [
+            {
+                "id": bg.id,
+                "created_at": bg.created_at.isoformat(),
+                "url": media_url(bg.bg_path),
+                "thumb": url_for("gallery.background_thumb", background_id=bg.id),
+            }
+            for bg in rows[:limit]
+        ],
+        "next_cursor": next_cursor,
+    }
+    return _conditional(data)
@@ -0,0 +1,24 @@
+import hashlib
+import secrets
+
+from .. import db
+from ..models import ApiToken, User
+
+
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def create_token(user: User, name: str = None) -> str:
+    token = secrets.token_urlsafe(32)
+    db.session.add(ApiToken(user_id=user.id, name=name, token_hash=hash_token(token)))
+    db.session.commit()
+    return token
+
+
+def user_for_token(token: str):
+    return (
+        User.query.join(ApiToken, ApiToken.user_id == User.id)
+        .filter(ApiToken.token_hash == hash_token(token))
+        .first()
+    )
@@ -2,19 +2,50 @@ from flask import (
     render_template, request, redirect, url_for,
     flash, session, g
 )
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
 from . import auth_bp
 from ..models import User
+from ..cache import LRUCache
 from .. import db
 from functools import wraps
 
+SKIP_USER_ENDPOINTS = {"static", "media.media", "ping", "ready", "stats_view", "metrics", "metrics_profile"}
+
+user_cache = LRUCache("users")
+
+
+def init_user_cache(app):
+    user_cache.max_items = app.config["USER_CACHE_SIZE"]
+    user_cache.ttl = app.config["USER_CACHE_TTL"]
+
+
+def _cached_user(user_id: int):
+    columns = user_cache.get(user_id)
+    if columns is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            user_cache.set(user_id, {c.key: getattr(user, c.key) for c in User.__table__.columns})
+        return user
+
+    user = User(**columns)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_user(_mapper, _conn, target):
+    user_cache.pop(target.id)
+
 
 @auth_bp.before_app_request
 def load_logged_in_user():
     user_id = session.get("user_id")
-    if user_id is None:
+    if user_id is None or request.endpoint in SKIP_USER_ENDPOINTS:
         g.user = None
     else:
-        g.user = User.query.get(user_id)
+        g.user = _cached_user(user_id)
 
 
 def login_user(user: User):
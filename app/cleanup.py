@@ -0,0 +1,194 @@
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy.orm import aliased
+
+from . import db, storage
+from .models import Image, Background, Composition, Job
+from .gallery.derivatives import derivative_key
+
+ACTIVE_JOB_STATUSES = ("pending", "running")
+
+
+def media_prefixes() -> list:
+    return [storage.folder_key(current_app.config["UPLOAD_FOLDER"]) + "/", "compositions/"]
+
+
+def iter_media():
+    """Yield ``(key, size, mtime)`` for every stored media file without listing it up front."""
+    for prefix in media_prefixes():
+        yield from storage.list(prefix)
+
+
+def _active_payloads():
+    for (payload,) in db.session.query(Job.payload).filter(Job.status.in_(ACTIVE_JOB_STATUSES)):
+        yield json.loads(payload)
+
+
+def referenced_paths() -> set:
+    paths = set()
+    columns = [
+        Image.original_path, Image.cutout_path, Image.mask_path,
+        Background.bg_path, Composition.output_path,
+    ]
+    for column in columns:
+        for (path,) in db.session.query(column).filter(column.isnot(None)).yield_per(1000):
+            paths.add(path)
+
+    for payload in _active_payloads():
+        if "original_path" in payload:
+            paths.add(payload["original_path"])
+        for subject in payload.get("subjects", ()):
+            paths.add(subject["original_path"])
+    return paths
+
+
+def referenced_thumb_prefixes() -> set:
+    rows = db.session.query(
+        Composition.id, Composition.image_id, Composition.background_id,
+        Composition.fit_mode, Composition.output_path, Image.mask_path, Image.cutout_path,
+    ).join(Image, Composition.image_id == Image.id).yield_per(1000)
+    return {f"{row.id}_{derivative_key(row, image=row)}_" for row in rows}
+
+
+def prune_rows(grace_seconds: int, dry_run: bool = False) -> dict:
+    cutoff = datetime.utcnow() - timedelta(seconds=grace_seconds)
+    used_backgrounds = {
+        payload["background_id"] for payload in _active_payloads() if payload.get("background_id")
+    }
+
+    images = Image.query.filter(
+        db.func.coalesce(Image.last_used_at, Image.created_at) < cutoff,
+        ~db.session.query(Composition.id).filter(Composition.image_id == Image.id).exists(),
+    )
+    # A user's newest backgrounds make up their library and are kept; older
+    # ones are no longer offered anywhere.
+    newer = aliased(Background)
+    newer_count = (
+        db.session.query(db.func.count(newer.id))
+        .filter(newer.user_id == Background.user_id, newer.id > Background.id)
+        .scalar_subquery()
+    )
+    backgrounds = Background.query.filter(
+        db.or_(Background.user_id.is_(None), newer_count >= current_app.config["BACKGROUND_LIBRARY_SIZE"]),
+        db.func.coalesce(Background.last_used_at, Background.created_at) < cutoff,
+        ~db.session.query(Composition.id).filter(Composition.background_id == Background.id).exists(),
+    )
+    if used_backgrounds:
+        backgrounds = backgrounds.filter(Background.id.notin_(used_backgrounds))
+
+    result = {"images": images.count(), "backgrounds": backgrounds.count()}
+    if not dry_run:
+        images.delete(synchronize_session=False)
+        backgrounds.delete(synchronize_session=False)
+        db.session.commit()
+    return result
+
+
+def find_orphans(grace_seconds: int):
+    referenced = referenced_paths()
+    thumb_prefixes = referenced_thumb_prefixes()
+    thumb_dir = storage.folder_key(current_app.config["THUMB_FOLDER"])
+    cutoff = time.time() - grace_seconds
+
+    for key, size, mtime in iter_media():
+        if mtime > cutoff:
+            continue
+        if os.path.dirname(key) == thumb_dir:
+            if _thumb_prefix(key) in thumb_prefixes:
+                continue
+        elif key in referenced:
+            continue
+        yield key, size
+
+
+def _thumb_prefix(key: str) -> str:
+    comp_id, _, rest = os.path.basename(key).partition("_")
+    return f"{comp_id}_{rest.partition('_')[0]}_"
+
+
+def collect_garbage(dry_run: bool = False, grace_seconds: int = None) -> dict:
+    if grace_seconds is None:
+        grace_seconds = current_app.config["GC_GRACE_SECONDS"]
+
+    # In a dry run the rows that would be pruned still reference their files,
+    # so the file counts are a lower bound.
+    rows = prune_rows(grace_seconds, dry_run=dry_run)
+
+    deleted = failed = freed = 0
+    for key, size in find_orphans(grace_seconds):
+        if not dry_run:
+            try:
+                storage.delete(key)
+            except Exception:
+                failed += 1
+                continue
+        deleted += 1
+        freed += size
+
+    return {"rows": rows, "files": deleted, "bytes": freed, "failed": failed, "dry_run": dry_run}
+
+
+def storage_report() -> dict:
+    folders = defaultdict(lambda: {"files": 0, "bytes": 0})
+    thumb_dir = storage.folder_key(current_app.config["THUMB_FOLDER"])
+    sizes = {}
+    for key, size, _ in iter_media():
+        if os.path.dirname(key) != thumb_dir:
+            sizes[key] = size
+        folder = folders[os.path.dirname(key)]
+        folder["files"] += 1
+        folder["bytes"] += size
+
+    user_paths = defaultdict(set)
+    queries = [
+        db.session.query(Image.user_id, Image.original_path),
+        db.session.query(Image.user_id, Image.cutout_path),
+        db.session.query(Image.user_id, Image.mask_path),
+        db.session.query(Background.user_id, Background.bg_path),
+        db.session.query(Image.user_id, Composition.output_path).join(Composition.image),
+    ]
+    for query in queries:
+        for user_id, path in query.yield_per(1000):
+            if path:
+                user_paths[user_id].add(path)
+
+    users = {
+        user_id: {"files": len(paths), "bytes": sum(sizes.get(path, 0) for path in paths)}
+        for user_id, paths in user_paths.items()
+    }
+    referenced = set().union(*user_paths.values()) if user_paths else set()
+    unreferenced = [size for rel, size in sizes.items() if rel not in referenced]
+    return {
+        "folders": dict(folders),
+        "users": users,
+        "total": {
+            "files": sum(f["files"] for f in folders.values()),
+            "bytes": sum(f["bytes"] for f in folders.values()),
+        },
+        "unreferenced": {"files": len(unreferenced), "bytes": sum(unreferenced)},
+    }
+
+
+def init_cleanup(app):
+    interval = app.config["GC_INTERVAL_SECONDS"]
+    if not interval:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    report = collect_garbage()
+                    app.logger.info("Storage GC: %s", report)
+                except Exception:
+                    app.logger.exception("Storage GC failed")
+                    db.session.rollback()
+
+    threading.Thread(target=run, name="storage-gc", daemon=True).start()
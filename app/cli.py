@@ -0,0 +1,221 @@
+import functools
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from .migrations import upgrade_schema
+from .models import ApiToken, Background, Composition, Image, User
+from . import db
+from .api.tokens import create_token
+from .gallery.derivatives import derivative_exists, derivative_key, generate_derivatives
+from .media import nginx_conf
+from .cleanup import collect_garbage, storage_report
+from . import maintenance
+
+thumbs_cli = AppGroup("thumbs", help="Manage gallery thumbnails.")
+schema_cli = AppGroup("schema", help="Inspect and upgrade the database schema.")
+media_cli = AppGroup("media", help="Serve uploaded media.")
+storage_cli = AppGroup("storage", help="Account for and reclaim upload storage.")
+api_cli = AppGroup("api", help="Manage API tokens.")
+maintenance_cli = AppGroup("maintenance", help="Bulk reprocessing and backfills over every row.")
+
+
+def _size(num_bytes: int) -> str:
+    return f"{num_bytes / (1024 * 1024):.1f} MB"
+
+
+def _pool_options(command):
+    command = click.option("--restart", is_flag=True, help="Ignore a saved checkpoint and start over.")(command)
+    command = click.option("--inline", is_flag=True, help="Work in this process instead of a pool.")(command)
+    command = click.option("--workers", type=int, default=None, help="Worker processes (default: one per CPU).")(command)
+    command = click.option("--chunk-size", type=int, default=None, help="Rows per chunk and per commit.")(command)
+    return command
+
+
+def _report(state, resumed=False):
+    if resumed:
+        click.echo(f"Resuming {state['task']} after id {state['last_id']}.")
+        return
+    click.echo(
+        f"{state['task']}: through id {state['last_id']}, {state['done']} done, "
+        f"{state['skipped']} skipped, {len(state['failed'])} failed"
+    )
+
+
+def _run(task, options, query, id_column, process_chunk, chunk_size, workers, inline, restart):
+    state = maintenance.run_task(
+        task, options, query, id_column, process_chunk,
+        chunk_size=chunk_size, workers=0 if inline else workers, restart=restart, report=_report,
+    )
+    if state["failed"]:
+        click.echo(f"Failed ids: {' '.join(map(str, state['failed']))}", err=True)
+    return state
+
+
+@maintenance_cli.command("reprocess")
+@click.option("--model", "model_name", default=None, help="Segmentation model (default: REMBG_MODEL).")
+@click.option("--user", "user_id", type=int, default=None, help="Only this user's images.")
+@click.option("--from-model", default=None, help="Only images segmented with this model.")
+@click.option("--all", "include_current", is_flag=True, help="Include images already on the target model.")
+@click.option("--no-rebuild", is_flag=True, help="Leave compositions and thumbnails as they are.")
+@click.option("--dry-run", is_flag=True, help="Only count the images that would be reprocessed.")
+@_pool_options
+def reprocess(model_name, user_id, from_model, include_current, no_rebuild, dry_run,
+              chunk_size, workers, inline, restart):
+    """Segment images again with a newer model and rebuild their compositions."""
+    model_name = model_name or current_app.config["REMBG_MODEL"]
+    query = maintenance.reprocess_query(model_name, user_id, from_model, include_current)
+    if dry_run:
+        click.echo(f"{query.count()} images would be reprocessed with {model_name}.")
+        return
+
+    options = {"model": model_name, "user": user_id, "from_model": from_model,
+               "all": include_current, "rebuild": not no_rebuild}
+    state = _run(
+        "reprocess", options, query, Image.id,
+        functools.partial(maintenance.reprocess_chunk, model_name=model_name,
+                          rebuild=not no_rebuild, include_current=include_current),
+        chunk_size, workers, inline, restart,
+    )
+    click.echo(f"Reprocessed {state['done']} images. Run `flask storage gc` to reclaim the old files.")
+
+
+@maintenance_cli.command("rebuild")
+@click.option("--user", "user_id", type=int, default=None, help="Only this user's compositions.")
+@click.option("--thumbs-only", is_flag=True, help="Only regenerate thumbnails.")
+@_pool_options
+def rebuild(user_id, thumbs_only, chunk_size, workers, inline, restart):
+    """Re-render compositions and their thumbnails with the current settings."""
+    query = Composition.query
+    if user_id is not None:
+        query = query.join(Image).filter(Image.user_id == user_id)
+    state = _run(
+        "rebuild", {"user": user_id, "thumbs_only": thumbs_only}, query, Composition.id,
+        functools.partial(maintenance.rebuild_chunk, thumbs_only=thumbs_only),
+        chunk_size, workers, inline, restart,
+    )
+    click.echo(f"Rebuilt {state['done']} compositions.")
+
+
+@maintenance_cli.command("backfill-hashes")
+@_pool_options
+def backfill_hashes(chunk_size, workers, inline, restart):
+    """Fill in content hashes missing from older images and backgrounds."""
+    for model in (Image, Background):
+        task = f"hashes-{model.__tablename__}"
+        state = _run(
+            task, {}, maintenance.backfill_query(model), model.id,
+            functools.partial(maintenance.backfill_chunk, model=model),
+            chunk_size, workers, inline, restart,
+        )
+        click.echo(f"Hashed {state['done']} {model.__tablename__} ({state['skipped']} duplicates left unhashed).")
+
+
+@api_cli.command("create-token")
+@click.argument("username")
+@click.option("--name", default=None, help="Label to tell tokens apart.")
+def api_create_token(username, name):
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise click.ClickException(f"No user named {username!r}.")
+    click.echo(create_token(user, name))
+
+
+@api_cli.command("list-tokens")
+@click.argument("username")
+def api_list_tokens(username):
+    tokens = ApiToken.query.join(User).filter(User.username == username).order_by(ApiToken.id)
+    for token in tokens:
+        click.echo(f"{token.id:>6}  {token.created_at:%Y-%m-%d %H:%M}  {token.name or ''}")
+
+
+@api_cli.command("revoke-token")
+@click.argument("token_id", type=int)
+def api_revoke_token(token_id):
+    token = db.session.get(ApiToken, token_id)
+    if token is None:
+        raise click.ClickException(f"No token with id {token_id}.")
+    db.session.delete(token)
+    db.session.commit()
+    click.echo(f"Revoked token {token_id}.")
+
+
+@storage_cli.command("gc")
+@click.option("--dry-run", is_flag=True, help="Only report what would be deleted.")
+@click.option("--grace", type=int, default=None, help="Skip files and rows younger than this many seconds.")
+def storage_gc(dry_run, grace):
+    result = collect_garbage(dry_run=dry_run, grace_seconds=grace)
+    verb = "Would delete" if dry_run else "Deleted"
+    click.echo(f"{verb} {result['rows']['images']} image and {result['rows']['backgrounds']} background rows.")
+    click.echo(f"{verb} {result['files']} files, {_size(result['bytes'])} ({result['failed']} failed).")
+
+
+@storage_cli.command("report")
+def storage_usage():
+    report = storage_report()
+    click.echo("Folders:")
+    for folder, usage in sorted(report["folders"].items()):
+        click.echo(f"  {folder:<28} {usage['files']:>7} files {_size(usage['bytes']):>12}")
+    click.echo("Users:")
+    for user_id, usage in sorted(report["users"].items(), key=lambda item: -item[1]["bytes"]):
+        click.echo(f"  user {user_id!s:<23} {usage['files']:>7} files {_size(usage['bytes']):>12}")
+    total, unreferenced = report["total"], report["unreferenced"]
+    click.echo(f"Total: {total['files']} files, {_size(total['bytes'])}")
+    click.echo(f"Unreferenced: {unreferenced['files']} files, {_size(unreferenced['bytes'])}")
+
+
+@media_cli.command("nginx-conf")
+@click.option("--static-root", default=None, help="Path of the static folder as seen by nginx.")
+def print_nginx_conf(static_root):
+    cfg = current_app.config
+    click.echo(nginx_conf(
+        static_root or current_app.static_folder,
+        cfg["MEDIA_MAX_AGE"],
+        cfg["MEDIA_ACCEL_REDIRECT"] or None,
+    ))
+
+
+@schema_cli.command("upgrade")
+def upgrade():
+    applied = upgrade_schema()
+    for step in applied:
+        click.echo(step)
+    click.echo(f"{len(applied)} change(s) applied.")
+
+
+@thumbs_cli.command("generate")
+@click.option("--all", "regenerate_all", is_flag=True, help="Regenerate thumbnails that already exist.")
+@click.option("--batch-size", default=200, show_default=True)
+def generate_thumbs(regenerate_all, batch_size):
+    widths = current_app.config["THUMB_WIDTHS"]
+    generated = failed = 0
+    last_id = 0
+
+    while True:
+        batch = (
+            Composition.query
+            .filter(Composition.id > last_id)
+            .order_by(Composition.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            break
+
+        for comp in batch:
+            if not regenerate_all and all(derivative_exists(comp, w) for w in widths):
+                # Thumbnails from before thumbs_key existed only need recording.
+                comp.thumbs_key = derivative_key(comp)
+                continue
+            try:
+                generate_derivatives(comp)
+                generated += 1
+            except Exception as exc:
+                failed += 1
+                click.echo(f"composition {comp.id}: {exc}", err=True)
+        db.session.commit()
+
+        last_id = batch[-1].id
+
+    click.echo(f"Generated thumbnails for {generated} compositions ({failed} failed).")
@@ -2,4 +2,4 @@ from flask import Blueprint
 
 gallery_bp = Blueprint("gallery", __name__)
 
-from . import routes
+from . import routes, urls
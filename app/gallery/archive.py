@@ -0,0 +1,40 @@
+import zipfile
+
+CHUNK_SIZE = 64 * 1024
+
+
+class _ChunkWriter:
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(entries):
+    """Yield a ZIP archive of ``(name, source)`` entries piece by piece.
+
+    ``source`` is bytes, a path, or a binary file object that is closed once copied.
+    """
+    out = _ChunkWriter()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_STORED) as zf:
+        for name, source in entries:
+            with zf.open(name, "w", force_zip64=True) as dest:
+                if isinstance(source, bytes):
+                    dest.write(source)
+                else:
+                    with (open(source, "rb") if isinstance(source, str) else source) as src:
+                        for chunk in iter(lambda: src.read(CHUNK_SIZE), b""):
+                            dest.write(chunk)
+                            yield out.drain()
+            yield out.drain()
+    yield out.drain()
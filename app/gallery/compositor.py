@@ -0,0 +1,76 @@
+from contextlib import nullcontext
+
+import numpy as np
+from PIL import Image as PILImage
+
+from ..cache import LRUCache
+from ..metrics import stage
+
+FIT_MODES = ("stretch", "cover", "contain")
+
+background_cache = LRUCache("backgrounds")
+
+
+def init_background_cache(app):
+    background_cache.max_bytes = app.config["BACKGROUND_CACHE_BYTES"]
+
+
+def fit_background(img: PILImage.Image, size, mode: str = "stretch", anchor=(0.5, 0.5),
+                   fill=(255, 255, 255)) -> PILImage.Image:
+    if mode not in FIT_MODES:
+        raise ValueError(f"Unknown fit mode {mode!r}")
+
+    width, height = size
+    img = img.convert("RGB")
+    if mode == "stretch":
+        return img.resize(size, PILImage.LANCZOS)
+
+    scale_x = width / img.width
+    scale_y = height / img.height
+    scale = max(scale_x, scale_y) if mode == "cover" else min(scale_x, scale_y)
+    scaled = img.resize(
+        (max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+        PILImage.LANCZOS,
+    )
+
+    left = round((width - scaled.width) * anchor[0])
+    top = round((height - scaled.height) * anchor[1])
+    if mode == "cover":
+        return scaled.crop((-left, -top, -left + width, -top + height))
+
+    canvas = PILImage.new("RGB", size, fill)
+    canvas.paste(scaled, (left, top))
+    return canvas
+
+
+def load_background(background_id, path: str, size, mode: str = "stretch", anchor=(0.5, 0.5),
+                    source: PILImage.Image = None) -> np.ndarray:
+    key = (background_id, tuple(size), mode, tuple(anchor))
+    pixels = background_cache.get(key)
+    if pixels is None:
+        if source is not None:
+            pixels = np.asarray(fit_background(source, size, mode, anchor).convert("RGBA"))
+        else:
+            # ``path`` may also be a callable returning a file object, opened only on a miss.
+            opened = path() if callable(path) else nullcontext(path)
+            with stage("background_fit"), opened as fp, PILImage.open(fp) as img:
+                # JPEG decodes at a reduced scale when the target is much smaller.
+                img.draft("RGB", tuple(size))
+                pixels = np.asarray(fit_background(img, size, mode, anchor).convert("RGBA"))
+        pixels.flags.writeable = False
+        background_cache.set(key, pixels, size=pixels.nbytes)
+    return pixels
+
+
+def as_image(pixels: np.ndarray) -> PILImage.Image:
+    height, width = pixels.shape[:2]
+    return PILImage.frombuffer("RGBA", (width, height), pixels, "raw", "RGBA", 0, 1)
+
+
+def compose(cutout_img: PILImage.Image, background_id, background_path: str, mode: str = "stretch",
+            anchor=(0.5, 0.5), source: PILImage.Image = None) -> PILImage.Image:
+    if cutout_img.mode != "RGBA":
+        cutout_img = cutout_img.convert("RGBA")
+    pixels = load_background(background_id, background_path, cutout_img.size, mode, anchor, source=source)
+    background = as_image(pixels)
+    return PILImage.alpha_composite(background, cutout_img)
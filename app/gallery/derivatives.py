@@ -0,0 +1,98 @@
+import hashlib
+
+from flask import current_app
+from PIL import Image as PILImage
+
+from .. import db, storage
+from ..metrics import stage
+from .render import load_composition_image
+
+FORMATS = {"webp": ("WEBP", "webp"), "jpeg": ("JPEG", "jpg")}
+
+
+def derivative_key(composition, image=None) -> str:
+    # The segmentation is part of the key: with masks only, output_path stays ""
+    # when an image is re-segmented.
+    image = image or composition.image
+    source = (
+        f"{composition.image_id}:{composition.background_id}:{composition.fit_mode}:{composition.output_path}"
+        f":{image.mask_path}:{image.cutout_path}"
+    )
+    return hashlib.sha1(source.encode()).hexdigest()[:12]
+
+
+def derivative_rel_path(composition, width: int) -> str:
+    _, ext = FORMATS[current_app.config["THUMB_FORMAT"]]
+    name = f"{composition.id}_{derivative_key(composition)}_{width}.{ext}"
+    return storage.key_for(current_app.config["THUMB_FOLDER"], name)
+
+
+def derivative_exists(composition, width: int) -> bool:
+    return storage.exists(derivative_rel_path(composition, width))
+
+
+def has_derivatives(composition) -> bool:
+    """Whether the row records current thumbnails, without asking storage."""
+    return composition.thumbs_key == derivative_key(composition)
+
+
+def ensure_derivatives(composition):
+    """Generate missing thumbnails and record them on ``composition``; the caller commits."""
+    if has_derivatives(composition):
+        return
+    if all(derivative_exists(composition, w) for w in current_app.config["THUMB_WIDTHS"]):
+        composition.thumbs_key = derivative_key(composition)
+    else:
+        generate_derivatives(composition)
+
+
+def nearest_width(width: int) -> int:
+    widths = sorted(current_app.config["THUMB_WIDTHS"])
+    return next((w for w in widths if w >= width), widths[-1])
+
+
+def _flatten(img: PILImage.Image) -> PILImage.Image:
+    if img.mode == "RGBA":
+        canvas = PILImage.new("RGB", img.size, (255, 255, 255))
+        canvas.paste(img, mask=img.getchannel("A"))
+        return canvas
+    return img.convert("RGB")
+
+
+@stage("thumbnails")
+def generate_derivatives(composition, widths=None):
+    cfg = current_app.config
+    fmt, _ = FORMATS[cfg["THUMB_FORMAT"]]
+    widths = sorted(widths or cfg["THUMB_WIDTHS"], reverse=True)
+
+    img = load_composition_image(composition)
+    if fmt == "JPEG":
+        img = _flatten(img)
+
+    for width in widths:
+        if img.width > width:
+            img.thumbnail((width, img.height), PILImage.LANCZOS, reducing_gap=3.0)
+        with storage.writer(derivative_rel_path(composition, width)) as out:
+            img.save(out, fmt, quality=cfg["THUMB_QUALITY"], method=4)
+    composition.thumbs_key = derivative_key(composition)
+
+
+def remove_derivatives(composition_id: int, keep_key: str = None):
+    prefix = storage.key_for(current_app.config["THUMB_FOLDER"], f"{composition_id}_")
+    for key, _, _ in list(storage.list(prefix)):
+        if keep_key and key.startswith(f"{prefix}{keep_key}_"):
+            continue
+        try:
+            storage.delete(key)
+        except OSError:
+            pass
+
+
+def refresh_derivatives(composition):
+    try:
+        generate_derivatives(composition)
+    except Exception:
+        current_app.logger.exception("Generating thumbnails for composition %s failed", composition.id)
+        return
+    db.session.commit()
+    remove_derivatives(composition.id, keep_key=derivative_key(composition))
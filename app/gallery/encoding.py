@@ -0,0 +1,71 @@
+from uuid import uuid4
+
+from flask import current_app
+from PIL import Image as PILImage, features
+
+from .. import storage
+from ..metrics import stage
+
+FORMATS = {
+    "png": ("PNG", "png"),
+    "webp": ("WEBP", "webp"),
+    "jpeg": ("JPEG", "jpg"),
+    "avif": ("AVIF", "avif"),
+}
+CUTOUT_FORMATS = ("png", "webp")
+COMPOSED_FORMATS = ("png", "webp", "jpeg", "avif")
+
+
+def available(fmt: str) -> bool:
+    return fmt in ("png", "jpeg") or features.check(fmt)
+
+
+def save_options(fmt: str, lossless: bool = False, quality: int = 85, png_compress_level: int = 6,
+                 webp_method: int = 4) -> dict:
+    if fmt == "png":
+        return {"compress_level": png_compress_level}
+    if fmt == "webp":
+        if lossless:
+            return {"lossless": True, "method": webp_method}
+        return {"quality": quality, "method": webp_method}
+    if fmt == "jpeg":
+        return {"quality": quality, "optimize": True}
+    if fmt == "avif":
+        return {"quality": quality}
+    raise ValueError(f"Unknown image format {fmt!r}")
+
+
+def policy(kind: str):
+    """Return ``(pil_format, extension, save_kwargs)`` for a "cutout" or "composed" image."""
+    cfg = current_app.config
+    if kind == "cutout":
+        fmt, allowed, lossless = cfg["CUTOUT_FORMAT"], CUTOUT_FORMATS, True
+    elif kind == "composed":
+        fmt, allowed, lossless = cfg["COMPOSED_FORMAT"], COMPOSED_FORMATS, False
+    else:
+        raise ValueError(f"Unknown image kind {kind!r}")
+
+    if fmt not in allowed or not available(fmt):
+        fmt = "png"
+    pil_format, ext = FORMATS[fmt]
+    options = save_options(
+        fmt,
+        lossless=lossless,
+        quality=cfg["COMPOSED_QUALITY"],
+        png_compress_level=cfg["PNG_COMPRESS_LEVEL"],
+        webp_method=cfg["WEBP_METHOD"],
+    )
+    return pil_format, ext, options
+
+
+@stage("encode")
+def save_encoded(img: PILImage.Image, folder: str, kind: str) -> str:
+    pil_format, ext, options = policy(kind)
+    if kind == "composed" and img.mode != "RGB":
+        # Composed images sit on an opaque background, so the alpha channel is dead weight.
+        img = img.convert("RGB")
+
+    key = storage.key_for(folder, f"{uuid4().hex}.{ext}")
+    with storage.writer(key) as out:
+        img.save(out, pil_format, **options)
+    return key
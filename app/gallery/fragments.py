@@ -0,0 +1,77 @@
+from flask import current_app, g, render_template
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
+
+from .. import db
+from ..cache import LRUCache
+from ..models import Composition, Image, User
+from .likes import liked_ids
+from .pagination import keyset_page
+
+gallery_cache = LRUCache("gallery")
+
+
+def init_gallery_cache(app):
+    gallery_cache.max_items = app.config["GALLERY_CACHE_SIZE"]
+    gallery_cache.ttl = app.config["GALLERY_CACHE_TTL"]
+
+
+def visible_compositions(user):
+    query = Composition.query
+
+    if user is None:
+        query = query.filter(Composition.is_public.is_(True))
+    elif user.is_admin:
+        pass
+    else:
+        query = (
+            query.outerjoin(Image)
+            .filter(
+                db.or_(
+                    Composition.is_public.is_(True),
+                    Image.user_id == user.id,
+                )
+            )
+        )
+
+    return query
+
+
+def gallery_page(user, cursor, page_size: int = None):
+    query = visible_compositions(user).options(
+        joinedload(Composition.image)
+        .joinedload(Image.user)
+        .joinedload(User.profile_image)
+        .joinedload(Composition.image)
+    )
+    return keyset_page(query, cursor, page_size or current_app.config["GALLERY_PAGE_SIZE"])
+
+
+def render_cards(cursor):
+    """Return (cards_html, next_cursor, count) for one gallery page.
+
+    Anonymous visitors all see the same public feed, so their pages are
+    served from gallery_cache until a composition changes.
+    """
+    if g.user is None:
+        cached = gallery_cache.get(cursor or "")
+        if cached is not None:
+            return cached
+
+    compositions, next_cursor = gallery_page(g.user, cursor)
+    liked = liked_ids(g.user.id, [comp.id for comp in compositions]) if g.user else set()
+    html = Markup(render_template("gallery/_cards.html", compositions=compositions, liked=liked))
+    result = (html, next_cursor, len(compositions))
+
+    if g.user is None:
+        gallery_cache.set(cursor or "", result)
+    return result
+
+
+@event.listens_for(Composition, "after_insert")
+@event.listens_for(Composition, "after_update")
+@event.listens_for(Composition, "after_delete")
+@event.listens_for(User, "after_update")
+def _invalidate_gallery(_mapper, _conn, _target):
+    gallery_cache.clear()
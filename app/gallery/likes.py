@@ -0,0 +1,68 @@
+from sqlalchemy import exists
+from sqlalchemy.exc import IntegrityError
+
+from .. import db
+from ..models import Composition, user_likes
+
+
+def has_liked(user_id: int, comp_id: int) -> bool:
+    return db.session.query(
+        exists().where(
+            user_likes.c.user_id == user_id,
+            user_likes.c.composition_id == comp_id,
+        )
+    ).scalar()
+
+
+def liked_ids(user_id, comp_ids) -> set:
+    if user_id is None or not comp_ids:
+        return set()
+    rows = db.session.execute(
+        db.select(user_likes.c.composition_id).where(
+            user_likes.c.user_id == user_id,
+            user_likes.c.composition_id.in_(list(comp_ids)),
+        )
+    )
+    return {row.composition_id for row in rows}
+
+
+def _adjust(column, comp_id: int, delta: int):
+    from .fragments import gallery_cache
+
+    Composition.query.filter(Composition.id == comp_id).update(
+        {column: column + delta},
+        synchronize_session=False,
+    )
+    # Bulk updates skip the mapper hooks that normally clear the anonymous feed.
+    gallery_cache.clear()
+
+
+def add_like(user_id: int, comp_id: int) -> bool:
+    try:
+        with db.session.begin_nested():
+            db.session.execute(user_likes.insert().values(user_id=user_id, composition_id=comp_id))
+    except IntegrityError:
+        return False
+    _adjust(Composition.like_count, comp_id, 1)
+    return True
+
+
+def remove_like(user_id: int, comp_id: int) -> bool:
+    result = db.session.execute(
+        user_likes.delete().where(
+            user_likes.c.user_id == user_id,
+            user_likes.c.composition_id == comp_id,
+        )
+    )
+    if not result.rowcount:
+        return False
+    _adjust(Composition.like_count, comp_id, -result.rowcount)
+    return True
+
+
+def comment_added(comp_id: int):
+    _adjust(Composition.comment_count, comp_id, 1)
+
+
+def comment_removed(comp_id: int):
+    _adjust(Composition.comment_count, comp_id, -1)
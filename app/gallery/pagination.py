@@ -0,0 +1,42 @@
+import base64
+import binascii
+from datetime import datetime
+
+from .. import db
+from ..models import Composition
+
+
+def encode_cursor(composition: Composition) -> str:
+    raw = f"{composition.created_at.isoformat()}|{composition.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, comp_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(created_at), int(comp_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+def keyset_page(query, cursor: str, page_size: int):
+    position = decode_cursor(cursor)
+    if position is not None:
+        created_at, comp_id = position
+        query = query.filter(
+            db.or_(
+                Composition.created_at < created_at,
+                db.and_(Composition.created_at == created_at, Composition.id < comp_id),
+            )
+        )
+
+    rows = (
+        query.order_by(Composition.created_at.desc(), Composition.id.desc())
+        .limit(page_size + 1)
+        .all()
+    )
+    next_cursor = encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+    return rows[:page_size], next_cursor
@@ -0,0 +1,149 @@
+import io
+
+from flask import current_app
+import numpy as np
+from PIL import Image as PILImage, ImageOps
+
+from .. import storage
+from ..cache import LRUCache
+from ..metrics import stage
+from .compositor import as_image, compose, fit_background
+from .segmentation import apply_mask, load_mask
+
+render_cache = LRUCache("render")
+cutout_cache = LRUCache("cutouts")
+
+
+def init_render_cache(app):
+    render_cache.max_bytes = app.config["RENDER_CACHE_BYTES"]
+    cutout_cache.max_bytes = app.config["CUTOUT_CACHE_BYTES"]
+
+
+def open_image(key: str) -> PILImage.Image:
+    with storage.open(key) as f:
+        img = PILImage.open(f)
+        img.load()
+    return img
+
+
+def _decode_cutout(image) -> PILImage.Image:
+    if image.cutout_path:
+        return open_image(image.cutout_path).convert("RGBA")
+    with storage.local_path(image.original_path) as original, storage.local_path(image.mask_path) as mask:
+        return apply_mask(original, load_mask(mask))
+
+
+def _cached_pixels(key, build) -> PILImage.Image:
+    pixels = cutout_cache.get(key)
+    if pixels is None:
+        pixels = np.asarray(build())
+        pixels.flags.writeable = False
+        cutout_cache.set(key, pixels, size=pixels.nbytes)
+    # A read-only view: Pillow copies before any in-place change, so the cache stays intact.
+    return as_image(pixels)
+
+
+def _cutout_key(image) -> tuple:
+    # Stored files are never rewritten, so their paths identify the pixels.
+    return (image.cutout_path,) if image.cutout_path else (image.original_path, image.mask_path)
+
+
+def load_cutout(image) -> PILImage.Image:
+    return _cached_pixels(("full",) + _cutout_key(image), lambda: _decode_cutout(image))
+
+
+def preview_cutout(image, max_edge: int) -> PILImage.Image:
+    def build():
+        img = load_cutout(image).copy()
+        img.thumbnail((max_edge, max_edge), PILImage.BILINEAR)
+        return img
+
+    return _cached_pixels(("preview", max_edge) + _cutout_key(image), build)
+
+
+@stage("composite")
+def compose_with(cutout_img: PILImage.Image, background, fit_mode: str = None,
+                 source: PILImage.Image = None) -> PILImage.Image:
+    cfg = current_app.config
+    return compose(
+        cutout_img,
+        background.id,
+        lambda: storage.open(background.bg_path),
+        mode=fit_mode or cfg["COMPOSE_FIT"],
+        anchor=cfg["COMPOSE_ANCHOR"],
+        source=source,
+    )
+
+
+def render_composition(composition) -> PILImage.Image:
+    cutout_img = load_cutout(composition.image)
+    if composition.background is None:
+        return cutout_img
+    return compose_with(cutout_img, composition.background, composition.fit_mode)
+
+
+def load_composition_image(composition) -> PILImage.Image:
+    if not composition.output_path:
+        return render_composition(composition)
+    img = open_image(composition.output_path)
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGBA")
+    return img
+
+
+def composition_png(composition) -> bytes:
+    key = (
+        "composition", composition.id, composition.image_id, composition.background_id, composition.fit_mode,
+    ) + _cutout_key(composition.image)
+    data = render_cache.get(key)
+    if data is None:
+        buf = io.BytesIO()
+        render_composition(composition).save(buf, "PNG", compress_level=current_app.config["PNG_COMPRESS_LEVEL"])
+        data = buf.getvalue()
+        render_cache.set(key, data, size=len(data))
+    return data
+
+
+def _preview_jpeg(img: PILImage.Image) -> bytes:
+    canvas = PILImage.new("RGB", img.size, (255, 255, 255))
+    canvas.paste(img, mask=img.getchannel("A"))
+    buf = io.BytesIO()
+    canvas.save(buf, "JPEG", quality=current_app.config["PREVIEW_QUALITY"])
+    return buf.getvalue()
+
+
+def preview_jpeg(composition, background=None, fit_mode: str = None, max_edge: int = None,
+                 source: PILImage.Image = None) -> bytes:
+    """Low-resolution composite of ``composition``'s cutout over a library background or an unsaved upload."""
+    cfg = current_app.config
+    cutout_img = preview_cutout(composition.image, max_edge or cfg["PREVIEW_MAX_EDGE"])
+    if source is not None:
+        fitted = fit_background(source, cutout_img.size, fit_mode or cfg["COMPOSE_FIT"], cfg["COMPOSE_ANCHOR"])
+        return _preview_jpeg(PILImage.alpha_composite(fitted.convert("RGBA"), cutout_img))
+    if background is None:
+        return _preview_jpeg(cutout_img)
+    return _preview_jpeg(compose_with(cutout_img, background, fit_mode))
+
+
+def open_preview_source(stream, max_edge: int) -> PILImage.Image:
+    """Decode an unsaved background upload at roughly the preview's scale."""
+    with PILImage.open(stream) as img:
+        img.draft("RGB", (max_edge * 2, max_edge * 2))
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_edge * 2, max_edge * 2), PILImage.BILINEAR)
+        return img.convert("RGB")
+
+
+def background_thumbnail(background, width: int) -> bytes:
+    key = ("background_thumb", background.id, width)
+    data = render_cache.get(key)
+    if data is None:
+        with storage.open(background.bg_path) as f, PILImage.open(f) as img:
+            img.draft("RGB", (width, width))
+            img = img.convert("RGB")
+            img.thumbnail((width, width), PILImage.BILINEAR)
+            buf = io.BytesIO()
+            img.save(buf, "JPEG", quality=current_app.config["PREVIEW_QUALITY"])
+        data = buf.getvalue()
+        render_cache.set(key, data, size=len(data))
+    return data
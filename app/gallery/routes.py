@@ -1,13 +1,28 @@
+import json
+import os
+import time
 from datetime import datetime
 from flask import (
     render_template, request, redirect, url_for,
-    flash, g
+    flash, g, jsonify, abort, Response, current_app, make_response, stream_with_context
 )
+from werkzeug.exceptions import RequestEntityTooLarge
 from . import gallery_bp
-from ..models import Composition, Comment, Image
-from .. import db
+from PIL import Image as PILImage, UnidentifiedImageError
+from ..models import Background, Composition, Comment, Job, user_likes
+from .. import db, storage
 from ..auth.routes import login_required, can_edit_resource
-from .utils import allowed_file, process_subject_and_background, recompose_with_new_background
+from .utils import (
+    allowed_file, submit_composition_job, submit_batch_job, recompose_with_new_background, UploadRejected,
+    megabytes, recompose_with_background, background_library, owned_background,
+)
+from .render import background_thumbnail, composition_png, open_preview_source, preview_jpeg
+from .archive import stream_zip
+from ..media import media_url
+from .derivatives import derivative_rel_path, ensure_derivatives, remove_derivatives
+from .compositor import FIT_MODES
+from .likes import add_like, remove_like, has_liked, comment_added, comment_removed
+from .fragments import render_cards
 
 
 @gallery_bp.route("/", methods=["GET", "POST"])
@@ -35,34 +50,208 @@ def gallery():
         visibility = request.form.get("visibility", "public")
         is_public = (visibility == "public")
 
-        comp = process_subject_and_background(
-            subject_file,
-            background_file,
-            g.user.id,
-            is_public=is_public,
-        )
-        flash("Finished")
-        return redirect(url_for("gallery.composition_detail", comp_id=comp.id))
+        try:
+            job = submit_composition_job(
+                subject_file,
+                background_file,
+                g.user.id,
+                is_public=is_public,
+                fit_mode=_fit_mode_from_form(),
+                tier=_tier_from_form(),
+            )
+        except UploadRejected as exc:
+            return _upload_rejected(str(exc), "gallery.gallery")
+        if request.accept_mimetypes.best == "application/json":
+            return jsonify({"job_id": job.id, "status_url": url_for("gallery.job_status_json", job_id=job.id)}), 202
+
+        flash("Upload received, removing the background...")
+        return redirect(url_for("gallery.job_status", job_id=job.id))
+
+    cards, next_cursor, count = render_cards(request.args.get("cursor"))
+    return render_template(
+        "gallery/gallery.html",
+        cards=cards,
+        card_count=count,
+        next_cursor=next_cursor,
+        fit_modes=FIT_MODES,
+    )
+
+
+@gallery_bp.route("/gallery/page")
+def gallery_page():
+    cards, next_cursor, _ = render_cards(request.args.get("cursor"))
+    resp = make_response(cards)
+    if next_cursor:
+        resp.headers["X-Next-Page"] = url_for("gallery.gallery_page", cursor=next_cursor)
+    return resp
+
+
+def _upload_rejected(message: str, endpoint: str, status: int = 400, **values):
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({"error": message}), status
+    flash(message)
+    return redirect(url_for(endpoint, **values))
+
+
+@gallery_bp.app_errorhandler(RequestEntityTooLarge)
+def upload_too_large(exc):
+    limit = megabytes(current_app.config["MAX_CONTENT_LENGTH"])
+    return _upload_rejected(f"Upload is larger than {limit}.", "gallery.gallery", status=413)
+
+
+def _fit_mode_from_form():
+    fit_mode = request.form.get("fit")
+    return fit_mode if fit_mode in FIT_MODES else None
+
+
+def _tier_from_form():
+    tier = request.form.get("tier")
+    return tier if tier in current_app.config["MODEL_TIERS"] else None
+
+
+def _get_job_or_404(job_id) -> Job:
+    job = Job.query.get_or_404(job_id)
+    if not can_edit_resource(job.user_id, g.user):
+        abort(404)
+    return job
+
+
+def _job_data(job: Job) -> dict:
+    payload = json.loads(job.payload)
+    data = {
+        "id": job.id,
+        "kind": job.kind,
+        "tier": payload.get("tier"),
+        "model": payload.get("model"),
+        "status": job.status,
+        "error": job.error,
+        "total": job.total,
+        "done": job.done,
+        "composition_id": job.composition_id,
+    }
+    if job.kind == "batch":
+        data["composition_ids"] = json.loads(job.result) if job.result else []
+        if job.status == "done":
+            data["download_url"] = url_for("gallery.job_download", job_id=job.id)
+    elif job.composition_id:
+        data["result_url"] = url_for("gallery.composition_detail", comp_id=job.composition_id)
+    return data
+
+
+@gallery_bp.route("/batch", methods=["GET", "POST"])
+@login_required
+def batch_upload():
+    if request.method == "POST":
+        subject_files = [f for f in request.files.getlist("subjects") if f and f.filename]
+        background_file = request.files.get("background")
 
-    query = Composition.query
+        if not subject_files:
+            flash("No images selected.")
+            return redirect(url_for("gallery.batch_upload"))
 
-    if g.user is None:
-        query = query.filter(Composition.is_public.is_(True))
-    elif g.user.is_admin:
-        pass
-    else:
-        query = (
-            query.outerjoin(Image)
-            .filter(
-                db.or_(
-                    Composition.is_public.is_(True),
-                    Image.user_id == g.user.id,
-                )
+        if len(subject_files) > current_app.config["BATCH_MAX_FILES"]:
+            flash(f"At most {current_app.config['BATCH_MAX_FILES']} images per batch.")
+            return redirect(url_for("gallery.batch_upload"))
+
+        if not all(allowed_file(f.filename) for f in subject_files):
+            flash("Frontal image type not supported.")
+            return redirect(url_for("gallery.batch_upload"))
+
+        if background_file and background_file.filename and not allowed_file(background_file.filename):
+            flash("Background image type not supported.")
+            return redirect(url_for("gallery.batch_upload"))
+
+        try:
+            job = submit_batch_job(
+                subject_files,
+                background_file,
+                g.user.id,
+                is_public=request.form.get("visibility", "public") == "public",
+                fit_mode=_fit_mode_from_form(),
+                tier=_tier_from_form(),
             )
-        )
+        except UploadRejected as exc:
+            return _upload_rejected(str(exc), "gallery.batch_upload")
+        if request.accept_mimetypes.best == "application/json":
+            return jsonify({
+                "job_id": job.id,
+                "status_url": url_for("gallery.job_status_json", job_id=job.id),
+                "events_url": url_for("gallery.job_events", job_id=job.id),
+            }), 202
+
+        flash(f"{len(subject_files)} images received, removing the backgrounds...")
+        return redirect(url_for("gallery.job_status", job_id=job.id))
 
-    compositions = query.order_by(Composition.created_at.desc()).all()
-    return render_template("gallery/gallery.html", compositions=compositions)
+    return render_template("gallery/batch.html", fit_modes=FIT_MODES)
+
+
+@gallery_bp.route("/jobs/<job_id>")
+@login_required
+def job_status(job_id):
+    job = _get_job_or_404(job_id)
+    if job.kind == "batch":
+        return render_template("gallery/batch_status.html", job=job, data=_job_data(job))
+    if job.status == "done" and job.composition_id:
+        return redirect(url_for("gallery.composition_detail", comp_id=job.composition_id))
+    return render_template("gallery/job_status.html", job=job)
+
+
+@gallery_bp.route("/jobs/<job_id>/status")
+@login_required
+def job_status_json(job_id):
+    return jsonify(_job_data(_get_job_or_404(job_id)))
+
+
+@gallery_bp.route("/jobs/<job_id>/events")
+@login_required
+def job_events(job_id):
+    job_id = _get_job_or_404(job_id).id
+    poll_seconds = current_app.config["JOB_POLL_SECONDS"]
+
+    def generate():
+        last = None
+        while True:
+            db.session.rollback()
+            job = db.session.get(Job, job_id, populate_existing=True)
+            data = _job_data(job)
+            if (data["status"], data["done"]) != last:
+                last = (data["status"], data["done"])
+                yield f"data: {json.dumps(data)}\n\n"
+            if job.status in ("done", "failed"):
+                return
+            time.sleep(poll_seconds)
+
+    resp = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"
+    return resp
+
+
+@gallery_bp.route("/jobs/<job_id>/download")
+@login_required
+def job_download(job_id):
+    job = _get_job_or_404(job_id)
+    if job.kind != "batch" or job.status != "done":
+        abort(404)
+
+    filenames = [s["filename"] for s in json.loads(job.payload)["subjects"]]
+    comp_ids = json.loads(job.result or "[]")
+
+    def entries():
+        for i, (comp_id, filename) in enumerate(zip(comp_ids, filenames), start=1):
+            comp = db.session.get(Composition, comp_id)
+            if comp is None:
+                continue
+            stem = os.path.splitext(filename)[0] or str(comp_id)
+            if comp.output_path:
+                ext = os.path.splitext(comp.output_path)[1]
+                yield f"{i:03d}_{stem}{ext}", storage.open(comp.output_path)
+            else:
+                yield f"{i:03d}_{stem}.png", composition_png(comp)
+
+    resp = Response(stream_with_context(stream_zip(entries())), mimetype="application/zip")
+    resp.headers["Content-Disposition"] = f"attachment; filename=batch-{job.id}.zip"
+    return resp
 
 
 @gallery_bp.route("/composition/<int:comp_id>", methods=["GET", "POST"])
@@ -90,12 +279,45 @@ def composition_detail(comp_id):
                 text=text
             )
             db.session.add(comment)
+            comment_added(comp.id)
             db.session.commit()
             flash("Comment successfully posted.")
 
         return redirect(url_for("gallery.composition_detail", comp_id=comp.id))
 
-    return render_template("gallery/composition_detail.html", composition=comp)
+    liked = g.user is not None and has_liked(g.user.id, comp.id)
+    return render_template("gallery/composition_detail.html", composition=comp, liked=liked)
+
+
+@gallery_bp.route("/render/composition/<int:comp_id>.png")
+def render_composition(comp_id):
+    comp = Composition.query.get_or_404(comp_id)
+
+    owner_id = comp.image.user_id if comp.image else None
+    if not comp.is_public and not can_edit_resource(owner_id, g.user):
+        abort(404)
+
+    resp = Response(composition_png(comp), mimetype="image/png")
+    resp.cache_control.max_age = 86400
+    resp.cache_control.private = not comp.is_public
+    resp.cache_control.public = comp.is_public
+    return resp
+
+
+@gallery_bp.route("/thumb/<int:comp_id>/<int:width>")
+def composition_thumb(comp_id, width):
+    comp = Composition.query.get_or_404(comp_id)
+
+    if width not in current_app.config["THUMB_WIDTHS"]:
+        abort(404)
+
+    owner_id = comp.image.user_id if comp.image else None
+    if not comp.is_public and not can_edit_resource(owner_id, g.user):
+        abort(404)
+
+    ensure_derivatives(comp)
+    db.session.commit()
+    return redirect(media_url(derivative_rel_path(comp, width)))
 
 
 @gallery_bp.route("/comment/<int:comment_id>/edit", methods=["GET", "POST"])
@@ -133,6 +355,7 @@ def delete_comment(comment_id):
 
     comp_id = comment.composition_id
     db.session.delete(comment)
+    comment_removed(comp_id)
     db.session.commit()
     flash("Comment successfully deleted.")
     return redirect(url_for("gallery.composition_detail", comp_id=comp_id))
@@ -175,8 +398,7 @@ def set_profile_image(comp_id):
 def like_composition(comp_id):
     comp = Composition.query.get_or_404(comp_id)
 
-    if g.user not in comp.likers:
-        comp.likers.append(g.user)
+    if add_like(g.user.id, comp.id):
         db.session.commit()
 
     return redirect(url_for("gallery.composition_detail", comp_id=comp.id))
@@ -187,8 +409,7 @@ def like_composition(comp_id):
 def unlike_composition(comp_id):
     comp = Composition.query.get_or_404(comp_id)
 
-    if g.user in comp.likers:
-        comp.likers.remove(g.user)
+    if remove_like(g.user.id, comp.id):
         db.session.commit()
 
     return redirect(url_for("gallery.composition_detail", comp_id=comp.id))
@@ -205,8 +426,18 @@ def change_background(comp_id):
         return redirect(url_for("gallery.composition_detail", comp_id=comp.id))
 
     if request.method == "POST":
+        background_id = request.form.get("background_id")
         bg_file = request.files.get("background")
 
+        if background_id and not (bg_file and bg_file.filename):
+            background = owned_background(background_id, owner_id)
+            if background is None:
+                flash("Background not found in your library.")
+                return redirect(url_for("gallery.change_background", comp_id=comp.id))
+            recompose_with_background(comp, background, fit_mode=_fit_mode_from_form())
+            flash("Background updated successfully.")
+            return redirect(url_for("gallery.composition_detail", comp_id=comp.id))
+
         if not bg_file or bg_file.filename == "":
             flash("No background selected.")
             return redirect(url_for("gallery.change_background", comp_id=comp.id))
@@ -215,11 +446,72 @@ def change_background(comp_id):
             flash("Background image type not supported.")
             return redirect(url_for("gallery.change_background", comp_id=comp.id))
 
-        recompose_with_new_background(comp, bg_file)
+        try:
+            recompose_with_new_background(comp, bg_file, fit_mode=_fit_mode_from_form())
+        except UploadRejected as exc:
+            return _upload_rejected(str(exc), "gallery.change_background", comp_id=comp.id)
         flash("Background updated successfully.")
         return redirect(url_for("gallery.composition_detail", comp_id=comp.id))
 
-    return render_template("gallery/change_background.html", composition=comp)
+    return render_template(
+        "gallery/change_background.html",
+        composition=comp,
+        fit_modes=FIT_MODES,
+        library=background_library(owner_id),
+    )
+
+
+@gallery_bp.route("/composition/<int:comp_id>/preview", methods=["GET", "POST"])
+@login_required
+def preview_background(comp_id):
+    comp = Composition.query.get_or_404(comp_id)
+
+    owner_id = comp.image.user_id if comp.image else None
+    if comp.image is None or not can_edit_resource(owner_id, g.user):
+        abort(404)
+
+    cfg = current_app.config
+    values = request.form if request.method == "POST" else request.args
+    width = values.get("width", type=int)
+    if width not in cfg["THUMB_WIDTHS"]:
+        width = cfg["PREVIEW_MAX_EDGE"]
+    fit_mode = values.get("fit")
+    fit_mode = fit_mode if fit_mode in FIT_MODES else comp.fit_mode
+
+    bg_file = request.files.get("background")
+    if request.method == "POST" and bg_file and bg_file.filename:
+        try:
+            source = open_preview_source(bg_file.stream, width)
+        except (UnidentifiedImageError, OSError, PILImage.DecompressionBombError):
+            return jsonify({"error": "File is not a supported image."}), 400
+        data = preview_jpeg(comp, fit_mode=fit_mode, max_edge=width, source=source)
+    else:
+        background = comp.background
+        if values.get("background_id"):
+            background = owned_background(values["background_id"], owner_id)
+            if background is None:
+                abort(404)
+        data = preview_jpeg(comp, background, fit_mode, max_edge=width)
+
+    resp = Response(data, mimetype="image/jpeg")
+    resp.cache_control.private = True
+    resp.cache_control.no_store = request.method == "POST"
+    if request.method == "GET":
+        resp.cache_control.max_age = 300
+    return resp
+
+
+@gallery_bp.route("/background/<int:background_id>/thumb")
+@login_required
+def background_thumb(background_id):
+    background = Background.query.get_or_404(background_id)
+    if not can_edit_resource(background.user_id, g.user):
+        abort(404)
+
+    resp = Response(background_thumbnail(background, min(current_app.config["THUMB_WIDTHS"])), mimetype="image/jpeg")
+    resp.cache_control.private = True
+    resp.cache_control.max_age = 86400
+    return resp
 
 
 @gallery_bp.route("/composition/<int:comp_id>/delete", methods=["POST"])
@@ -233,15 +525,13 @@ def delete_composition(comp_id):
         flash("You have no permission to delete this composition.")
         return redirect(url_for("gallery.composition_detail", comp_id=comp.id))
 
-    if hasattr(comp, "likers"):
-        comp.likers.clear()
-
-    for c in list(comp.comments):
-        db.session.delete(c)
+    db.session.execute(user_likes.delete().where(user_likes.c.composition_id == comp.id))
+    Comment.query.filter(Comment.composition_id == comp.id).delete(synchronize_session=False)
 
     db.session.delete(comp)
 
     db.session.commit()
+    remove_derivatives(comp_id)
     flash("Composition successfully deleted.")
     return redirect(url_for("gallery.gallery"))
 
@@ -0,0 +1,297 @@
+from uuid import uuid4
+
+import numpy as np
+from flask import current_app
+from PIL import Image as PILImage, ImageFilter, ImageOps
+from rembg import remove
+
+from .. import storage
+from ..metrics import stage
+
+ROTATING_ORIENTATIONS = {5, 6, 7, 8}
+# Tiles whose coarse mask varies less than this are settled and skip inference.
+TILE_UNCERTAINTY = 8
+
+U2NET_NORMALIZATION = ((0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320))
+BATCH_NORMALIZATION = {
+    "u2net": U2NET_NORMALIZATION,
+    "u2netp": U2NET_NORMALIZATION,
+    "u2net_human_seg": U2NET_NORMALIZATION,
+    "silueta": U2NET_NORMALIZATION,
+    "isnet-general-use": ((0.5, 0.5, 0.5), (1.0, 1.0, 1.0), (1024, 1024)),
+}
+
+
+@stage("decode")
+def open_proxy(path: str, max_edge: int) -> PILImage.Image:
+    img = PILImage.open(path)
+    # JPEG can decode straight to 1/2, 1/4 or 1/8 scale; other formats ignore it.
+    img.draft("RGB", (max_edge, max_edge))
+    img = ImageOps.exif_transpose(img)
+
+    factor = max(img.size) // max_edge
+    if factor >= 2:
+        img = img.reduce(factor)
+    img = img.convert("RGB")
+    img.thumbnail((max_edge, max_edge), PILImage.BILINEAR)
+    return img
+
+
+def predict_mask(img: PILImage.Image, session) -> PILImage.Image:
+    return remove(img, session=session, only_mask=True)
+
+
+def supports_batching(session) -> bool:
+    inner = getattr(session, "inner_session", None)
+    if inner is None or getattr(session, "model_name", None) not in BATCH_NORMALIZATION:
+        return False
+    return not isinstance(inner.get_inputs()[0].shape[0], int)
+
+
+def predict_masks(images, session) -> list:
+    if len(images) < 2 or not supports_batching(session):
+        return [predict_mask(img, session) for img in images]
+
+    mean, std, size = BATCH_NORMALIZATION[session.model_name]
+    input_name = session.inner_session.get_inputs()[0].name
+    batch = np.concatenate([session.normalize(img, mean, std, size)[input_name] for img in images])
+    preds = session.inner_session.run(None, {input_name: batch})[0][:, 0]
+
+    masks = []
+    for img, pred in zip(images, preds):
+        low, high = pred.min(), pred.max()
+        pred = (pred - low) / max(high - low, 1e-6)
+        mask = PILImage.fromarray((pred.clip(0, 1) * 255).astype(np.uint8))
+        masks.append(mask.resize(img.size, PILImage.LANCZOS))
+    return masks
+
+
+@stage("mask")
+def upsample_mask(mask: PILImage.Image, size) -> PILImage.Image:
+    if mask.size == size:
+        return mask
+    scale = max(size[0] / mask.size[0], size[1] / mask.size[1])
+    mask = mask.resize(size, PILImage.BICUBIC)
+    if scale >= 2:
+        mask = mask.filter(ImageFilter.GaussianBlur(scale / 4))
+    return mask
+
+
+def oriented_size(path: str):
+    with PILImage.open(path) as img:
+        width, height = img.size
+        if img.getexif().get(0x0112) in ROTATING_ORIENTATIONS:
+            return height, width
+        return width, height
+
+
+@stage("decode")
+def open_subject(path: str) -> PILImage.Image:
+    return ImageOps.exif_transpose(PILImage.open(path)).convert("RGBA")
+
+
+@stage("decode")
+def open_full(path: str) -> PILImage.Image:
+    img = PILImage.open(path)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    # In place, so a full-size RGB image is decoded once rather than copied twice.
+    ImageOps.exif_transpose(img, in_place=True)
+    return img
+
+
+def segment(path: str, executor, model_name: str = None) -> PILImage.Image:
+    return segment_many([path], executor, model_name)[0]
+
+
+def use_tiles(path: str) -> bool:
+    cfg = current_app.config
+    if cfg["SEGMENT_MODE"] == "tiled":
+        return True
+    threshold = cfg["SEGMENT_TILE_MIN_PIXELS"]
+    if not threshold:
+        return False
+    width, height = oriented_size(path)
+    return width * height >= threshold
+
+
+def segment_many(paths, executor, model_name: str = None) -> list:
+    paths = list(paths)
+    masks = [None] * len(paths)
+    untiled = []
+    for i, path in enumerate(paths):
+        if use_tiles(path):
+            masks[i] = segment_tiled(path, executor, model_name)
+        else:
+            untiled.append(i)
+
+    if untiled:
+        for i, mask in zip(untiled, _segment_untiled([paths[i] for i in untiled], executor, model_name)):
+            masks[i] = mask
+    return masks
+
+
+def _segment_untiled(paths, executor, model_name: str = None) -> list:
+    cfg = current_app.config
+
+    if cfg["SEGMENT_MODE"] == "full":
+        images = [open_full(path) for path in paths]
+        return executor.predict_masks(images, model_name)
+
+    proxies = [open_proxy(path, cfg["SEGMENT_MAX_EDGE"]) for path in paths]
+    masks = executor.predict_masks(proxies, model_name)
+    del proxies
+    return [upsample_mask(mask, oriented_size(path)) for mask, path in zip(masks, paths)]
+
+
+def segment_tiled(path: str, executor, model_name: str = None) -> PILImage.Image:
+    cfg = current_app.config
+    proxy = open_proxy(path, cfg["SEGMENT_MAX_EDGE"])
+    coarse = executor.predict_masks([proxy], model_name)[0]
+    del proxy
+
+    return refine_tiles(
+        open_full(path),
+        coarse,
+        lambda tiles: executor.predict_masks(tiles, model_name),
+        tile=cfg["SEGMENT_TILE_SIZE"],
+        overlap=cfg["SEGMENT_TILE_OVERLAP"],
+        batch_size=cfg["SEGMENT_TILE_BATCH"],
+        band=cfg["SEGMENT_TILE_BAND"],
+    )
+
+
+def tile_starts(length: int, tile: int, overlap: int) -> list:
+    if length <= tile:
+        return [0]
+    starts = list(range(0, length - tile, tile - overlap))
+    starts.append(length - tile)
+    return starts
+
+
+def _ramp(length: int, overlap: int) -> np.ndarray:
+    if overlap <= 0:
+        return np.ones(length, np.float32)
+    distance = np.minimum(np.arange(1, length + 1), np.arange(length, 0, -1))
+    return np.minimum(distance / (overlap + 1), 1).astype(np.float32)
+
+
+def _spread(arr: np.ndarray, radius: int, op) -> np.ndarray:
+    """Separable min or max filter, with ``op`` being ``np.minimum`` or ``np.maximum``."""
+    if radius <= 0:
+        return arr
+    height, width = arr.shape
+    padded = np.pad(arr, ((radius, radius), (0, 0)), mode="edge")
+    rows = padded[:height].copy()
+    for shift in range(1, 2 * radius + 1):
+        op(rows, padded[shift:shift + height], out=rows)
+    padded = np.pad(rows, ((0, 0), (radius, radius)), mode="edge")
+    result = padded[:, :width].copy()
+    for shift in range(1, 2 * radius + 1):
+        op(result, padded[:, shift:shift + width], out=result)
+    return result
+
+
+def _tile_alphas(img, boxes, guides, predict) -> list:
+    coarse, lower, upper = guides
+    scale_x, scale_y = coarse.width / img.width, coarse.height / img.height
+
+    alphas, bounds, pending = [], [], []
+    for i, (left, top, right, bottom) in enumerate(boxes):
+        size = (right - left, bottom - top)
+        proxy_box = (left * scale_x, top * scale_y, right * scale_x, bottom * scale_y)
+        lo, hi, guess = (
+            np.asarray(m.resize(size, PILImage.BILINEAR, box=proxy_box)) for m in (lower, upper, coarse)
+        )
+        alphas.append(guess.astype(np.float32))
+        bounds.append((lo, hi))
+        if (hi - lo).max() >= TILE_UNCERTAINTY:
+            pending.append(i)
+
+    if pending:
+        preds = predict([img.crop(boxes[i]) for i in pending])
+        for i, pred in zip(pending, preds):
+            lo, hi = bounds[i]
+            alphas[i] = np.clip(np.asarray(pred.convert("L"), np.float32), lo, hi)
+    return alphas
+
+
+def refine_tiles(img: PILImage.Image, coarse: PILImage.Image, predict, tile: int = 1024, overlap: int = 128,
+                 batch_size: int = 4, band: float = 0.02) -> PILImage.Image:
+    """Sharpen a coarse full-image mask with overlapping full-resolution tiles.
+
+    The coarse mask supplies global context: each tile's prediction is clamped
+    between its eroded and dilated versions, and tiles it already settles skip
+    inference. Tile masks are feathered together in a buffer one tile row high.
+    ``img`` is already decoded in full, so peak memory is that RGB image plus
+    the uint8 mask and the row buffer; tiling bounds the model's input, not
+    the decode.
+    """
+    width, height = img.size
+    overlap = min(overlap, tile // 2)
+    coarse = coarse.convert("L")
+    radius = max(1, round(max(coarse.size) * band))
+    coarse_arr = np.asarray(coarse)
+    guides = (
+        coarse,
+        PILImage.fromarray(_spread(coarse_arr, radius, np.minimum)),
+        PILImage.fromarray(_spread(coarse_arr, radius, np.maximum)),
+    )
+
+    xs = tile_starts(width, tile, overlap)
+    ys = tile_starts(height, tile, overlap)
+    band_height = min(tile, height)
+    acc = np.zeros((band_height, width), np.float32)
+    weights = np.zeros((band_height, width), np.float32)
+    out = np.empty((height, width), np.uint8)
+    feather = {}
+
+    for row, top in enumerate(ys):
+        boxes = [(left, top, min(left + tile, width), top + band_height) for left in xs]
+        for start in range(0, len(boxes), batch_size):
+            chunk = boxes[start:start + batch_size]
+            for (left, _, right, _), alpha in zip(chunk, _tile_alphas(img, chunk, guides, predict)):
+                size = (band_height, right - left)
+                if size not in feather:
+                    feather[size] = np.outer(_ramp(size[0], overlap), _ramp(size[1], overlap))
+                acc[:, left:right] += alpha * feather[size]
+                weights[:, left:right] += feather[size]
+
+        # Rows above the next tile row get no more contributions.
+        done = (ys[row + 1] if row + 1 < len(ys) else height) - top
+        finished = np.divide(acc[:done], weights[:done], out=acc[:done])
+        out[top:top + done] = np.rint(finished, out=finished)
+        keep = band_height - done
+        acc[:keep] = acc[done:]
+        weights[:keep] = weights[done:]
+        acc[keep:] = 0
+        weights[keep:] = 0
+
+    return PILImage.fromarray(out)
+
+
+def apply_mask(path: str, mask: PILImage.Image) -> PILImage.Image:
+    subject_img = open_subject(path)
+    subject_img.putalpha(mask)
+    return subject_img
+
+
+def cut_out(path: str, executor, model_name: str = None) -> PILImage.Image:
+    return apply_mask(path, segment(path, executor, model_name))
+
+
+@stage("encode")
+def save_mask(mask: PILImage.Image, folder: str, fmt: str = "png") -> str:
+    key = storage.key_for(folder, f"{uuid4().hex}.{fmt}")
+    with storage.writer(key) as out:
+        if fmt == "npy":
+            np.save(out, np.asarray(mask, dtype=np.uint8))
+        else:
+            mask.save(out, "PNG", optimize=True)
+    return key
+
+
+def load_mask(path: str) -> PILImage.Image:
+    if path.endswith(".npy"):
+        return PILImage.fromarray(np.load(path, mmap_mode="r"))
+    return PILImage.open(path).convert("L")
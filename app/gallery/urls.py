@@ -0,0 +1,41 @@
+from flask import url_for, current_app
+
+from . import gallery_bp
+from .derivatives import derivative_key, derivative_rel_path, has_derivatives, nearest_width
+from ..media import media_url
+
+
+@gallery_bp.app_template_global()
+def composition_url(composition) -> str:
+    if composition.output_path:
+        return media_url(composition.output_path)
+    return url_for(
+        "gallery.render_composition",
+        comp_id=composition.id,
+        v=derivative_key(composition),
+    )
+
+
+@gallery_bp.app_template_global()
+def composition_format(composition) -> str:
+    """Name of the format composition_url serves, e.g. "WEBP"."""
+    if not composition.output_path:
+        return "PNG"
+    ext = composition.output_path.rsplit(".", 1)[-1].upper()
+    return "JPEG" if ext == "JPG" else ext
+
+
+@gallery_bp.app_template_global()
+def thumb_url(composition, width: int) -> str:
+    width = nearest_width(width)
+    if has_derivatives(composition):
+        return media_url(derivative_rel_path(composition, width))
+    return url_for("gallery.composition_thumb", comp_id=composition.id, width=width)
+
+
+@gallery_bp.app_template_global()
+def thumb_srcset(composition) -> str:
+    return ", ".join(
+        f"{thumb_url(composition, width)} {width}w"
+        for width in sorted(current_app.config["THUMB_WIDTHS"])
+    )
@@ -1,134 +1,546 @@
+import hashlib
+import io
+import json
 import os
+from contextlib import ExitStack
+from datetime import datetime
 from uuid import uuid4
-import uuid
-from PIL import Image as PILImage
-from rembg import remove
 from werkzeug.utils import secure_filename
 from flask import current_app
-from ..models import Image as ImageModel, Background, Composition
-from .. import db
+from sqlalchemy.exc import IntegrityError
+from ..models import Image as ImageModel, Background, Composition, Job
+from .. import db, inference, jobs, model_sessions, storage
+from ..metrics import stage
+from ..stats import stats
+from PIL import Image as PILImage, ImageOps, UnidentifiedImageError
+from .segmentation import apply_mask, segment, segment_many, save_mask
+from .render import load_cutout, compose_with, open_image
+from .derivatives import refresh_derivatives
+from .encoding import save_encoded
 
 
 
 ALLOWED_EXTENSIONS = {"png", "jpg", "jpeg", "webp"}
+ALLOWED_FORMATS = {"PNG", "JPEG", "WEBP"}
+CHUNK_SIZE = 64 * 1024
+SNIFF_LIMIT = 1024 * 1024
+
+
+class UploadRejected(Exception):
+    pass
+
+
+def megabytes(size: int) -> str:
+    return f"{size / (1024 * 1024):.3g} MB"
 
 
 def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def save_image_file(file_storage, folder: str) -> str:
+def _sniff_size(header: bytes, complete: bool = False):
+    cfg = current_app.config
+    try:
+        with PILImage.open(io.BytesIO(header)) as img:
+            fmt, size = img.format, img.size
+    except PILImage.DecompressionBombError:
+        raise UploadRejected("Image dimensions are too large.")
+    except (UnidentifiedImageError, OSError, SyntaxError, ValueError):
+        if complete or len(header) >= SNIFF_LIMIT:
+            raise UploadRejected("File is not a supported image.")
+        return None
+
+    if fmt not in ALLOWED_FORMATS:
+        raise UploadRejected("Image type not supported.")
+
+    pixels = size[0] * size[1]
+    if pixels > cfg["UPLOAD_MAX_PIXELS"] and (
+        cfg["UPLOAD_OVERSIZE"] == "reject" or pixels > cfg["UPLOAD_DOWNSCALE_MAX_PIXELS"]
+    ):
+        raise UploadRejected(f"Image is {size[0]}x{size[1]}, which exceeds the allowed dimensions.")
+    return size
+
+
+def _downscale(path: str, max_pixels: int):
+    with PILImage.open(path) as img:
+        fmt = img.format
+        scale = (max_pixels / (img.width * img.height)) ** 0.5
+        # JPEG decodes straight at a reduced scale, so the full frame is never in memory.
+        img.draft("RGB", (int(img.width * scale), int(img.height * scale)))
+        img = ImageOps.exif_transpose(img)
+
+        scale = min(1.0, (max_pixels / (img.width * img.height)) ** 0.5)
+        img.thumbnail((int(img.width * scale), int(img.height * scale)), PILImage.LANCZOS)
+        img.save(path, fmt, quality=90)
+
+
+@stage("save")
+def save_upload(file_storage, folder: str):
+    """Copy an upload to storage under ``folder``; return ``(key, sha256 hex digest)``.
+
+    Werkzeug has already spooled the whole request body by the time this runs;
+    only MAX_CONTENT_LENGTH is enforced before that. While copying the file
+    out, UPLOAD_MAX_BYTES is checked chunk by chunk and format and dimensions
+    are read from the header as soon as it parses, so a refused image is not
+    copied any further and never reaches storage. An image that is only over
+    UPLOAD_MAX_PIXELS is copied in full, then downscaled before it is stored.
+    """
+    cfg = current_app.config
     filename = secure_filename(file_storage.filename)
     ext = filename.rsplit(".", 1)[1].lower()
-    new_name = f"{uuid4().hex}.{ext}"
-    path = os.path.join(folder, new_name)
-    file_storage.save(path)
-    rel_path = os.path.relpath(path, os.path.join(current_app.root_path, "static")).replace("\\", "/")
+    key = storage.key_for(folder, f"{uuid4().hex}.{ext}")
+
+    digest = hashlib.sha256()
+    header = b""
+    size = None
+    written = 0
+    # Checks and downscaling run on a local temp file; only accepted uploads reach storage.
+    out, path = storage.temp_file(f".{ext}")
+    try:
+        with out:
+            for chunk in iter(lambda: file_storage.stream.read(CHUNK_SIZE), b""):
+                written += len(chunk)
+                if written > cfg["UPLOAD_MAX_BYTES"]:
+                    raise UploadRejected(f"File is larger than {megabytes(cfg['UPLOAD_MAX_BYTES'])}.")
+                if size is None:
+                    header += chunk
+                    size = _sniff_size(header)
+                    if size is not None:
+                        header = b""
+                digest.update(chunk)
+                out.write(chunk)
+
+        if size is None:
+            size = _sniff_size(header, complete=True)
+        if size[0] * size[1] > cfg["UPLOAD_MAX_PIXELS"]:
+            _downscale(path, cfg["UPLOAD_MAX_PIXELS"])
+        storage.put_file(key, path)
+    except Exception:
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+
+    return key, digest.hexdigest()
+
+
+def save_image_file(file_storage, folder: str) -> str:
+    rel_path, _ = save_upload(file_storage, folder)
     return rel_path
 
 
-def process_subject_and_background(subject_file, background_file, user_id: int, is_public: bool = True):
+def choose_tier(requested: str = None) -> str:
     cfg = current_app.config
-    base_static = os.path.join(current_app.root_path, "static")
+    if requested in cfg["MODEL_TIERS"]:
+        return requested
 
-    original_rel = save_image_file(subject_file, cfg["ORIGINAL_FOLDER"])
-    original_abs = os.path.join(base_static, original_rel)
+    threshold = cfg["MODEL_DOWNGRADE_QUEUE_DEPTH"]
+    if threshold and jobs.depth() >= threshold:
+        stats.incr("tiers.downgraded")
+        return cfg["MODEL_DOWNGRADE_TIER"]
+    return cfg["MODEL_DEFAULT_TIER"]
 
-    background_rel = None
-    background_obj = None
-    if background_file and background_file.filename:
-        background_rel = save_image_file(background_file, cfg["BACKGROUND_FOLDER"])
-        background_abs = os.path.join(base_static, background_rel)
 
-        background_obj = Background(user_id=user_id, bg_path=background_rel)
-        db.session.add(background_obj)
-        db.session.flush()
-    else:
-        background_abs = None
+def acceptable_models(model_name: str) -> list:
+    # A mask from the requested tier or any better one can be reused.
+    models = list(current_app.config["MODEL_TIERS"].values())
+    if model_name not in models:
+        return [model_name]
+    return models[models.index(model_name):]
 
-    subject_img = PILImage.open(original_abs).convert("RGBA")
-    cutout_img = remove(subject_img)
 
-    cutout_name = f"{uuid4().hex}.png"
-    cutout_abs = os.path.join(cfg["CUTOUT_FOLDER"], cutout_name)
-    cutout_rel = os.path.relpath(cutout_abs, base_static).replace("\\", "/")
-    cutout_img.save(cutout_abs)
+def find_cached_image(content_hash: str, user_id: int, model_name: str = None):
+    if not content_hash:
+        return None
+    query = ImageModel.query.filter(
+        ImageModel.content_hash == content_hash,
+        db.or_(ImageModel.cutout_path.isnot(None), ImageModel.mask_path.isnot(None)),
+    )
+    if model_name:
+        query = query.filter(db.or_(
+            ImageModel.model_name.is_(None),
+            ImageModel.model_name.in_(acceptable_models(model_name)),
+        ))
+    cached = query.order_by((ImageModel.user_id == user_id).desc(), ImageModel.id).first()
+    if cached is not None and not _touch(ImageModel, cached.id):
+        # Collected between the lookup and the touch.
+        return None
+    return cached
 
-    if background_abs:
-        bg_img = PILImage.open(background_abs).convert("RGBA")
-        bg_img = bg_img.resize(cutout_img.size, PILImage.LANCZOS)
-        composed_img = PILImage.alpha_composite(bg_img, cutout_img)
 
-        composed_name = f"{uuid4().hex}.png"
-        composed_abs = os.path.join(cfg["COMPOSED_FOLDER"], composed_name)
-        composed_rel = os.path.relpath(composed_abs, base_static).replace("\\", "/")
-        composed_img.save(composed_abs)
-    else:
-        composed_rel = cutout_rel
+def _touch(model, row_id: int) -> bool:
+    # Committed on its own connection so a concurrent collector run sees the reuse at once.
+    with db.engine.begin() as conn:
+        touched = conn.execute(
+            model.__table__.update()
+            .where(model.id == row_id)
+            .values(last_used_at=datetime.utcnow())
+        )
+    return touched.rowcount > 0
+
 
+def find_background(content_hash: str, user_id: int):
+    if not content_hash:
+        return None
+    existing = Background.query.filter_by(user_id=user_id, content_hash=content_hash).order_by(Background.id).first()
+    if existing is not None and not _touch(Background, existing.id):
+        return None
+    return existing
+
+
+def save_background(background_file, user_id: int) -> Background:
+    background_rel, content_hash = save_upload(background_file, current_app.config["BACKGROUND_FOLDER"])
+
+    existing = find_background(content_hash, user_id)
+    if existing is not None:
+        stats.incr("backgrounds.dedupe.hits")
+        _remove_static(background_rel)
+        return existing
+
+    background_obj = Background(user_id=user_id, bg_path=background_rel, content_hash=content_hash)
+    db.session.add(background_obj)
+    db.session.flush()
+    return background_obj
+
+
+def owned_background(background_id, owner_id: int):
+    try:
+        background_id = int(background_id)
+    except (TypeError, ValueError):
+        return None
+    background = db.session.get(Background, background_id)
+    if background is None or background.user_id != owner_id or not _touch(Background, background.id):
+        return None
+    return background
+
+
+def background_library(user_id: int, limit: int = None):
+    limit = limit or current_app.config["BACKGROUND_LIBRARY_SIZE"]
+    return Background.query.filter_by(user_id=user_id).order_by(Background.id.desc()).limit(limit).all()
+
+
+def _image_for_upload(original_rel: str, content_hash, user_id: int, mask=None, model_name: str = None):
+    model_name = model_name or model_sessions.model_name
+    cached = find_cached_image(content_hash, user_id, model_name)
+    if cached is not None:
+        stats.incr("dedupe.hits")
+        if cached.user_id == user_id:
+            return cached, None
+        img_obj = ImageModel(
+            user_id=user_id,
+            original_path=cached.original_path,
+            cutout_path=cached.cutout_path,
+            mask_path=cached.mask_path,
+            content_hash=content_hash,
+            model_name=cached.model_name,
+        )
+        return img_obj, None
+
+    stats.incr("dedupe.misses")
+    cfg = current_app.config
     img_obj = ImageModel(
         user_id=user_id,
         original_path=original_rel,
-        cutout_path=cutout_rel,
+        content_hash=content_hash,
+        model_name=model_name,
     )
-    db.session.add(img_obj)
-    db.session.flush()
+
+    with storage.local_path(original_rel) as original_path:
+        if mask is None:
+            mask = segment(original_path, inference, model_name)
+        if cfg["STORE_MASKS_ONLY"]:
+            img_obj.mask_path = save_mask(mask, cfg["MASK_FOLDER"], cfg["MASK_FORMAT"])
+            return img_obj, None
+        cutout_img = apply_mask(original_path, mask)
+
+    _save_cutout(img_obj, cutout_img)
+    return img_obj, cutout_img
+
+
+def _save_cutout(img_obj: ImageModel, cutout_img):
+    img_obj.cutout_path = save_encoded(cutout_img, current_app.config["CUTOUT_FOLDER"], "cutout")
+
+
+def _add_image(img_obj: ImageModel) -> ImageModel:
+    if img_obj.id is not None:
+        return img_obj
+    try:
+        with db.session.begin_nested():
+            db.session.add(img_obj)
+    except IntegrityError:
+        existing = ImageModel.query.filter_by(user_id=img_obj.user_id, content_hash=img_obj.content_hash).first()
+        if existing.model_name and existing.model_name not in acceptable_models(img_obj.model_name):
+            existing.cutout_path = img_obj.cutout_path
+            existing.mask_path = img_obj.mask_path
+            existing.model_name = img_obj.model_name
+        return existing
+    return img_obj
+
+
+def _composed_output(img_obj: ImageModel, cutout_img, background_obj, fit_mode: str = None,
+                     background_source=None) -> str:
+    cfg = current_app.config
+    if cfg["STORE_MASKS_ONLY"]:
+        return ""
+
+    if background_obj:
+        if cutout_img is None:
+            cutout_img = load_cutout(img_obj)
+        composed_img = compose_with(cutout_img, background_obj, fit_mode, source=background_source)
+        return save_encoded(composed_img, cfg["COMPOSED_FOLDER"], "composed")
+
+    if img_obj.cutout_path is None:
+        _save_cutout(img_obj, load_cutout(img_obj))
+    return img_obj.cutout_path
+
+
+def build_composition(original_rel: str, background_obj, user_id: int, is_public: bool = True,
+                      content_hash: str = None, fit_mode: str = None, model_name: str = None):
+    img_obj, cutout_img = _image_for_upload(original_rel, content_hash, user_id, model_name=model_name)
+    img_obj = _add_image(img_obj)
 
     comp_obj = Composition(
-        image_id=img_obj.id,
+        image=img_obj,
         background_id=background_obj.id if background_obj else None,
-        output_path=composed_rel,
+        output_path=_composed_output(img_obj, cutout_img, background_obj, fit_mode),
+        fit_mode=fit_mode,
         is_public=is_public,
     )
     db.session.add(comp_obj)
-    db.session.commit()
+    with stage("commit"):
+        db.session.commit()
 
+    refresh_derivatives(comp_obj)
     return comp_obj
 
-def recompose_with_new_background(composition: Composition, background_file):
-    cfg = current_app.config
-    base_static = os.path.join(current_app.root_path, "static")
 
-    bg_rel_path = save_image_file(background_file, cfg["BACKGROUND_FOLDER"])
-    bg_abs = os.path.join(base_static, bg_rel_path)
+def _remove_static(rel_path: str):
+    try:
+        storage.delete(rel_path)
+    except OSError:
+        pass
+
+
+def _save_uploads(subject_file, background_file, user_id: int):
+    original_rel, content_hash = save_upload(subject_file, current_app.config["ORIGINAL_FOLDER"])
+
+    cached = find_cached_image(content_hash, user_id)
+    if cached is not None:
+        _remove_static(original_rel)
+        original_rel = cached.original_path
+
+    background_obj = None
+    if background_file and background_file.filename:
+        try:
+            background_obj = save_background(background_file, user_id)
+        except UploadRejected:
+            if cached is None:
+                _remove_static(original_rel)
+            raise
+
+    return original_rel, content_hash, background_obj
 
-    bg = Background(
-        user_id=composition.image.user_id if composition.image else None,
-        bg_path=bg_rel_path,
+
+def process_subject_and_background(subject_file, background_file, user_id: int, is_public: bool = True,
+                                   fit_mode: str = None, tier: str = None):
+    original_rel, content_hash, background_obj = _save_uploads(subject_file, background_file, user_id)
+    return build_composition(
+        original_rel,
+        background_obj,
+        user_id,
+        is_public=is_public,
+        content_hash=content_hash,
+        fit_mode=fit_mode,
+        model_name=model_sessions.model_for(choose_tier(tier)),
     )
-    db.session.add(bg)
-    db.session.flush()
 
-    static_root = current_app.static_folder
-    cutout_abs = os.path.join(static_root, composition.image.cutout_path)
-    bg_abs = os.path.join(static_root, bg_rel_path)
 
-    fg = PILImage.open(cutout_abs).convert("RGBA")
-    bg_img = PILImage.open(bg_abs).convert("RGBA")
+def submit_composition_job(subject_file, background_file, user_id: int, is_public: bool = True,
+                           fit_mode: str = None, tier: str = None, background_obj: Background = None) -> Job:
+    tier = choose_tier(tier)
+    original_rel, content_hash, saved_background = _save_uploads(subject_file, background_file, user_id)
+    background_obj = saved_background or background_obj
 
-    bg_img = bg_img.resize(fg.size, PILImage.LANCZOS)
+    job = Job(
+        kind="compose",
+        user_id=user_id,
+        payload=json.dumps({
+            "original_path": original_rel,
+            "content_hash": content_hash,
+            "background_id": background_obj.id if background_obj else None,
+            "is_public": is_public,
+            "fit_mode": fit_mode,
+            "tier": tier,
+            "model": model_sessions.model_for(tier),
+        }),
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    jobs.submit(job)
+    return job
 
-    merged = PILImage.new("RGBA", fg.size)
-    merged.paste(bg_img, (0, 0))
-    merged.alpha_composite(fg)
 
-    file_name = f"{uuid.uuid4().hex}.png"
-    out_rel = os.path.join("compositions", file_name).replace("\\", "/")
-    out_abs = os.path.join(static_root, out_rel)
-    os.makedirs(os.path.dirname(out_abs), exist_ok=True)
-    merged.save(out_abs, "PNG")
+@jobs.handler("compose")
+def run_composition_job(job: Job, payload: dict):
+    background_obj = None
+    if payload["background_id"] is not None:
+        background_obj = db.session.get(Background, payload["background_id"])
+
+    return build_composition(
+        payload["original_path"],
+        background_obj,
+        job.user_id,
+        is_public=payload["is_public"],
+        content_hash=payload.get("content_hash"),
+        fit_mode=payload.get("fit_mode"),
+        model_name=payload.get("model"),
+    )
+
+
+def submit_batch_job(subject_files, background_file, user_id: int, is_public: bool = True,
+                     fit_mode: str = None, tier: str = None, background_obj: Background = None) -> Job:
+    tier = choose_tier(tier)
+    subjects = []
+    saved = []
+    try:
+        for subject_file in subject_files:
+            original_rel, content_hash, _ = _save_uploads(subject_file, None, user_id)
+            if find_cached_image(content_hash, user_id) is None:
+                saved.append(original_rel)
+            subjects.append({
+                "original_path": original_rel,
+                "content_hash": content_hash,
+                "filename": secure_filename(subject_file.filename),
+            })
+        if background_file and background_file.filename:
+            background_obj = save_background(background_file, user_id)
+    except UploadRejected:
+        for rel_path in saved:
+            _remove_static(rel_path)
+        raise
+
+    job = Job(
+        kind="batch",
+        user_id=user_id,
+        total=len(subjects),
+        done=0,
+        payload=json.dumps({
+            "subjects": subjects,
+            "background_id": background_obj.id if background_obj else None,
+            "is_public": is_public,
+            "fit_mode": fit_mode,
+            "tier": tier,
+            "model": model_sessions.model_for(tier),
+        }),
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    jobs.submit(job)
+    return job
+
+
+def _report_progress(job: Job, done: int):
+    Job.query.filter(Job.id == job.id).update(
+        {"done": done, "heartbeat_at": datetime.utcnow()}, synchronize_session=False,
+    )
+    db.session.commit()
+
+
+@jobs.handler("batch")
+def run_batch_job(job: Job, payload: dict):
+    cfg = current_app.config
+    subjects = payload["subjects"]
+    fit_mode = payload.get("fit_mode")
+    model_name = payload.get("model") or model_sessions.model_name
+
+    background_obj = None
+    background_source = None
+    if payload["background_id"] is not None:
+        background_obj = db.session.get(Background, payload["background_id"])
+        background_source = open_image(background_obj.bg_path).convert("RGB")
+
+    # Segmentation and file writes happen chunk by chunk with progress commits;
+    # the rows are only inserted at the end so the write lock is held briefly.
+    built = []
+    images = {}
+    batch_size = cfg["BATCH_INFERENCE_SIZE"]
+    for start in range(0, len(subjects), batch_size):
+        chunk = subjects[start:start + batch_size]
+
+        pending = {}
+        with ExitStack() as originals:
+            for subject in chunk:
+                content_hash = subject["content_hash"]
+                if content_hash in images or content_hash in pending:
+                    continue
+                if find_cached_image(content_hash, job.user_id, model_name) is None:
+                    pending[content_hash] = originals.enter_context(storage.local_path(subject["original_path"]))
+            masks = dict(zip(pending, segment_many(list(pending.values()), inference, model_name)))
+
+        for subject in chunk:
+            content_hash = subject["content_hash"]
+            img_obj, cutout_img = images.get(content_hash), None
+            if img_obj is None:
+                img_obj, cutout_img = _image_for_upload(
+                    subject["original_path"], content_hash, job.user_id,
+                    mask=masks.pop(content_hash, None), model_name=model_name,
+                )
+                images[content_hash] = img_obj
+            built.append((img_obj, Composition(
+                background_id=background_obj.id if background_obj else None,
+                output_path=_composed_output(img_obj, cutout_img, background_obj, fit_mode, background_source),
+                fit_mode=fit_mode,
+                is_public=payload["is_public"],
+            )))
+
+        _report_progress(job, start + len(chunk))
+
+    added = {}
+    comps = []
+    for img_obj, comp_obj in built:
+        if id(img_obj) not in added:
+            added[id(img_obj)] = _add_image(img_obj)
+        comp_obj.image = added[id(img_obj)]
+        db.session.add(comp_obj)
+        comps.append(comp_obj)
+    with stage("commit"):
+        db.session.commit()
+
+    for comp_obj in comps:
+        refresh_derivatives(comp_obj)
+    return comps
+
+
+def recompose_with_new_background(composition: Composition, background_file, fit_mode: str = None):
+    owner_id = composition.image.user_id if composition.image else None
+    return recompose_with_background(composition, save_background(background_file, owner_id), fit_mode)
+
+
+def recompose_with_background(composition: Composition, bg: Background, fit_mode: str = None):
+    cfg = current_app.config
+    if composition.background_id == bg.id and composition.fit_mode == fit_mode:
+        db.session.commit()
+        return composition
+
+    if cfg["STORE_MASKS_ONLY"]:
+        out_rel = ""
+    else:
+        merged = compose_with(load_cutout(composition.image), bg, fit_mode)
+        out_dir = os.path.join(current_app.static_folder, "compositions")
+        out_rel = save_encoded(merged, out_dir, "composed")
 
     old_out_rel = composition.output_path
 
     if old_out_rel and old_out_rel != composition.image.cutout_path:
-        old_out_abs = os.path.join(static_root, old_out_rel)
-        try:
-            os.remove(old_out_abs)
-        except OSError:
-            pass
+        _remove_static(old_out_rel)
 
     composition.background_id = bg.id
+    composition.fit_mode = fit_mode
     composition.output_path = out_rel
 
-    db.session.commit()
-    return composition
\ No newline at end of file
+    with stage("commit"):
+        db.session.commit()
+
+    refresh_derivatives(composition)
+    return composition
@@ -0,0 +1,217 @@
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+from PIL import Image as PILImage
+
+from .metrics import inference_latency, stage_latency
+from .stats import stats
+
+_worker_sessions = {}
+_worker_threads = (0, 0)
+
+
+def _worker_session(model_name: str):
+    session = _worker_sessions.get(model_name)
+    if session is None:
+        import onnxruntime as ort
+        from rembg import new_session
+
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads, opts.inter_op_num_threads = _worker_threads
+        session = _worker_sessions[model_name] = new_session(model_name, sess_opts=opts)
+    return session
+
+
+def _init_worker(model_names, intra_op_threads: int, inter_op_threads: int):
+    global _worker_threads
+    _worker_threads = (intra_op_threads, inter_op_threads)
+    for model_name in model_names:
+        _worker_session(model_name)
+
+
+def _warm_worker(model_names):
+    from .gallery.segmentation import predict_mask
+
+    for model_name in model_names:
+        predict_mask(PILImage.new("RGB", (64, 64), (127, 127, 127)), _worker_session(model_name))
+
+
+def _predict_shared(in_name: str, out_name: str, layout: list, model_name: str):
+    from .gallery.segmentation import predict_masks
+
+    shm_in = shared_memory.SharedMemory(name=in_name)
+    shm_out = shared_memory.SharedMemory(name=out_name)
+    try:
+        images = []
+        for in_offset, _, width, height in layout:
+            view = np.ndarray((height, width, 3), np.uint8, buffer=shm_in.buf, offset=in_offset)
+            images.append(PILImage.fromarray(view.copy()))
+            del view
+
+        for (_, out_offset, width, height), mask in zip(layout, predict_masks(images, _worker_session(model_name))):
+            view = np.ndarray((height, width), np.uint8, buffer=shm_out.buf, offset=out_offset)
+            view[:] = np.asarray(mask.convert("L"))
+            del view
+    finally:
+        shm_in.close()
+        shm_out.close()
+
+
+def _pack(images):
+    layout = []
+    in_size = out_size = 0
+    for img in images:
+        layout.append((in_size, out_size, img.width, img.height))
+        in_size += img.width * img.height * 3
+        out_size += img.width * img.height
+
+    shm_in = shared_memory.SharedMemory(create=True, size=max(in_size, 1))
+    shm_out = shared_memory.SharedMemory(create=True, size=max(out_size, 1))
+    for (in_offset, _, width, height), img in zip(layout, images):
+        view = np.ndarray((height, width, 3), np.uint8, buffer=shm_in.buf, offset=in_offset)
+        view[:] = np.asarray(img.convert("RGB"))
+        del view
+    return shm_in, shm_out, layout
+
+
+def _unpack(shm_out, layout) -> list:
+    masks = []
+    for _, out_offset, width, height in layout:
+        view = np.ndarray((height, width), np.uint8, buffer=shm_out.buf, offset=out_offset)
+        masks.append(PILImage.fromarray(view.copy()))
+        del view
+    return masks
+
+
+class InferenceExecutor:
+    MODES = ("inline", "process")
+
+    def __init__(self, app=None):
+        self.mode = None
+        self.workers = 0
+        self.threads_per_worker = 0
+        self.ready = False
+        self.error = None
+        self.model_names = ()
+        self.preload = False
+        self._pool = None
+        self._start_lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        mode = app.config["INFERENCE_EXECUTOR"]
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown INFERENCE_EXECUTOR {mode!r}")
+
+        self.mode = mode
+        app.extensions["inference"] = self
+        if mode == "inline":
+            return
+
+        from . import model_sessions
+
+        self.model_names = tuple(model_sessions.model_names())
+
+        cpus = os.cpu_count() or 1
+        self.workers = app.config["INFERENCE_WORKERS"] or cpus
+        # Each process gets its share of the cores so the pool never oversubscribes.
+        self.threads_per_worker = app.config["REMBG_INTRA_OP_THREADS"] or max(1, cpus // self.workers)
+        self.preload = app.config["REMBG_PRELOAD"]
+        # Like the job workers, the pool starts with the first request: spawned
+        # workers re-import __main__, and CLI commands never need it.
+        app.before_request(self.start)
+
+    def start(self):
+        if self._pool is not None:
+            return
+        with self._start_lock:
+            if self._pool is not None:
+                return
+            pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.model_names, self.threads_per_worker, 1),
+            )
+            if self.preload:
+                for _ in range(self.workers):
+                    pool.submit(_warm_worker, self.model_names).add_done_callback(self._worker_warmed)
+            self._pool = pool
+
+    def _worker_warmed(self, future):
+        try:
+            future.result()
+            self.ready = True
+        except Exception as exc:
+            self.error = str(exc)
+
+    def predict_masks(self, images, model_name: str = None) -> list:
+        from . import model_sessions
+
+        images = list(images)
+        if not images:
+            return []
+
+        model_name = model_name or model_sessions.model_name
+        started = time.perf_counter()
+        masks = self._predict(images, model_name)
+        elapsed = time.perf_counter() - started
+        stage_latency.observe(elapsed, "inference")
+        inference_latency.observe(elapsed / len(images), model_name)
+        stats.incr(f"inference.{model_name}.images", len(images))
+        return masks
+
+    def _predict(self, images, model_name: str) -> list:
+        if self.mode == "inline":
+            from . import model_sessions
+            from .gallery.segmentation import predict_masks
+
+            return predict_masks(images, model_sessions.get(model_name))
+
+        self.start()
+        per_task = -(-len(images) // self.workers)
+        blocks = []
+        pending = []
+        try:
+            for start in range(0, len(images), per_task):
+                shm_in, shm_out, layout = _pack(images[start:start + per_task])
+                blocks += [shm_in, shm_out]
+                future = self._pool.submit(_predict_shared, shm_in.name, shm_out.name, layout, model_name)
+                pending.append((shm_out, layout, future))
+
+            masks = []
+            for shm_out, layout, future in pending:
+                future.result()
+                masks.extend(_unpack(shm_out, layout))
+            self.ready = True
+            return masks
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+    def status(self) -> dict:
+        from . import model_sessions
+
+        if self.mode == "inline":
+            return dict(model_sessions.status(), executor="inline")
+        return {
+            "ready": self.ready,
+            "executor": "process",
+            "model": model_sessions.model_name,
+            "tiers": model_sessions.tiers,
+            "workers": self.workers,
+            "threads_per_worker": self.threads_per_worker,
+            "error": self.error,
+        }
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,171 @@
+import json
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+from .metrics import job_latency, profiler
+
+
+class JobQueue:
+    BACKENDS = ("thread", "sqlite")
+
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        self.handlers = {}
+        self._queue = queue.Queue()
+        self._wakeup = threading.Event()
+        self._workers = []
+        self._start_lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config["JOB_BACKEND"]
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown JOB_BACKEND {backend!r}")
+
+        self.app = app
+        self.backend = backend
+        self.poll_seconds = app.config["JOB_POLL_SECONDS"]
+        self.stale_seconds = app.config["JOB_STALE_SECONDS"]
+        self.retry_max_seconds = app.config["JOB_RETRY_MAX_SECONDS"]
+        app.extensions["jobs"] = self
+
+        if app.config["JOB_WORKERS"]:
+            # Started by the first request, so `flask` commands and the
+            # reloader's parent process never run jobs.
+            app.before_request(self.start_workers)
+
+    def start_workers(self):
+        if self._workers:
+            return
+        with self._start_lock:
+            if self._workers:
+                return
+            for i in range(self.app.config["JOB_WORKERS"]):
+                worker = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def handler(self, kind: str):
+        def register(func):
+            self.handlers[kind] = func
+            return func
+        return register
+
+    def submit(self, job):
+        if self.backend == "thread":
+            self._queue.put(job.id)
+        else:
+            self._wakeup.set()
+
+    def depth(self) -> int:
+        from .models import Job
+
+        return Job.query.filter(Job.status == "pending").count()
+
+    def _work(self):
+        from . import db
+
+        delay = 0
+        while True:
+            with self.app.app_context():
+                try:
+                    job_id = self._next()
+                    if job_id is not None:
+                        self._run(job_id)
+                except Exception:
+                    # A locked or unreachable database must not kill the worker.
+                    delay = min(max(delay * 2, self.poll_seconds), self.retry_max_seconds)
+                    self.app.logger.exception("Job worker failed; retrying in %.1fs", delay)
+                    db.session.rollback()
+                else:
+                    delay = 0
+            if delay:
+                time.sleep(delay)
+
+    def _next(self):
+        if self.backend == "thread":
+            job_id = self._queue.get()
+            return job_id if self._mark_running(job_id) else None
+
+        job_id = self._claim()
+        if job_id is None:
+            self._wakeup.wait(self.poll_seconds)
+            self._wakeup.clear()
+        return job_id
+
+    def _claimable(self):
+        from .models import Job
+        from . import db
+
+        cutoff = datetime.utcnow() - timedelta(seconds=self.stale_seconds)
+        return db.or_(
+            Job.status == "pending",
+            db.and_(Job.status == "running", db.func.coalesce(Job.heartbeat_at, Job.started_at) < cutoff),
+        )
+
+    def _claim(self):
+        from .models import Job
+        from . import db
+
+        candidate = (
+            db.session.query(Job.id)
+            .filter(self._claimable())
+            .order_by(Job.created_at)
+            .first()
+        )
+        if candidate is None:
+            db.session.rollback()
+            return None
+
+        now = datetime.utcnow()
+        claimed = (
+            Job.query.filter(Job.id == candidate.id, self._claimable())
+            .update({"status": "running", "started_at": now, "heartbeat_at": now}, synchronize_session=False)
+        )
+        db.session.commit()
+        return candidate.id if claimed else None
+
+    def _mark_running(self, job_id) -> bool:
+        from .models import Job
+        from . import db
+
+        now = datetime.utcnow()
+        claimed = (
+            Job.query.filter(Job.id == job_id, Job.status == "pending")
+            .update({"status": "running", "started_at": now, "heartbeat_at": now}, synchronize_session=False)
+        )
+        db.session.commit()
+        return bool(claimed)
+
+    def _run(self, job_id):
+        from .models import Job
+        from . import db
+
+        job = db.session.get(Job, job_id)
+        kind = job.kind
+        started = time.perf_counter()
+        try:
+            with profiler.track():
+                result = self.handlers[kind](job, json.loads(job.payload))
+        except Exception as exc:
+            self.app.logger.exception("Job %s failed", job_id)
+            db.session.rollback()
+            job = db.session.get(Job, job_id)
+            job.status = "failed"
+            job.error = str(exc)
+        else:
+            job.status = "done"
+            job.done = job.total
+            if isinstance(result, list):
+                job.result = json.dumps([comp.id for comp in result])
+                result = result[0] if result else None
+            job.composition_id = result.id if result is not None else None
+
+        job.finished_at = datetime.utcnow()
+        db.session.commit()
+        job_latency.observe(time.perf_counter() - started, kind, job.status)
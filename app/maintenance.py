@@ -0,0 +1,374 @@
+import hashlib
+import json
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from types import SimpleNamespace
+
+from flask import current_app
+
+from . import db, inference, storage
+from .models import Background, Composition, Image
+from .gallery.derivatives import generate_derivatives
+from .gallery.encoding import save_encoded
+from .gallery.render import compose_with, load_cutout
+from .gallery.segmentation import apply_mask, save_mask, segment
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_worker_app = None
+
+
+def worker_settings(app, workers: int) -> dict:
+    """The parent's settings, minus anything that starts background work in a worker."""
+    settings = {}
+    for key, value in app.config.items():
+        if not key.isupper():
+            continue
+        try:
+            pickle.dumps(value)
+        except Exception:
+            continue
+        settings[key] = value
+
+    cpus = os.cpu_count() or 1
+    settings.update(
+        JOB_WORKERS=0,
+        GC_INTERVAL_SECONDS=0,
+        PROFILER_ENABLED=False,
+        INFERENCE_EXECUTOR="inline",
+        REMBG_PRELOAD=False,
+        # Each process gets its share of the cores so the pool never oversubscribes.
+        REMBG_INTRA_OP_THREADS=app.config["REMBG_INTRA_OP_THREADS"] or max(1, cpus // workers),
+        REMBG_INTER_OP_THREADS=1,
+    )
+    return settings
+
+
+def _init_worker(settings: dict):
+    global _worker_app
+    from config import Config
+    from . import create_app
+
+    _worker_app = create_app(type("MaintenanceConfig", (Config,), settings))
+
+
+def _call(func, args):
+    if _worker_app is None:
+        return func(*args)
+    with _worker_app.app_context():
+        try:
+            return func(*args)
+        finally:
+            db.session.remove()
+
+
+class TaskPool:
+    """Runs task functions in spawned worker processes, or in this one when ``workers`` is 0."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._pool = None
+        if workers:
+            self._pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(worker_settings(current_app, workers),),
+            )
+
+    def map(self, func, items):
+        """Yield ``(args, result, error)`` for each argument tuple as it finishes."""
+        if self._pool is None:
+            for args in items:
+                try:
+                    yield args, _call(func, args), None
+                except Exception as exc:
+                    db.session.rollback()
+                    yield args, None, exc
+            return
+
+        futures = {self._pool.submit(_call, func, args): args for args in items}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except BrokenProcessPool:
+                # A dead worker is not the row's fault; stop before this chunk is committed.
+                raise
+            except Exception as exc:
+                yield futures[future], None, exc
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+
+class Checkpoint:
+    """Progress of one task run, saved after every committed chunk."""
+
+    def __init__(self, task: str, options: dict):
+        digest = hashlib.sha1(json.dumps(options, sort_keys=True).encode()).hexdigest()[:10]
+        folder = current_app.config["MAINTENANCE_CHECKPOINT_FOLDER"]
+        self.path = os.path.join(folder, f"{task}-{digest}.json")
+        self.state = {"task": task, "options": options, "last_id": 0, "done": 0, "skipped": 0, "failed": []}
+
+    def load(self) -> bool:
+        try:
+            with open(self.path) as f:
+                self.state = json.load(f)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.state, f)
+        os.replace(tmp, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def run_task(task: str, options: dict, query, id_column, process_chunk, chunk_size: int = None,
+             workers: int = None, restart: bool = False, report=None) -> dict:
+    """Walk ``query`` in ``id_column`` order one keyset chunk at a time.
+
+    ``process_chunk(pool, ids, state)`` does the work and commits; progress is
+    checkpointed after each chunk, so an interrupted run resumes after the
+    last committed one. Rows in a chunk that was committed but not yet
+    checkpointed are processed again, so chunks must be safe to repeat.
+    """
+    cfg = current_app.config
+    chunk_size = chunk_size or cfg["MAINTENANCE_CHUNK_SIZE"]
+    if workers is None:
+        workers = cfg["MAINTENANCE_WORKERS"] or os.cpu_count() or 1
+
+    checkpoint = Checkpoint(task, options)
+    if restart:
+        checkpoint.clear()
+    elif checkpoint.load() and report:
+        report(checkpoint.state, resumed=True)
+    state = checkpoint.state
+
+    pool = TaskPool(workers)
+    try:
+        while True:
+            ids = [
+                row_id for (row_id,) in
+                query.with_entities(id_column)
+                .filter(id_column > state["last_id"])
+                .order_by(id_column)
+                .limit(chunk_size)
+            ]
+            if not ids:
+                break
+            process_chunk(pool, ids, state)
+            state["last_id"] = ids[-1]
+            checkpoint.save()
+            if report:
+                report(state)
+    finally:
+        pool.shutdown()
+
+    checkpoint.clear()
+    return state
+
+
+def _failed(state: dict, row_id: int, exc: Exception):
+    state["failed"].append(row_id)
+    current_app.logger.error("Row %s failed: %s", row_id, exc)
+
+
+def _rebuild_output(comp: Composition, image, cutout_img=None) -> dict:
+    cfg = current_app.config
+    if cfg["STORE_MASKS_ONLY"]:
+        output_path = ""
+    elif comp.background is None:
+        if image.cutout_path is None:
+            # Segmented while only masks were stored; cut it out now.
+            if cutout_img is None:
+                cutout_img = load_cutout(image)
+            image.cutout_path = save_encoded(cutout_img, cfg["CUTOUT_FOLDER"], "cutout")
+        output_path = image.cutout_path
+    else:
+        if cutout_img is None:
+            cutout_img = load_cutout(image)
+        composed_img = compose_with(cutout_img, comp.background, comp.fit_mode)
+        output_path = save_encoded(composed_img, cfg["COMPOSED_FOLDER"], "composed")
+
+    # A detached stand-in, so the row itself is only updated by the batch commit.
+    rebuilt = SimpleNamespace(
+        id=comp.id, image_id=comp.image_id, background_id=comp.background_id, fit_mode=comp.fit_mode,
+        output_path=output_path, image=image, background=comp.background,
+    )
+    generate_derivatives(rebuilt)
+    return {"id": comp.id, "output_path": output_path, "thumbs_key": rebuilt.thumbs_key}
+
+
+def reprocess_image(image_id: int, model_name: str, reuse, rebuild: bool) -> dict:
+    """Segment one image with ``model_name``, or adopt ``reuse`` = (mask_path, cutout_path)."""
+    cfg = current_app.config
+    img = db.session.get(Image, image_id)
+
+    cutout_img = None
+    if reuse is not None:
+        mask_path, cutout_path = reuse
+    else:
+        with storage.local_path(img.original_path) as original_path:
+            mask = segment(original_path, inference, model_name)
+            if cfg["STORE_MASKS_ONLY"]:
+                mask_path, cutout_path = save_mask(mask, cfg["MASK_FOLDER"], cfg["MASK_FORMAT"]), None
+            else:
+                cutout_img = apply_mask(original_path, mask)
+                mask_path, cutout_path = None, save_encoded(cutout_img, cfg["CUTOUT_FOLDER"], "cutout")
+
+    image = SimpleNamespace(
+        id=img.id, original_path=img.original_path, mask_path=mask_path, cutout_path=cutout_path,
+    )
+    compositions = [_rebuild_output(comp, image, cutout_img) for comp in img.compositions] if rebuild else []
+    return {
+        "image": {"id": image_id, "mask_path": mask_path, "cutout_path": cutout_path, "model_name": model_name},
+        "compositions": compositions,
+    }
+
+
+def reprocess_query(model_name: str, user_id: int = None, from_model: str = None, include_current: bool = False):
+    query = Image.query
+    if user_id is not None:
+        query = query.filter(Image.user_id == user_id)
+    if from_model:
+        query = query.filter(Image.model_name == from_model)
+    elif not include_current:
+        query = query.filter(db.or_(Image.model_name.is_(None), Image.model_name != model_name))
+    return query
+
+
+def reprocess_chunk(pool: TaskPool, ids, state: dict, model_name: str, rebuild: bool = True,
+                    include_current: bool = False):
+    originals = dict(db.session.query(Image.id, Image.original_path).filter(Image.id.in_(ids)))
+
+    # Dedupe copies share one original; segment it once and let the other rows adopt the result.
+    reuse = {}
+    if not include_current:
+        shared = db.session.query(Image.original_path, Image.mask_path, Image.cutout_path).filter(
+            Image.original_path.in_(set(originals.values())),
+            Image.model_name == model_name,
+            Image.id.notin_(ids),
+        )
+        reuse = {path: (mask_path, cutout_path) for path, mask_path, cutout_path in shared}
+
+    first, rest, seen = [], [], set()
+    for image_id in ids:
+        path = originals[image_id]
+        if path in reuse or path in seen:
+            rest.append(image_id)
+        else:
+            seen.add(path)
+            first.append(image_id)
+
+    images, compositions = [], []
+    for batch in (first, rest):
+        tasks = [(image_id, model_name, reuse.get(originals[image_id]), rebuild) for image_id in batch]
+        for args, result, error in pool.map(reprocess_image, tasks):
+            if error is not None:
+                _failed(state, args[0], error)
+                continue
+            image = result["image"]
+            reuse.setdefault(originals[args[0]], (image["mask_path"], image["cutout_path"]))
+            images.append(image)
+            compositions += result["compositions"]
+
+    if images:
+        db.session.execute(db.update(Image), images)
+    if compositions:
+        db.session.execute(db.update(Composition), compositions)
+    db.session.commit()
+    state["done"] += len(images)
+
+
+def rebuild_composition(comp_id: int, thumbs_only: bool):
+    comp = db.session.get(Composition, comp_id)
+    if thumbs_only:
+        generate_derivatives(comp)
+        return {"id": comp.id, "thumbs_key": comp.thumbs_key}
+    cutout_path = comp.image.cutout_path
+    result = _rebuild_output(comp, comp.image)
+    if comp.image.cutout_path != cutout_path:
+        result["image"] = {"id": comp.image_id, "cutout_path": comp.image.cutout_path}
+    return result
+
+
+def rebuild_chunk(pool: TaskPool, ids, state: dict, thumbs_only: bool = False):
+    updates, images = [], []
+    for args, result, error in pool.map(rebuild_composition, [(comp_id, thumbs_only) for comp_id in ids]):
+        if error is not None:
+            _failed(state, args[0], error)
+            continue
+        state["done"] += 1
+        if "image" in result:
+            images.append(result.pop("image"))
+        updates.append(result)
+
+    if images:
+        db.session.execute(db.update(Image), images)
+    if updates:
+        db.session.execute(db.update(Composition), updates)
+    db.session.commit()
+
+
+def hash_file(key: str) -> str:
+    # Hashes the stored file; for downscaled uploads that differs from the
+    # upload-time hash, so an identical re-upload is not matched.
+    digest = hashlib.sha256()
+    with storage.open(key) as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def backfill_query(model):
+    return model.query.filter(model.content_hash.is_(None))
+
+
+def backfill_chunk(pool: TaskPool, ids, state: dict, model=Image):
+    path_column = Image.original_path if model is Image else Background.bg_path
+    rows = db.session.query(model.id, model.user_id, path_column).filter(model.id.in_(ids)).all()
+
+    hashes = {}
+    for (key,), digest, error in pool.map(hash_file, [(key,) for key in {row[2] for row in rows}]):
+        if error is not None:
+            for row in rows:
+                if row[2] == key:
+                    _failed(state, row.id, error)
+            continue
+        hashes[key] = digest
+
+    # Images are unique per (user, hash); a user's later duplicate keeps no hash.
+    taken = set()
+    if model is Image:
+        taken = set(db.session.query(Image.user_id, Image.content_hash).filter(
+            Image.content_hash.in_(set(hashes.values())),
+        ))
+
+    updates = []
+    for row_id, user_id, key in rows:
+        if key not in hashes:
+            continue
+        if model is Image and (user_id, hashes[key]) in taken:
+            state["skipped"] += 1
+            continue
+        taken.add((user_id, hashes[key]))
+        updates.append({"id": row_id, "content_hash": hashes[key]})
+
+    if updates:
+        db.session.execute(db.update(model), updates)
+    db.session.commit()
+    state["done"] += len(updates)
@@ -0,0 +1,73 @@
+import hashlib
+import mimetypes
+import os
+
+from flask import Blueprint, abort, current_app, redirect, send_file
+from werkzeug.security import safe_join
+
+from . import storage
+
+# Everything under these static subfolders is written once under a fresh UUID name.
+MEDIA_PREFIXES = ("uploads/", "compositions/")
+
+media_bp = Blueprint("media", __name__, url_prefix="/media")
+
+
+def media_etag(filename: str, size: int) -> str:
+    return hashlib.sha1(f"{filename}:{size}".encode()).hexdigest()
+
+
+@media_bp.app_template_global()
+def media_url(rel_path: str) -> str:
+    return storage.url(rel_path)
+
+
+@media_bp.route("/<path:filename>")
+def media(filename):
+    if not filename.startswith(MEDIA_PREFIXES):
+        abort(404)
+    if storage.name != "local":
+        # Old links and bookmarks still resolve once media lives in the object store.
+        return redirect(storage.url(filename))
+    path = safe_join(current_app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+
+    cfg = current_app.config
+    etag = media_etag(filename, os.path.getsize(path))
+
+    accel_prefix = cfg["MEDIA_ACCEL_REDIRECT"]
+    if accel_prefix:
+        resp = current_app.response_class(mimetype=mimetypes.guess_type(filename)[0])
+        resp.headers["X-Accel-Redirect"] = f"{accel_prefix.rstrip('/')}/{filename}"
+        resp.set_etag(etag)
+    else:
+        # send_file answers If-None-Match and Range itself and honours USE_X_SENDFILE.
+        resp = send_file(path, conditional=True, etag=etag, max_age=cfg["MEDIA_MAX_AGE"])
+
+    resp.cache_control.no_cache = None
+    resp.cache_control.public = True
+    resp.cache_control.max_age = cfg["MEDIA_MAX_AGE"]
+    resp.cache_control.immutable = True
+    return resp
+
+
+def nginx_conf(static_root: str, max_age: int, accel_prefix: str = None) -> str:
+    static_root = static_root.rstrip("/")
+    cache_header = f'add_header Cache-Control "public, max-age={max_age}, immutable";'
+    blocks = []
+    for prefix in MEDIA_PREFIXES:
+        if accel_prefix:
+            location = f"location {accel_prefix.rstrip('/')}/{prefix} {{\n    internal;\n"
+        else:
+            location = f"location /media/{prefix} {{\n"
+        blocks.append(
+            location
+            + f"    alias {static_root}/{prefix};\n"
+            + "    sendfile on;\n"
+            + "    tcp_nopush on;\n"
+            + "    etag on;\n"
+            + f"    {cache_header}\n"
+            + "}\n"
+        )
+    return "\n".join(blocks)
@@ -0,0 +1,291 @@
+import hmac
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import Response, abort, current_app, g, jsonify, request
+from sqlalchemy import event
+
+from .cache import cache_stats
+from .stats import stats
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 250)
+
+histograms = {}
+
+
+def _labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+        histograms[name] = self
+
+    def observe(self, value: float, *label_values):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self) -> list:
+        """``(label values, cumulative bucket counts, sum, count)`` for each label set."""
+        with self._lock:
+            series = sorted((key, list(counts), total, count) for key, (counts, total, count) in self._series.items())
+        samples = []
+        for label_values, counts, total, count in series:
+            cumulative, running = [], 0
+            for bucket_count in counts:
+                running += bucket_count
+                cumulative.append(running)
+            samples.append((label_values, cumulative, total, count))
+        return samples
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, cumulative, total, count in self.samples():
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), cumulative):
+                labels = _labels(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+            labels = _labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total:.6f}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+request_latency = Histogram(
+    "http_request_duration_seconds", "Request latency by endpoint.", LATENCY_BUCKETS,
+    ("endpoint", "method", "status"),
+)
+request_queries = Histogram(
+    "http_request_sql_queries", "SQL statements executed per request.", QUERY_BUCKETS, ("endpoint",),
+)
+stage_latency = Histogram(
+    "pipeline_stage_duration_seconds", "Time spent in each image pipeline stage.", LATENCY_BUCKETS, ("stage",),
+)
+job_latency = Histogram(
+    "job_duration_seconds", "Background job run time.", LATENCY_BUCKETS, ("kind", "status"),
+)
+inference_latency = Histogram(
+    "inference_image_duration_seconds", "Segmentation time per image by model.", LATENCY_BUCKETS, ("model",),
+)
+
+
+@contextmanager
+def stage(name: str):
+    """Time a pipeline stage; works as a ``with`` block or a decorator."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_latency.observe(time.perf_counter() - started, name)
+
+
+class SamplingProfiler:
+    """Samples the stacks of threads serving requests or jobs into folded-stack counts."""
+
+    def __init__(self):
+        self.running = False
+        self.interval = 0.01
+        self.max_depth = 64
+        self.samples = Counter()
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def start(self, interval: float, max_depth: int):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.running = True
+        threading.Thread(target=self._sample, name="sampling-profiler", daemon=True).start()
+
+    def attach(self):
+        self._active.add(threading.get_ident())
+
+    def detach(self):
+        self._active.discard(threading.get_ident())
+
+    @contextmanager
+    def track(self):
+        if not self.running:
+            yield
+            return
+        self.attach()
+        try:
+            yield
+        finally:
+            self.detach()
+
+    def _sample(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            stacks = []
+            for ident in list(self._active):
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                if stack:
+                    stacks.append(";".join(reversed(stack)))
+            del frames
+            if stacks:
+                with self._lock:
+                    self.samples.update(stacks)
+
+    def folded(self, reset: bool = False) -> str:
+        with self._lock:
+            samples = self.samples if reset else Counter(self.samples)
+            if reset:
+                self.samples = Counter()
+        return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+
+profiler = SamplingProfiler()
+_local = threading.local()
+
+
+def _count_query(*args):
+    _local.queries = getattr(_local, "queries", 0) + 1
+
+
+def _series() -> list:
+    """Everything /metrics exports besides histograms, as ``(name, help, type, labels, samples)``."""
+    from . import db, inference, model_sessions
+    from .models import Job
+
+    job_counts = dict(
+        db.session.query(Job.status, db.func.count(Job.id))
+        .filter(Job.status.in_(("pending", "running")))
+        .group_by(Job.status)
+    )
+    caches = sorted(cache_stats().items())
+    return [
+        ("job_queue_jobs", "Jobs waiting or running.", "gauge", ("status",),
+         [((status,), job_counts.get(status, 0)) for status in ("pending", "running")]),
+        ("model_sessions_loaded", "Segmentation sessions loaded in this process.", "gauge", (),
+         [((), len(model_sessions.sessions))]),
+        ("model_session_load_seconds", "Time taken to load each model session.", "gauge", ("model",),
+         [((model,), round(seconds, 3)) for model, seconds in sorted(model_sessions.load_seconds.items())]),
+        ("inference_workers", "Inference worker processes.", "gauge", (), [((), inference.workers)]),
+        ("inference_ready", "Whether segmentation can serve requests.", "gauge", (),
+         [((), int(inference.status()["ready"]))]),
+        ("cache_hits_total", "Cache hits.", "counter", ("cache",), [((name,), s["hits"]) for name, s in caches]),
+        ("cache_misses_total", "Cache misses.", "counter", ("cache",), [((name,), s["misses"]) for name, s in caches]),
+        ("cache_hit_ratio", "Share of lookups served from the cache.", "gauge", ("cache",),
+         [((name,), round(s["hit_rate"], 4)) for name, s in caches]),
+        ("cache_items", "Entries held by each cache.", "gauge", ("cache",), [((name,), s["items"]) for name, s in caches]),
+        ("cache_bytes", "Bytes held by each cache.", "gauge", ("cache",), [((name,), s["bytes"]) for name, s in caches]),
+        ("app_events_total", "Application event counters.", "counter", ("event",),
+         [((name,), value) for name, value in sorted(stats.snapshot().items())]),
+    ]
+
+
+def render_metrics() -> str:
+    lines = []
+    for histogram in histograms.values():
+        lines += histogram.render()
+    for name, help_text, kind, labels, samples in _series():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for label_values, value in samples:
+            lines.append(f"{name}{_labels(labels, label_values)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def metrics_snapshot() -> dict:
+    """The same series as render_metrics(), keyed by metric name, for the JSON /stats view."""
+    snapshot = {}
+    for histogram in histograms.values():
+        bounds = [str(bound) for bound in histogram.buckets + ("+Inf",)]
+        snapshot[histogram.name] = [
+            {"labels": dict(zip(histogram.labels, label_values)), "buckets": dict(zip(bounds, cumulative)),
+             "sum": total, "count": count}
+            for label_values, cumulative, total, count in histogram.samples()
+        ]
+    for name, _, _, labels, samples in _series():
+        snapshot[name] = [{"labels": dict(zip(labels, label_values)), "value": value} for label_values, value in samples]
+    return snapshot
+
+
+def restricted(view):
+    """Serve ``view`` only to METRICS_ALLOW_IPS or a bearer of METRICS_TOKEN."""
+    @wraps(view)
+    def guarded(*args, **kwargs):
+        cfg = current_app.config
+        if request.remote_addr not in cfg["METRICS_ALLOW_IPS"]:
+            scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+            expected = cfg["METRICS_TOKEN"]
+            if not (expected and scheme.lower() == "bearer"
+                    and hmac.compare_digest(token.strip().encode(), expected.encode())):
+                abort(403)
+        return view(*args, **kwargs)
+    return guarded
+
+
+def init_metrics(app, engine):
+    event.listen(engine, "before_cursor_execute", _count_query)
+
+    @app.before_request
+    def start_timer():
+        g.metrics_started = time.perf_counter()
+        _local.queries = 0
+        if profiler.running:
+            profiler.attach()
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            endpoint = request.endpoint or "unmatched"
+            request_latency.observe(time.perf_counter() - started, endpoint, request.method, response.status_code)
+            request_queries.observe(getattr(_local, "queries", 0), endpoint)
+        return response
+
+    @app.teardown_request
+    def stop_profile(exc):
+        if profiler.running:
+            profiler.detach()
+
+    @app.route("/metrics")
+    @restricted
+    def metrics():
+        return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+    @app.route("/stats")
+    @restricted
+    def stats_view():
+        return jsonify(metrics_snapshot())
+
+    @app.route("/metrics/profile")
+    @restricted
+    def metrics_profile():
+        if not profiler.running:
+            abort(404)
+        folded = profiler.folded(reset=request.args.get("reset") == "1")
+        return Response(folded, mimetype="text/plain")
+
+    if app.config["PROFILER_ENABLED"] and not profiler.running:
+        profiler.start(app.config["PROFILER_INTERVAL"], app.config["PROFILER_MAX_DEPTH"])
@@ -0,0 +1,54 @@
+from sqlalchemy import inspect, text
+
+from . import db
+
+ADDED_COLUMNS = [
+    ("images", "content_hash", "VARCHAR(64)", None),
+    ("images", "mask_path", "VARCHAR(255)", None),
+    ("images", "model_name", "VARCHAR(64)", None),
+    ("images", "last_used_at", "DATETIME", None),
+    ("backgrounds", "content_hash", "VARCHAR(64)", None),
+    ("backgrounds", "last_used_at", "DATETIME", None),
+    ("compositions", "fit_mode", "VARCHAR(16)", None),
+    ("compositions", "thumbs_key", "VARCHAR(12)", None),
+    (
+        "compositions", "like_count", "INTEGER NOT NULL DEFAULT 0",
+        "UPDATE compositions SET like_count = "
+        "(SELECT COUNT(*) FROM user_likes WHERE user_likes.composition_id = compositions.id)",
+    ),
+    (
+        "compositions", "comment_count", "INTEGER NOT NULL DEFAULT 0",
+        "UPDATE compositions SET comment_count = "
+        "(SELECT COUNT(*) FROM comments WHERE comments.composition_id = compositions.id)",
+    ),
+    ("jobs", "total", "INTEGER NOT NULL DEFAULT 1", None),
+    ("jobs", "done", "INTEGER NOT NULL DEFAULT 0", None),
+    ("jobs", "result", "TEXT", None),
+    ("jobs", "heartbeat_at", "DATETIME", None),
+]
+
+
+def upgrade_schema() -> list:
+    inspector = inspect(db.engine)
+    applied = []
+
+    with db.engine.begin() as conn:
+        for table, column, ddl, backfill in ADDED_COLUMNS:
+            existing = {c["name"] for c in inspector.get_columns(table)}
+            if column not in existing:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+                if backfill:
+                    conn.execute(text(backfill))
+                applied.append(f"add column {table}.{column}")
+
+        for table in db.metadata.tables.values():
+            existing = {i["name"] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(conn)
+                    applied.append(f"create index {index.name}")
+
+        if applied and conn.dialect.name == "sqlite":
+            conn.execute(text("ANALYZE"))
+
+    return applied
@@ -0,0 +1,100 @@
+import threading
+import time
+
+import onnxruntime as ort
+from PIL import Image as PILImage
+from rembg import new_session, remove
+
+
+class ModelSessionManager:
+    def __init__(self, app=None):
+        self.model_name = None
+        self.tiers = {}
+        self.sessions = {}
+        self.errors = {}
+        self.load_seconds = {}
+        self.warmup_seconds = {}
+        self._intra_op_threads = 0
+        self._inter_op_threads = 0
+        self._warmup = True
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.model_name = app.config["REMBG_MODEL"]
+        self.tiers = dict(app.config["MODEL_TIERS"])
+        self._intra_op_threads = app.config["REMBG_INTRA_OP_THREADS"]
+        self._inter_op_threads = app.config["REMBG_INTER_OP_THREADS"]
+        self._warmup = app.config["REMBG_WARMUP"]
+        app.extensions["model_sessions"] = self
+
+        # Process workers load their own sessions; the web process needs none.
+        if app.config["REMBG_PRELOAD"] and app.config["INFERENCE_EXECUTOR"] == "inline":
+            for model_name in self.model_names():
+                try:
+                    self.load(model_name)
+                except Exception as exc:
+                    app.logger.exception("Loading model %s failed", model_name)
+                    self.errors[model_name] = str(exc)
+
+    def model_names(self) -> list:
+        names = [self.model_name]
+        names += [name for name in self.tiers.values() if name not in names]
+        return names
+
+    def model_for(self, tier: str = None) -> str:
+        return self.tiers.get(tier, self.model_name)
+
+    def _session_options(self) -> ort.SessionOptions:
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = self._intra_op_threads
+        opts.inter_op_num_threads = self._inter_op_threads
+        return opts
+
+    def load(self, model_name: str = None):
+        model_name = model_name or self.model_name
+        with self._lock:
+            if model_name in self.sessions:
+                return self.sessions[model_name]
+
+            started = time.perf_counter()
+            session = new_session(model_name, sess_opts=self._session_options())
+            self.load_seconds[model_name] = time.perf_counter() - started
+
+            if self._warmup:
+                started = time.perf_counter()
+                remove(PILImage.new("RGB", (64, 64), (127, 127, 127)), session=session)
+                self.warmup_seconds[model_name] = time.perf_counter() - started
+
+            self.sessions[model_name] = session
+            self.errors.pop(model_name, None)
+            return session
+
+    def get(self, model_name: str = None):
+        session = self.sessions.get(model_name or self.model_name)
+        if session is not None:
+            return session
+        return self.load(model_name)
+
+    @property
+    def ready(self) -> bool:
+        return self.model_name in self.sessions
+
+    def status(self) -> dict:
+        return {
+            "ready": self.ready,
+            "model": self.model_name,
+            "error": self.errors.get(self.model_name),
+            "tiers": self.tiers,
+            "models": {
+                name: {
+                    "loaded": name in self.sessions,
+                    "load_seconds": self.load_seconds.get(name),
+                    "warmup_seconds": self.warmup_seconds.get(name),
+                    "error": self.errors.get(name),
+                }
+                for name in self.model_names()
+            },
+        }
@@ -1,4 +1,5 @@
 from datetime import datetime
+from uuid import uuid4
 from werkzeug.security import generate_password_hash, check_password_hash
 from . import db
 
@@ -6,6 +7,7 @@ user_likes = db.Table(
     "user_likes",
     db.Column("user_id", db.Integer, db.ForeignKey("users.id"), primary_key=True),
     db.Column("composition_id", db.Integer, db.ForeignKey("compositions.id"), primary_key=True),
+    db.Index("ix_user_likes_composition_id", "composition_id"),
 )
 
 
@@ -49,10 +51,20 @@ class Image(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
     original_path = db.Column(db.String(255), nullable=False)
     cutout_path = db.Column(db.String(255))
+    mask_path = db.Column(db.String(255))
+    content_hash = db.Column(db.String(64))
+    model_name = db.Column(db.String(64))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Refreshed whenever dedupe reuses the row, so the collector leaves it alone.
+    last_used_at = db.Column(db.DateTime)
 
     compositions = db.relationship("Composition", backref="image", lazy=True)
 
+    __table_args__ = (
+        db.Index("ix_images_user_content_hash", "user_id", "content_hash", unique=True),
+        db.Index("ix_images_content_hash", "content_hash"),
+    )
+
 
 class Background(db.Model):
     __tablename__ = "backgrounds"
@@ -60,10 +72,18 @@ class Background(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     bg_path = db.Column(db.String(255), nullable=False)
+    content_hash = db.Column(db.String(64))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # Refreshed whenever dedupe reuses the row, so the collector leaves it alone.
+    last_used_at = db.Column(db.DateTime)
 
     compositions = db.relationship("Composition", backref="background", lazy=True)
 
+    __table_args__ = (
+        db.Index("ix_backgrounds_user_id", "user_id"),
+        db.Index("ix_backgrounds_user_content_hash", "user_id", "content_hash"),
+    )
+
 
 class Composition(db.Model):
     __tablename__ = "compositions"
@@ -72,6 +92,11 @@ class Composition(db.Model):
     image_id = db.Column(db.Integer, db.ForeignKey("images.id"), nullable=False)
     background_id = db.Column(db.Integer, db.ForeignKey("backgrounds.id"))
     output_path = db.Column(db.String(255), nullable=False)
+    fit_mode = db.Column(db.String(16))
+    # derivative_key of the thumbnails known to be in storage.
+    thumbs_key = db.Column(db.String(12))
+    like_count = db.Column(db.Integer, nullable=False, default=0)
+    comment_count = db.Column(db.Integer, nullable=False, default=0)
     is_public = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
@@ -83,6 +108,12 @@ class Composition(db.Model):
         back_populates="liked_compositions",
     )
 
+    __table_args__ = (
+        db.Index("ix_compositions_public_created", "is_public", "created_at", "id"),
+        db.Index("ix_compositions_created", "created_at", "id"),
+        db.Index("ix_compositions_image_id", "image_id"),
+    )
+
 
 class Comment(db.Model):
     __tablename__ = "comments"
@@ -94,3 +125,42 @@ class Comment(db.Model):
     is_edited = db.Column(db.Boolean, default=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index("ix_comments_composition_created", "composition_id", "created_at"),
+    )
+
+
+class Job(db.Model):
+    __tablename__ = "jobs"
+
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid4().hex)
+    kind = db.Column(db.String(32), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    status = db.Column(db.String(16), nullable=False, default="pending", index=True)
+    payload = db.Column(db.Text, nullable=False)
+    composition_id = db.Column(db.Integer, db.ForeignKey("compositions.id"))
+    error = db.Column(db.Text)
+    total = db.Column(db.Integer, nullable=False, default=1)
+    done = db.Column(db.Integer, nullable=False, default=0)
+    result = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    # Refreshed as a job reports progress; a stale heartbeat lets another worker reclaim it.
+    heartbeat_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    composition = db.relationship("Composition")
+
+
+class ApiToken(db.Model):
+    __tablename__ = "api_tokens"
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    name = db.Column(db.String(64))
+    # Only a SHA-256 of the token is stored; the token itself is shown once when created.
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    user = db.relationship("User")
@@ -0,0 +1,15 @@
+from sqlalchemy import event
+
+
+def configure_sqlite(app, engine):
+    if engine.dialect.name != "sqlite":
+        return
+
+    pragmas = app.config["SQLITE_PRAGMAS"]
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_conn, _record):
+        cursor = dbapi_conn.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
@@ -0,0 +1,268 @@
+import mimetypes
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager, suppress
+from uuid import uuid4
+
+from flask import url_for
+
+from .cache import LRUCache
+
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class LocalStorage:
+    """Keys are paths below the static folder, served by the /media route."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split("/"))
+
+    def put_file(self, key: str, local_path: str):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.move(local_path, path)
+
+    @contextmanager
+    def writer(self, key: str):
+        # Written beside the target and renamed over it, so concurrent writers
+        # of one key never interleave and readers never see a partial file.
+        path = self.path(key)
+        folder, name = os.path.split(path)
+        os.makedirs(folder, exist_ok=True)
+        tmp_path = os.path.join(folder, f".{name}.{uuid4().hex}.part")
+        try:
+            with open(tmp_path, "xb") as out:
+                yield out
+            os.replace(tmp_path, path)
+        except BaseException:
+            with suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
+
+    def open(self, key: str):
+        return open(self.path(key), "rb")
+
+    @contextmanager
+    def local_path(self, key: str):
+        yield self.path(key)
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self.path(key))
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix: str):
+        """Yield ``(key, size, mtime)`` for every key starting with ``prefix``."""
+        folder = prefix.rpartition("/")[0]
+        for key, size, mtime in self._walk(folder):
+            if key.startswith(prefix):
+                yield key, size, mtime
+
+    def _walk(self, folder: str):
+        try:
+            entries = os.scandir(self.path(folder) if folder else self.root)
+        except FileNotFoundError:
+            return
+        with entries:
+            for entry in entries:
+                key = f"{folder}/{entry.name}" if folder else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    yield from self._walk(key)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    yield key, stat.st_size, stat.st_mtime
+
+    def url(self, key: str) -> str:
+        return url_for("media.media", filename=key)
+
+
+class S3Storage:
+    """Any S3-compatible object store; point S3_ENDPOINT_URL at MinIO or moto_server to run locally."""
+
+    def __init__(self, bucket: str, endpoint_url: str = None, region: str = None, public_url: str = None,
+                 url_expires: int = 3600, max_pool_connections: int = 20,
+                 multipart_threshold: int = 8 * 1024 * 1024, multipart_chunksize: int = 8 * 1024 * 1024,
+                 cache_control: str = None, known_keys: int = 10000):
+        try:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config as BotoConfig
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND 's3' needs the boto3 package installed")
+
+        self.bucket = bucket
+        self.public_url = public_url.rstrip("/") if public_url else None
+        self.url_expires = url_expires
+        self.multipart_threshold = multipart_threshold
+        self.cache_control = cache_control
+        self._client_error = ClientError
+        # One client shares a pool of keep-alive connections across request and job threads.
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url or None,
+            region_name=region or None,
+            config=BotoConfig(
+                max_pool_connections=max_pool_connections,
+                retries={"max_attempts": 3, "mode": "standard"},
+                s3={"addressing_style": "path"} if endpoint_url else None,
+            ),
+        )
+        self.transfer = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max(1, max_pool_connections // 2),
+        )
+        # Keys are never rewritten in place, so a key seen once stays valid until deleted here.
+        self._known = LRUCache("s3_known_keys", max_items=known_keys)
+        # A URL is reused for half its lifetime, so pages rendered in that window
+        # share it and browsers can cache the object.
+        self._urls = LRUCache("s3_presigned_urls", max_items=known_keys, ttl=url_expires / 2)
+
+    def _extra_args(self, key: str) -> dict:
+        args = {"ContentType": mimetypes.guess_type(key)[0] or "application/octet-stream"}
+        if self.cache_control:
+            args["CacheControl"] = self.cache_control
+        return args
+
+    def _remember(self, key: str):
+        self._known.set(key, True)
+
+    def upload(self, key: str, fileobj):
+        # upload_fileobj switches to a multipart upload past the threshold and
+        # only holds one chunk per part in memory.
+        self.client.upload_fileobj(fileobj, self.bucket, key, ExtraArgs=self._extra_args(key), Config=self.transfer)
+        self._remember(key)
+
+    def put_file(self, key: str, local_path: str):
+        with open(local_path, "rb") as f:
+            self.upload(key, f)
+        os.remove(local_path)
+
+    @contextmanager
+    def writer(self, key: str):
+        with tempfile.SpooledTemporaryFile(max_size=self.multipart_threshold) as buf:
+            yield buf
+            buf.seek(0)
+            self.upload(key, buf)
+
+    def open(self, key: str):
+        # Pillow and numpy need to seek, so the body is spooled rather than read as a stream.
+        buf = tempfile.SpooledTemporaryFile(max_size=self.multipart_threshold)
+        try:
+            self.client.download_fileobj(self.bucket, key, buf, Config=self.transfer)
+        except self._client_error as exc:
+            buf.close()
+            raise FileNotFoundError(key) from exc
+        buf.seek(0)
+        return buf
+
+    @contextmanager
+    def local_path(self, key: str):
+        fd, path = tempfile.mkstemp(suffix=os.path.splitext(key)[1])
+        try:
+            with os.fdopen(fd, "wb") as out, self.open(key) as src:
+                shutil.copyfileobj(src, out, COPY_CHUNK_SIZE)
+            yield path
+        finally:
+            os.remove(path)
+
+    def exists(self, key: str) -> bool:
+        if self._known.get(key):
+            return True
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except self._client_error as exc:
+            if exc.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        self._remember(key)
+        return True
+
+    def delete(self, key: str):
+        self._known.pop(key)
+        self._urls.pop(key)
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def list(self, prefix: str):
+        """Yield ``(key, size, mtime)`` for every key starting with ``prefix``."""
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", ()):
+                yield obj["Key"], obj["Size"], obj["LastModified"].timestamp()
+
+    def url(self, key: str) -> str:
+        if self.public_url:
+            return f"{self.public_url}/{key}"
+        url = self._urls.get(key)
+        if url is None:
+            url = self.client.generate_presigned_url(
+                "get_object", Params={"Bucket": self.bucket, "Key": key}, ExpiresIn=self.url_expires,
+            )
+            self._urls.set(key, url)
+        return url
+
+
+class Storage:
+    BACKENDS = ("local", "s3")
+
+    def __init__(self, app=None):
+        self.backend = None
+        self.name = None
+        self.static_root = None
+        self.tmp_folder = None
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        cfg = app.config
+        name = cfg["STORAGE_BACKEND"]
+        if name not in self.BACKENDS:
+            raise ValueError(f"Unknown STORAGE_BACKEND {name!r}")
+
+        self.name = name
+        self.static_root = app.static_folder
+        self.tmp_folder = cfg["UPLOAD_TMP_FOLDER"]
+        os.makedirs(self.tmp_folder, exist_ok=True)
+
+        if name == "local":
+            self.backend = LocalStorage(self.static_root)
+        else:
+            self.backend = S3Storage(
+                cfg["S3_BUCKET"],
+                endpoint_url=cfg["S3_ENDPOINT_URL"],
+                region=cfg["S3_REGION"],
+                public_url=cfg["S3_PUBLIC_URL"],
+                url_expires=cfg["S3_URL_EXPIRES"],
+                max_pool_connections=cfg["S3_MAX_POOL_CONNECTIONS"],
+                multipart_threshold=cfg["S3_MULTIPART_THRESHOLD"],
+                multipart_chunksize=cfg["S3_MULTIPART_CHUNKSIZE"],
+                cache_control=f"public, max-age={cfg['MEDIA_MAX_AGE']}, immutable",
+                known_keys=cfg["S3_KNOWN_KEYS"],
+            )
+        app.extensions["storage"] = self
+
+    def key_for(self, folder: str, filename: str) -> str:
+        """Map one of the *_FOLDER settings and a file name to a storage key."""
+        return f"{self.folder_key(folder)}/{filename}"
+
+    def folder_key(self, folder: str) -> str:
+        return os.path.relpath(folder, self.static_root).replace("\\", "/")
+
+    def temp_file(self, suffix: str = ""):
+        fd, path = tempfile.mkstemp(suffix=suffix, dir=self.tmp_folder)
+        return os.fdopen(fd, "wb"), path
+
+    def __getattr__(self, name):
+        if self.backend is None:
+            raise AttributeError(name)
+        return getattr(self.backend, name)
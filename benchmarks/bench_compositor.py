@@ -0,0 +1,76 @@
+"""Compare the NumPy compositor against the Pillow paths it replaced.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_compositor --size 2000x1500 --repeat 20
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image as PILImage
+
+from app.gallery.compositor import background_cache, compose
+
+
+def pillow_upload_path(cutout_img, background_path):
+    bg_img = PILImage.open(background_path).convert("RGBA")
+    bg_img = bg_img.resize(cutout_img.size, PILImage.LANCZOS)
+    return PILImage.alpha_composite(bg_img, cutout_img)
+
+
+def pillow_recompose_path(cutout_img, background_path):
+    bg_img = PILImage.open(background_path).convert("RGBA")
+    bg_img = bg_img.resize(cutout_img.size, PILImage.LANCZOS)
+    merged = PILImage.new("RGBA", cutout_img.size)
+    merged.paste(bg_img, (0, 0))
+    merged.alpha_composite(cutout_img)
+    return merged
+
+
+def timed(func, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="2000x1500")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.split("x"))
+    rng = np.random.default_rng(0)
+    cutout_img = PILImage.fromarray(rng.integers(0, 256, (height, width, 4), dtype=np.uint8))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        background_path = os.path.join(tmp, "background.jpg")
+        PILImage.fromarray(rng.integers(0, 256, (1080, 1920, 3), dtype=np.uint8)).save(background_path)
+
+        def cold():
+            background_cache.clear()
+            compose(cutout_img, 1, background_path)
+
+        def warm():
+            compose(cutout_img, 1, background_path)
+
+        results = [
+            ("pillow upload path", timed(lambda: pillow_upload_path(cutout_img, background_path), args.repeat)),
+            ("pillow recompose path", timed(lambda: pillow_recompose_path(cutout_img, background_path), args.repeat)),
+            ("compositor, cold cache", timed(cold, args.repeat)),
+            ("compositor, warm cache", timed(warm, args.repeat)),
+        ]
+
+    print(f"{width}x{height}, best of {args.repeat}")
+    for name, seconds in results:
+        print(f"  {name:<24} {seconds * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
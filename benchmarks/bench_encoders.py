@@ -0,0 +1,91 @@
+"""Compare output encoders on the images already under app/static/uploads.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_encoders --limit 50 --quality 85
+"""
+import argparse
+import io
+import os
+import time
+
+from PIL import Image as PILImage
+
+from app.gallery.encoding import FORMATS, available, save_options
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".avif"}
+SKIP_FOLDERS = {"thumbs", "masks"}
+
+
+def candidates(has_alpha: bool, quality: int):
+    if has_alpha:
+        yield "png level 1", "png", {"png_compress_level": 1}
+        yield "png level 6", "png", {"png_compress_level": 6}
+        yield "png level 9", "png", {"png_compress_level": 9}
+        yield "webp lossless", "webp", {"lossless": True}
+        yield f"avif q{quality}", "avif", {"quality": quality}
+    else:
+        yield "png level 6", "png", {"png_compress_level": 6}
+        yield f"webp q{quality}", "webp", {"quality": quality}
+        yield f"jpeg q{quality}", "jpeg", {"quality": quality}
+        yield f"avif q{quality}", "avif", {"quality": quality}
+
+
+def iter_images(root: str, limit: int):
+    seen = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d not in SKIP_FOLDERS]
+        for name in filenames:
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                yield os.path.join(dirpath, name)
+                seen += 1
+                if limit and seen >= limit:
+                    return
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", default=os.path.join("app", "static", "uploads"))
+    parser.add_argument("--limit", type=int, default=0)
+    parser.add_argument("--quality", type=int, default=85)
+    args = parser.parse_args()
+
+    totals = {}
+    counts = {"alpha": 0, "opaque": 0}
+    for path in iter_images(args.root, args.limit):
+        with PILImage.open(path) as img:
+            img.load()
+            has_alpha = img.mode in ("RGBA", "LA", "PA") and img.getchannel("A").getextrema()[0] < 255
+            img = img.convert("RGBA" if has_alpha else "RGB")
+        group = "alpha" if has_alpha else "opaque"
+        counts[group] += 1
+
+        for label, fmt, kwargs in candidates(has_alpha, args.quality):
+            if not available(fmt):
+                continue
+            pil_format, _ = FORMATS[fmt]
+            buf = io.BytesIO()
+            started = time.perf_counter()
+            img.save(buf, pil_format, **save_options(fmt, **kwargs))
+            elapsed = time.perf_counter() - started
+
+            entry = totals.setdefault((group, label), [0, 0.0, 0])
+            entry[0] += buf.tell()
+            entry[1] += elapsed
+            entry[2] += 1
+
+    for group in ("alpha", "opaque"):
+        if not counts[group]:
+            continue
+        rows = [(label, *entry) for (g, label), entry in totals.items() if g == group]
+        baseline = next(size for label, size, _, _ in rows if label == "png level 6")
+        print(f"{group} images: {counts[group]}")
+        for label, size, seconds, n in rows:
+            print(
+                f"  {label:<16} {size / 1024:10.1f} KiB  {size / baseline:6.1%} of png  "
+                f"{seconds / n * 1000:8.1f} ms/image"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""Time each stage of the upload and recompose pipelines, and the gallery page.
+
+Everything runs against a throwaway SQLite database and upload folder; the
+default stub model needs no GPU, network or model download. Run from the
+repository root:
+
+    python -m benchmarks.bench_pipeline --output bench.json
+    python -m benchmarks.bench_pipeline --baseline benchmarks/baseline.json --max-slowdown 1.25
+    python -m benchmarks.bench_pipeline --model real --repeat 5
+
+With --baseline the run exits non-zero when any stage's median is more than
+--max-slowdown times its baseline median. benchmarks/baseline.json is a
+stub-model run at the default settings; its "environment" block records the
+machine. Timings only compare on similar hardware, so refresh it with
+--output when the reference machine or an intended speed change moves it.
+"""
+import argparse
+import functools
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from importlib import metadata
+from uuid import uuid4
+
+import numpy as np
+from PIL import Image as PILImage, ImageDraw
+from werkzeug.datastructures import FileStorage
+
+import config
+from app import create_app, db, inference, model_sessions, storage
+from app.gallery import segmentation, utils
+from app.gallery.fragments import gallery_cache
+from app.models import Composition, Image, User
+
+GALLERY_SIZES = (100, 1000, 10000)
+# Stages faster than this are mostly noise and are left out of the baseline check.
+MIN_COMPARE_MS = 1.0
+
+
+class StubSession:
+    """Stands in for a rembg session: an ellipse mask with the model's call shape."""
+
+    model_name = "stub"
+
+    def predict(self, img, *args, **kwargs):
+        mask = PILImage.new("L", img.size, 0)
+        width, height = img.size
+        ImageDraw.Draw(mask).ellipse((width // 4, height // 4, 3 * width // 4, 3 * height // 4), fill=255)
+        return [mask]
+
+
+class StageTimer:
+    def __init__(self):
+        self.current = None
+
+    def wrap(self, owner, name: str, stage: str):
+        original = getattr(owner, name)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            if self.current is None:
+                return original(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.current[stage] += time.perf_counter() - started
+
+        setattr(owner, name, timed)
+
+    def run(self, func):
+        self.current = defaultdict(float)
+        started = time.perf_counter()
+        try:
+            result = func()
+        finally:
+            stages, self.current = self.current, None
+        stages["total"] = time.perf_counter() - started
+        stages["other"] = stages["total"] - sum(v for k, v in stages.items() if k != "total")
+        return result, dict(stages)
+
+
+def instrument(timer: StageTimer):
+    timer.wrap(utils, "save_upload", "save")
+    timer.wrap(segmentation, "open_proxy", "decode")
+    timer.wrap(segmentation, "oriented_size", "decode")
+    timer.wrap(segmentation, "open_subject", "decode")
+    timer.wrap(utils, "load_cutout", "decode")
+    timer.wrap(inference, "predict_masks", "inference")
+    timer.wrap(segmentation, "upsample_mask", "mask")
+    timer.wrap(utils, "save_encoded", "encode")
+    timer.wrap(utils, "save_mask", "encode")
+    timer.wrap(utils, "compose_with", "composite")
+    timer.wrap(db.session, "commit", "commit")
+    timer.wrap(utils, "refresh_derivatives", "thumbnails")
+
+
+def bench_config(workdir: str, model: str):
+    uploads = os.path.join(config.Config.UPLOAD_FOLDER, f"bench-{uuid4().hex}")
+    database_url = "sqlite:///" + os.path.join(workdir, "bench.db").replace("\\", "/")
+
+    class BenchConfig(config.Config):
+        SQLALCHEMY_DATABASE_URI = database_url
+        SQLALCHEMY_ENGINE_OPTIONS = config.engine_options(database_url)
+        UPLOAD_FOLDER = uploads
+        ORIGINAL_FOLDER = os.path.join(uploads, "original")
+        CUTOUT_FOLDER = os.path.join(uploads, "cutout")
+        BACKGROUND_FOLDER = os.path.join(uploads, "backgrounds")
+        COMPOSED_FOLDER = os.path.join(uploads, "composed")
+        MASK_FOLDER = os.path.join(uploads, "masks")
+        THUMB_FOLDER = os.path.join(uploads, "thumbs")
+        UPLOAD_TMP_FOLDER = os.path.join(workdir, "tmp")
+        STORAGE_BACKEND = "local"
+        INFERENCE_EXECUTOR = "inline"
+        JOB_WORKERS = 0
+        GC_INTERVAL_SECONDS = 0
+        REMBG_PRELOAD = model == "real"
+
+    return BenchConfig
+
+
+def synthetic_photo(size, seed: int, fmt: str = "JPEG") -> FileStorage:
+    width, height = size
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    pixels = (base + rng.integers(-20, 20, base.shape)).clip(0, 255).astype(np.uint8)
+
+    buf = io.BytesIO()
+    PILImage.fromarray(pixels).save(buf, fmt, quality=90)
+    buf.seek(0)
+    return FileStorage(stream=buf, filename=f"bench-{seed}.{fmt.lower()}")
+
+
+def summarize(samples) -> dict:
+    result = {}
+    for stage in sorted({stage for sample in samples for stage in sample}):
+        values = [sample.get(stage, 0.0) * 1000 for sample in samples]
+        result[stage] = {
+            "median_ms": round(statistics.median(values), 3),
+            "min_ms": round(min(values), 3),
+            "mean_ms": round(statistics.fmean(values), 3),
+        }
+    return result
+
+
+def bench_pipeline(timer: StageTimer, user_id: int, size, repeat: int) -> dict:
+    upload_samples, recompose_samples = [], []
+    # The first round warms caches and lazy imports and is not recorded.
+    for i in range(repeat + 1):
+        comp, stages = timer.run(lambda: utils.process_subject_and_background(
+            synthetic_photo(size, seed=2 * i),
+            synthetic_photo(size, seed=2 * i + 1),
+            user_id,
+        ))
+        if i:
+            upload_samples.append(stages)
+
+        _, stages = timer.run(lambda: utils.recompose_with_new_background(
+            comp, synthetic_photo(size, seed=10_000 + i), fit_mode="cover",
+        ))
+        if i:
+            recompose_samples.append(stages)
+    return {"upload": summarize(upload_samples), "recompose": summarize(recompose_samples)}
+
+
+def add_gallery_rows(user_id: int, count: int):
+    start = db.session.query(db.func.count(Image.id)).scalar()
+    images = [
+        {"user_id": user_id, "original_path": f"uploads/bench/{n}.jpg", "content_hash": f"bench-{n}"}
+        for n in range(start, start + count)
+    ]
+    db.session.execute(Image.__table__.insert(), images)
+    first_id = db.session.query(db.func.max(Image.id)).scalar() - count + 1
+    db.session.execute(Composition.__table__.insert(), [
+        {"image_id": image_id, "output_path": f"compositions/bench-{image_id}.webp",
+         "is_public": True, "like_count": 0, "comment_count": 0}
+        for image_id in range(first_id, first_id + count)
+    ])
+    db.session.commit()
+
+
+def bench_gallery(app, user_id: int, sizes, repeat: int) -> dict:
+    client = app.test_client()
+    client.get("/")  # compiles templates
+    results = {}
+    rows = db.session.query(db.func.count(Composition.id)).scalar()
+    for size in sorted(sizes):
+        if size > rows:
+            add_gallery_rows(user_id, size - rows)
+            rows = size
+
+        cold, warm = [], []
+        for _ in range(repeat):
+            gallery_cache.clear()
+            started = time.perf_counter()
+            client.get("/")
+            cold.append(time.perf_counter() - started)
+            started = time.perf_counter()
+            client.get("/")
+            warm.append(time.perf_counter() - started)
+        results[str(size)] = summarize([{"cold": c, "warm": w} for c, w in zip(cold, warm)])
+    return results
+
+
+def environment(model: str) -> dict:
+    versions = {}
+    for name in ("Pillow", "numpy", "rembg", "onnxruntime", "Flask", "SQLAlchemy"):
+        try:
+            versions[name] = metadata.version(name)
+        except metadata.PackageNotFoundError:
+            versions[name] = None
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "model": model,
+        "versions": versions,
+    }
+
+
+def flatten(results: dict, prefix: str = ""):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif key == "median_ms":
+            yield prefix.rstrip("."), value
+
+
+def compare(report: dict, baseline: dict, max_slowdown: float) -> bool:
+    for key in ("size",):
+        if baseline.get(key) != report[key]:
+            print(f"warning: baseline {key} is {baseline.get(key)!r}, this run used {report[key]!r}")
+    if baseline["environment"]["model"] != report["environment"]["model"]:
+        print("warning: baseline was measured with a different model")
+    for key in ("cpus", "python"):
+        if baseline["environment"].get(key) != report["environment"][key]:
+            print(f"warning: baseline ran with {key}={baseline['environment'].get(key)!r}, "
+                  f"this run has {report['environment'][key]!r}")
+
+    results = report["results"]
+    old = dict(flatten(baseline["results"]))
+    ok = True
+    print(f"\n{'metric':<40} {'baseline':>10} {'now':>10} {'ratio':>7}")
+    for name, now in flatten(results):
+        before = old.get(name)
+        if before is None:
+            continue
+        ratio = now / before if before else float("inf")
+        flag = ""
+        if before >= MIN_COMPARE_MS and ratio > max_slowdown:
+            flag, ok = "  SLOWER", False
+        print(f"{name:<40} {before:>8.1f}ms {now:>8.1f}ms {ratio:>6.2f}x{flag}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", choices=("stub", "real"), default="stub")
+    parser.add_argument("--size", default="1600x1200", help="Subject and background size.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--gallery-sizes", default=",".join(map(str, GALLERY_SIZES)))
+    parser.add_argument("--output", help="Write the results as JSON to this file.")
+    parser.add_argument("--baseline", help="Compare against a JSON file from an earlier run.")
+    parser.add_argument("--max-slowdown", type=float, default=1.25)
+    args = parser.parse_args()
+
+    size = tuple(int(v) for v in args.size.split("x"))
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    bench = bench_config(workdir, args.model)
+    try:
+        app = create_app(bench)
+        if args.model == "stub":
+            for model_name in model_sessions.model_names():
+                model_sessions.sessions[model_name] = StubSession()
+
+        timer = StageTimer()
+        instrument(timer)
+        with app.app_context():
+            user = User(username="bench", email="bench@example.com", password_hash="-")
+            db.session.add(user)
+            db.session.commit()
+
+            results = {
+                "pipeline": bench_pipeline(timer, user.id, size, args.repeat),
+                "gallery": bench_gallery(
+                    app, user.id, [int(n) for n in args.gallery_sizes.split(",")], args.repeat,
+                ),
+            }
+            for (key,) in db.session.query(Composition.output_path).filter(
+                Composition.output_path.like("compositions/%"), ~Composition.output_path.like("compositions/bench-%"),
+            ):
+                storage.delete(key)
+    finally:
+        shutil.rmtree(bench.UPLOAD_FOLDER, ignore_errors=True)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {"environment": environment(args.model), "size": args.size, "repeat": args.repeat, "results": results}
+    for name, value in flatten(results):
+        print(f"{name:<40} {value:>8.1f} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(report, baseline, args.max_slowdown):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
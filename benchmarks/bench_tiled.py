@@ -0,0 +1,142 @@
+"""Compare proxy, full and tiled segmentation on a synthetic large subject.
+
+The stub model sees a fixed 320x320 input like u2net, so edge detail depends
+on how much of the image each inference covers. Each mode runs in a fresh
+process to report its own peak memory. Run from the repository root:
+
+    python -m benchmarks.bench_tiled --size 8000x6000
+    python -m benchmarks.bench_tiled --model u2net --modes proxy,tiled
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image as PILImage, ImageDraw
+
+MODEL_INPUT = (320, 320)
+
+
+class StubSession:
+    """Thresholds the red channel after squeezing the image through the model's input size."""
+
+    model_name = "stub"
+
+    def predict(self, img, *args, **kwargs):
+        small = np.asarray(img.convert("RGB").resize(MODEL_INPUT, PILImage.BILINEAR))
+        mask = PILImage.fromarray(np.where(small[..., 0] > 128, 255, 0).astype(np.uint8))
+        return [mask.resize(img.size, PILImage.BILINEAR)]
+
+
+class SessionExecutor:
+    def __init__(self, session):
+        self.session = session
+
+    def predict_masks(self, images, model_name=None):
+        from app.gallery.segmentation import predict_masks
+
+        return predict_masks(list(images), self.session)
+
+
+def synthetic_subject(size, path: str):
+    """A red subject with thin spokes and fine holes on a busy blue-green background."""
+    width, height = size
+    rng = np.random.default_rng(0)
+    pixels = np.empty((height, width, 3), np.uint8)
+    pixels[..., 0] = rng.integers(0, 100, (height, width), dtype=np.uint8)
+    pixels[..., 1] = np.linspace(60, 200, width, dtype=np.uint8)
+    pixels[..., 2] = 160
+    img = PILImage.fromarray(pixels)
+
+    draw = ImageDraw.Draw(img)
+    cx, cy, radius = width // 2, height // 2, min(width, height) // 3
+    draw.ellipse((cx - radius, cy - radius, cx + radius, cy + radius), fill=(230, 40, 40))
+    spoke = max(2, min(width, height) // 800)
+    for angle in np.linspace(0, 2 * np.pi, 48, endpoint=False):
+        end = (cx + 1.4 * radius * np.cos(angle), cy + 1.4 * radius * np.sin(angle))
+        draw.line((cx, cy, *end), fill=(230, 40, 40), width=spoke)
+    for x in range(cx - radius // 2, cx + radius // 2, spoke * 8):
+        draw.rectangle((x, cy - spoke * 2, x + spoke * 3, cy + spoke * 2), fill=(20, 120, 160))
+    img.save(path, quality=92)
+
+
+def ground_truth(path: str) -> np.ndarray:
+    with PILImage.open(path) as img:
+        return np.asarray(img.convert("RGB"))[..., 0] > 128
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_mode(mode: str, path: str, model: str, result):
+    from flask import Flask
+
+    from config import Config
+    from app.gallery.segmentation import segment
+
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config["SEGMENT_MODE"] = mode
+
+    if model == "stub":
+        session = StubSession()
+    else:
+        from rembg import new_session
+
+        session = new_session(model)
+    executor = SessionExecutor(session)
+
+    with app.app_context():
+        before = peak_rss_mb()
+        started = time.perf_counter()
+        mask = segment(path, executor, model)
+        elapsed = time.perf_counter() - started
+        peak = peak_rss_mb()
+
+    predicted = np.asarray(mask) > 127
+    truth = ground_truth(path)
+    union = np.logical_or(predicted, truth).sum()
+    edge = truth ^ np.roll(truth, 1, axis=1)
+    result.update(
+        seconds=elapsed,
+        rss_mb=peak - before,
+        iou=float(np.logical_and(predicted, truth).sum() / union) if union else 1.0,
+        edge_accuracy=float((predicted[edge] == truth[edge]).mean()) if edge.any() else 1.0,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default="8000x6000")
+    parser.add_argument("--modes", default="proxy,full,tiled")
+    parser.add_argument("--model", default="stub", help="'stub' or a rembg model name.")
+    args = parser.parse_args()
+
+    size = tuple(int(v) for v in args.size.split("x"))
+    ctx = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "subject.jpg")
+        synthetic_subject(size, path)
+        print(f"{size[0]}x{size[1]} subject, model {args.model}")
+
+        for mode in args.modes.split(","):
+            with ctx.Manager() as manager:
+                result = manager.dict()
+                proc = ctx.Process(target=run_mode, args=(mode, path, args.model, result))
+                proc.start()
+                proc.join()
+                if proc.exitcode:
+                    print(f"  {mode:<6} failed with exit code {proc.exitcode}")
+                    continue
+                print(
+                    f"  {mode:<6} {result['seconds']:7.2f} s  peak +{result['rss_mb']:7.1f} MB  "
+                    f"IoU {result['iou']:.4f}  edge accuracy {result['edge_accuracy']:.3f}"
+                )
+
+
+if __name__ == "__main__":
+    main()
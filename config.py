@@ -5,17 +5,163 @@ INSTANCE_DIR = os.path.join(BASE_DIR, "instance")
 os.makedirs(INSTANCE_DIR, exist_ok=True)
 
 DB_NAME = "bg_app.db"
+DATABASE_URL = os.environ.get("DATABASE_URL") or (
+    "sqlite:///" + os.path.join(INSTANCE_DIR, DB_NAME).replace("\\", "/")
+)
+
+
+def engine_options(url: str) -> dict:
+    if url.startswith("sqlite"):
+        # The lock wait is SQLITE_PRAGMAS["busy_timeout"], applied on connect.
+        return {}
+    return {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 20)),
+        "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": True,
+    }
+
 
 class Config:
     SECRET_KEY = os.environ.get("SECRET_KEY") or os.urandom(32).hex()
-    SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(INSTANCE_DIR, DB_NAME).replace("\\", "/")
+    SQLALCHEMY_DATABASE_URI = DATABASE_URL
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(DATABASE_URL)
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLITE_PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "busy_timeout": 5000,
+        "cache_size": -64000,
+        "temp_store": "MEMORY",
+    }
 
     UPLOAD_FOLDER = os.path.join(BASE_DIR, "app", "static", "uploads")
     ORIGINAL_FOLDER = os.path.join(UPLOAD_FOLDER, "original")
     CUTOUT_FOLDER = os.path.join(UPLOAD_FOLDER, "cutout")
     BACKGROUND_FOLDER = os.path.join(UPLOAD_FOLDER, "backgrounds")
     COMPOSED_FOLDER = os.path.join(UPLOAD_FOLDER, "composed")
+    MASK_FOLDER = os.path.join(UPLOAD_FOLDER, "masks")
+    THUMB_FOLDER = os.path.join(UPLOAD_FOLDER, "thumbs")
+
+    UPLOAD_TMP_FOLDER = os.path.join(INSTANCE_DIR, "tmp")
+
+    STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "local")
+    S3_BUCKET = os.environ.get("S3_BUCKET", "")
+    S3_ENDPOINT_URL = os.environ.get("S3_ENDPOINT_URL", "")
+    S3_REGION = os.environ.get("S3_REGION", "")
+    # Serve media from a public bucket or CDN. Without it URLs are presigned and
+    # each one is reused for half of S3_URL_EXPIRES.
+    S3_PUBLIC_URL = os.environ.get("S3_PUBLIC_URL", "")
+    S3_URL_EXPIRES = int(os.environ.get("S3_URL_EXPIRES", 24 * 3600))
+    S3_MAX_POOL_CONNECTIONS = int(os.environ.get("S3_MAX_POOL_CONNECTIONS", 20))
+    S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+    S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+    # Keys remembered as existing, to skip HEAD requests.
+    S3_KNOWN_KEYS = 10000
+
+    MEDIA_MAX_AGE = 365 * 24 * 3600
+    MEDIA_ACCEL_REDIRECT = os.environ.get("MEDIA_ACCEL_REDIRECT", "")
+    USE_X_SENDFILE = os.environ.get("USE_X_SENDFILE") == "1"
+
+    MAX_CONTENT_LENGTH = int(os.environ.get("MAX_CONTENT_LENGTH", 200 * 1024 * 1024))
+    UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 25 * 1024 * 1024))
+    UPLOAD_MAX_PIXELS = int(os.environ.get("UPLOAD_MAX_PIXELS", 24_000_000))
+    UPLOAD_OVERSIZE = os.environ.get("UPLOAD_OVERSIZE", "downscale")
+    UPLOAD_DOWNSCALE_MAX_PIXELS = 100_000_000
+
+    STORE_MASKS_ONLY = os.environ.get("STORE_MASKS_ONLY", "0") == "1"
+    MASK_FORMAT = os.environ.get("MASK_FORMAT", "png")
+    RENDER_CACHE_BYTES = 64 * 1024 * 1024
+    CUTOUT_CACHE_BYTES = int(os.environ.get("CUTOUT_CACHE_BYTES", 256 * 1024 * 1024))
+    PREVIEW_MAX_EDGE = 480
+    PREVIEW_QUALITY = 75
+    BACKGROUND_LIBRARY_SIZE = 24
+
+    COMPOSE_FIT = "stretch"
+    COMPOSE_ANCHOR = (0.5, 0.5)
+    BACKGROUND_CACHE_BYTES = 128 * 1024 * 1024
+
+    CUTOUT_FORMAT = os.environ.get("CUTOUT_FORMAT", "webp")
+    COMPOSED_FORMAT = os.environ.get("COMPOSED_FORMAT", "webp")
+    COMPOSED_QUALITY = int(os.environ.get("COMPOSED_QUALITY", 85))
+    PNG_COMPRESS_LEVEL = int(os.environ.get("PNG_COMPRESS_LEVEL", 6))
+    WEBP_METHOD = 4
+
+    THUMB_WIDTHS = (160, 320, 640)
+    THUMB_FORMAT = "webp"
+    THUMB_QUALITY = 80
+
+    GALLERY_PAGE_SIZE = int(os.environ.get("GALLERY_PAGE_SIZE", 24))
+    GALLERY_CACHE_SIZE = 64
+    GALLERY_CACHE_TTL = 30
+
+    API_PAGE_SIZE = 50
+    API_MAX_PAGE_SIZE = 500
+    # JSON responses smaller than this are sent uncompressed.
+    API_GZIP_MIN_BYTES = 1024
+    API_GZIP_LEVEL = 6
+
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 300
+
+    REMBG_MODEL = os.environ.get("REMBG_MODEL", "u2net")
+    REMBG_INTRA_OP_THREADS = int(os.environ.get("REMBG_INTRA_OP_THREADS", 0))
+    REMBG_INTER_OP_THREADS = int(os.environ.get("REMBG_INTER_OP_THREADS", 0))
+    REMBG_PRELOAD = True
+    REMBG_WARMUP = True
+
+    # Ordered from fastest to highest quality.
+    MODEL_TIERS = {
+        "fast": os.environ.get("MODEL_FAST", "u2netp"),
+        "quality": REMBG_MODEL,
+    }
+    MODEL_DEFAULT_TIER = os.environ.get("MODEL_DEFAULT_TIER", "quality")
+    MODEL_DOWNGRADE_TIER = "fast"
+    MODEL_DOWNGRADE_QUEUE_DEPTH = int(os.environ.get("MODEL_DOWNGRADE_QUEUE_DEPTH", 0))
+
+    INFERENCE_EXECUTOR = os.environ.get("INFERENCE_EXECUTOR", "inline")
+    INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", 0))
+
+    SEGMENT_MODE = os.environ.get("SEGMENT_MODE", "proxy")
+    SEGMENT_MAX_EDGE = int(os.environ.get("SEGMENT_MAX_EDGE", 1024))
+    # "proxy" and "full" switch to tiles for images at least this many pixels; 0 disables.
+    SEGMENT_TILE_MIN_PIXELS = int(os.environ.get("SEGMENT_TILE_MIN_PIXELS", 0))
+    SEGMENT_TILE_SIZE = int(os.environ.get("SEGMENT_TILE_SIZE", 1024))
+    SEGMENT_TILE_OVERLAP = 128
+    SEGMENT_TILE_BATCH = 4
+    # Width of the uncertain edge band, as a fraction of the coarse mask's long side.
+    SEGMENT_TILE_BAND = 0.02
+
+    JOB_BACKEND = os.environ.get("JOB_BACKEND", "thread")
+    JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+    JOB_POLL_SECONDS = 1.0
+    # Running jobs with no progress report for this long are claimed again.
+    JOB_STALE_SECONDS = 600
+    JOB_RETRY_MAX_SECONDS = 30
+
+    PROFILER_ENABLED = os.environ.get("PROFILER_ENABLED", "0") == "1"
+    PROFILER_INTERVAL = float(os.environ.get("PROFILER_INTERVAL", 0.01))
+    PROFILER_MAX_DEPTH = 64
+
+    # /metrics, /metrics/profile and /stats answer these client addresses, or any
+    # client sending "Authorization: Bearer <METRICS_TOKEN>". Behind a reverse proxy
+    # every client has the proxy's address, so set a token and drop the loopback entries.
+    METRICS_ALLOW_IPS = [
+        ip.strip() for ip in os.environ.get("METRICS_ALLOW_IPS", "127.0.0.1,::1").split(",") if ip.strip()
+    ]
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+    GC_GRACE_SECONDS = int(os.environ.get("GC_GRACE_SECONDS", 3600))
+    GC_INTERVAL_SECONDS = int(os.environ.get("GC_INTERVAL_SECONDS", 0))
+
+    MAINTENANCE_CHECKPOINT_FOLDER = os.path.join(INSTANCE_DIR, "maintenance")
+    MAINTENANCE_CHUNK_SIZE = 200
+    # Worker processes for `flask maintenance` commands; 0 means one per CPU.
+    MAINTENANCE_WORKERS = int(os.environ.get("MAINTENANCE_WORKERS", 0))
+
+    BATCH_MAX_FILES = int(os.environ.get("BATCH_MAX_FILES", 50))
+    BATCH_INFERENCE_SIZE = int(os.environ.get("BATCH_INFERENCE_SIZE", 8))
 
     @classmethod
     def ensure_dirs(cls):
@@ -25,5 +171,7 @@ class Config:
             cls.CUTOUT_FOLDER,
             cls.BACKGROUND_FOLDER,
             cls.COMPOSED_FOLDER,
+            cls.MASK_FOLDER,
+            cls.THUMB_FOLDER,
         ]:
             os.makedirs(p, exist_ok=True)
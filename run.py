@@ -1,6 +1,5 @@
 from app import create_app
 
-app = create_app()
-
+# WSGI servers load the factory, e.g. `gunicorn "app:create_app()"`.
 if __name__ == "__main__":
-    app.run(debug=True)
+    create_app().run(debug=True)
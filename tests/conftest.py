@@ -0,0 +1,97 @@
+import os
+import sys
+
+import pytest
+from PIL import Image as PILImage
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(TESTS_DIR, "stubs"), os.path.dirname(TESTS_DIR)]
+
+from config import Config  # noqa: E402
+from rembg import ellipse_mask as circle_mask  # noqa: E402,F401
+
+
+def test_settings(root) -> dict:
+    """Settings that keep the database, uploads and checkpoints below ``root``."""
+    upload_folder = os.path.join(root, "static", "uploads")
+    settings = {
+        "TESTING": True,
+        "SECRET_KEY": "test",
+        "SQLALCHEMY_DATABASE_URI": f"sqlite:///{os.path.join(root, 'test.db')}",
+        "UPLOAD_FOLDER": upload_folder,
+        "UPLOAD_TMP_FOLDER": os.path.join(root, "tmp"),
+        "MAINTENANCE_CHECKPOINT_FOLDER": os.path.join(root, "maintenance"),
+        "REMBG_PRELOAD": False,
+        "JOB_WORKERS": 0,
+        "GC_INTERVAL_SECONDS": 0,
+    }
+    for name in ("ORIGINAL", "CUTOUT", "BACKGROUND", "COMPOSED", "MASK", "THUMB"):
+        folder = os.path.basename(getattr(Config, f"{name}_FOLDER"))
+        settings[f"{name}_FOLDER"] = os.path.join(upload_folder, folder)
+    return settings
+
+
+test_settings.__test__ = False
+
+
+def make_app(root, **overrides):
+    from app import create_app, storage
+
+    application = create_app(type("TestConfig", (Config,), dict(test_settings(root), **overrides)))
+    # Storage keys are relative to the static folder, so it moves along with the uploads.
+    application.static_folder = os.path.join(root, "static")
+    storage.init_app(application)
+    return application
+
+
+@pytest.fixture
+def app(tmp_path):
+    from app import db
+
+    application = make_app(str(tmp_path))
+    with application.app_context():
+        yield application
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def user(app):
+    from app import db
+    from app.models import User
+
+    row = User(username="alice", email="alice@example.com", password_hash="x")
+    db.session.add(row)
+    db.session.commit()
+    return row
+
+
+@pytest.fixture
+def client(app, user):
+    """A test client signed in as ``user``."""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["user_id"] = user.id
+    return client
+
+
+@pytest.fixture
+def mask_only_composition(app, user):
+    """A background-less composition of a 120x80 subject stored as original plus mask."""
+    from app import db, storage
+    from app.gallery.segmentation import save_mask
+    from app.models import Composition, Image
+
+    original = PILImage.new("RGB", (120, 80), (200, 30, 30))
+    original_path = storage.key_for(app.config["ORIGINAL_FOLDER"], "subject.png")
+    with storage.writer(original_path) as out:
+        original.save(out, "PNG")
+    image = Image(
+        user_id=user.id,
+        original_path=original_path,
+        mask_path=save_mask(circle_mask(original.size), app.config["MASK_FOLDER"]),
+    )
+    comp = Composition(image=image, output_path="")
+    db.session.add_all([image, comp])
+    db.session.commit()
+    return comp
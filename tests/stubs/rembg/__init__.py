@@ -0,0 +1,34 @@
+"""Stand-in for rembg: every subject is the centred ellipse.
+
+Tests put this directory first on sys.path, which spawned workers inherit,
+so no model is ever downloaded or run.
+"""
+from PIL import Image, ImageDraw
+
+
+def ellipse_mask(size) -> Image.Image:
+    mask = Image.new("L", size, 0)
+    w, h = size
+    ImageDraw.Draw(mask).ellipse((w // 4, h // 4, 3 * w // 4, 3 * h // 4), fill=255)
+    return mask
+
+
+class StubSession:
+    def __init__(self, model_name: str):
+        self.model_name = model_name
+
+    def predict(self, img, *args, **kwargs):
+        return [ellipse_mask(img.size)]
+
+
+def new_session(model_name: str = "u2net", *args, **kwargs):
+    return StubSession(model_name)
+
+
+def remove(img, session=None, only_mask: bool = False, **kwargs):
+    mask = (session or new_session()).predict(img)[0]
+    if only_mask:
+        return mask
+    cutout = img.convert("RGBA")
+    cutout.putalpha(mask)
+    return cutout
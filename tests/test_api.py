@@ -0,0 +1,48 @@
+from sqlalchemy import event
+
+from app import db
+from app.api.tokens import create_token
+from app.models import Composition
+
+
+def _count_queries(client, url, **kwargs) -> int:
+    statements = []
+
+    def count(*args):
+        statements.append(1)
+
+    event.listen(db.engine, "before_cursor_execute", count)
+    try:
+        assert client.get(url, **kwargs).status_code == 200
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count)
+    return len(statements)
+
+
+def test_list_query_count_does_not_grow_with_the_page(app, client, mask_only_composition):
+    url = "/api/v1/compositions?fields=id,url,thumbs"
+    _count_queries(client, url)  # Warms the user cache.
+    one = _count_queries(client, url)
+
+    image = mask_only_composition.image
+    db.session.add_all([Composition(image=image, output_path="") for _ in range(9)])
+    db.session.commit()
+
+    assert _count_queries(client, url) == one
+
+
+def test_writes_need_a_bearer_token(app, client, user):
+    resp = client.post("/api/v1/compositions")
+    assert resp.status_code == 401
+    assert resp.headers["WWW-Authenticate"] == "Bearer"
+
+    token = create_token(user)
+    resp = client.post("/api/v1/compositions", headers={"Authorization": f"Bearer {token}"})
+    assert resp.status_code == 400
+    assert "subject" in resp.get_json()["error"]
+
+
+def test_session_cookie_can_read(client, mask_only_composition):
+    resp = client.get(f"/api/v1/compositions/{mask_only_composition.id}")
+    assert resp.status_code == 200
+    assert resp.get_json()["id"] == mask_only_composition.id
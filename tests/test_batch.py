@@ -0,0 +1,62 @@
+import io
+import zipfile
+
+from PIL import Image as PILImage
+
+from app import db, inference, jobs
+from app.models import Composition, Image, Job
+
+
+def _png(color, size=(64, 48)) -> io.BytesIO:
+    buf = io.BytesIO()
+    PILImage.new("RGB", size, color).save(buf, "PNG")
+    buf.seek(0)
+    return buf
+
+
+def _near(pixel, expected) -> bool:
+    return all(abs(a - b) <= 8 for a, b in zip(pixel, expected))
+
+
+def test_batch_segments_once_and_streams_a_zip(app, client, monkeypatch):
+    batches = []
+    predict = inference.predict_masks
+
+    def counting(images, *args, **kwargs):
+        batches.append(len(images))
+        return predict(images, *args, **kwargs)
+
+    monkeypatch.setattr(inference, "predict_masks", counting)
+
+    resp = client.post(
+        "/batch",
+        data={
+            "subjects": [
+                (_png((200, 0, 0)), "red.png"),
+                (_png((0, 200, 0)), "green.png"),
+                (_png((200, 0, 0)), "red-again.png"),
+            ],
+            "background": (_png((0, 0, 200), (96, 96)), "sky.png"),
+        },
+        headers={"Accept": "application/json"},
+    )
+    assert resp.status_code == 202
+    job_id = resp.get_json()["job_id"]
+    assert jobs._mark_running(job_id)
+    jobs._run(job_id)
+
+    job = db.session.get(Job, job_id, populate_existing=True)
+    assert (job.status, job.done, job.total) == ("done", 3, 3)
+    assert batches == [2]
+    assert Image.query.count() == 2
+    assert Composition.query.count() == 3
+
+    download = client.get(f"/jobs/{job_id}/download")
+    assert download.is_streamed
+    with zipfile.ZipFile(io.BytesIO(download.get_data())) as archive:
+        names = archive.namelist()
+        first = PILImage.open(io.BytesIO(archive.read(names[0]))).convert("RGB")
+    assert [name.rsplit(".", 1)[0] for name in names] == ["001_red", "002_green", "003_red-again"]
+    # Compositions may be stored lossy, so colours are only compared roughly.
+    assert _near(first.getpixel((0, 0)), (0, 0, 200))
+    assert _near(first.getpixel((32, 24)), (200, 0, 0))
@@ -0,0 +1,38 @@
+from datetime import datetime, timedelta
+
+from app import db
+from app.cleanup import prune_rows
+from app.gallery.utils import background_library, find_background
+from app.models import Background
+
+
+def _backgrounds(user, count, age=timedelta(days=30)):
+    created = datetime.utcnow() - age
+    rows = [
+        Background(user_id=user.id, bg_path=f"uploads/backgrounds/{i}.png", content_hash=f"hash{i}", created_at=created)
+        for i in range(count)
+    ]
+    db.session.add_all(rows)
+    db.session.commit()
+    return [row.id for row in rows]
+
+
+def test_backgrounds_outside_the_library_are_pruned(app, user, mask_only_composition):
+    app.config["BACKGROUND_LIBRARY_SIZE"] = 3
+    ids = _backgrounds(user, 6)
+    # The oldest one is still used by a composition.
+    mask_only_composition.background_id = ids[0]
+    db.session.commit()
+
+    assert prune_rows(3600) == {"images": 0, "backgrounds": 2}
+    remaining = [bg.id for bg in Background.query.order_by(Background.id)]
+    assert remaining == [ids[0]] + ids[3:]
+    assert [bg.id for bg in background_library(user.id)] == ids[:2:-1]
+
+
+def test_reused_background_is_kept(app, user):
+    app.config["BACKGROUND_LIBRARY_SIZE"] = 1
+    ids = _backgrounds(user, 2)
+
+    assert find_background("hash0", user.id).id == ids[0]
+    assert prune_rows(3600) == {"images": 0, "backgrounds": 0}
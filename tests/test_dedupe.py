@@ -0,0 +1,53 @@
+import io
+import os
+
+from PIL import Image as PILImage
+from werkzeug.datastructures import FileStorage
+
+from app import db, inference
+from app.gallery.utils import process_subject_and_background
+from app.models import Image, User
+from app.stats import stats
+
+
+def _upload(color=(10, 120, 200)) -> FileStorage:
+    buf = io.BytesIO()
+    PILImage.new("RGB", (64, 48), color).save(buf, "PNG")
+    buf.seek(0)
+    return FileStorage(buf, filename="subject.png", content_type="image/png")
+
+
+def test_repeat_upload_skips_inference(app, user, monkeypatch):
+    batches = []
+    predict = inference.predict_masks
+
+    def counting(images, *args, **kwargs):
+        batches.append(len(images))
+        return predict(images, *args, **kwargs)
+
+    monkeypatch.setattr(inference, "predict_masks", counting)
+    hits, misses = stats.get("dedupe.hits"), stats.get("dedupe.misses")
+
+    first = process_subject_and_background(_upload(), None, user.id)
+    second = process_subject_and_background(_upload(), None, user.id)
+
+    other = User(username="bob", email="bob@example.com", password_hash="x")
+    db.session.add(other)
+    db.session.commit()
+    third = process_subject_and_background(_upload(), None, other.id)
+
+    assert batches == [1]
+    assert (stats.get("dedupe.hits") - hits, stats.get("dedupe.misses") - misses) == (2, 1)
+    assert second.image_id == first.image_id
+    assert third.image_id != first.image_id
+    assert third.image.cutout_path == first.image.cutout_path
+    assert Image.query.count() == 2
+    assert len(os.listdir(app.config["ORIGINAL_FOLDER"])) == 1
+
+
+def test_different_bytes_are_segmented(app, user):
+    first = process_subject_and_background(_upload(), None, user.id)
+    second = process_subject_and_background(_upload((200, 40, 40)), None, user.id)
+
+    assert second.image.content_hash != first.image.content_hash
+    assert second.image.cutout_path != first.image.cutout_path
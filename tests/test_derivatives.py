@@ -0,0 +1,69 @@
+import pytest
+from PIL import Image as PILImage
+
+from app import db, storage
+from app.cleanup import referenced_thumb_prefixes
+from app.gallery.derivatives import derivative_key, derivative_rel_path, generate_derivatives, refresh_derivatives
+from app.gallery.render import composition_png
+from app.gallery.segmentation import save_mask
+from app.gallery.urls import composition_format, composition_url, thumb_url
+from app.models import Composition
+
+
+def test_resegmenting_changes_mask_only_urls(app, mask_only_composition):
+    app.config["STORE_MASKS_ONLY"] = True
+    comp, image = mask_only_composition, mask_only_composition.image
+
+    with app.test_request_context():
+        before = (derivative_key(comp), composition_url(comp), composition_png(comp))
+        image.mask_path = save_mask(PILImage.new("L", (120, 80), 255), app.config["MASK_FOLDER"])
+        db.session.commit()
+        after = (derivative_key(comp), composition_url(comp), composition_png(comp))
+
+    assert all(old != new for old, new in zip(before, after))
+    assert f"{comp.id}_{after[0]}_" in referenced_thumb_prefixes()
+
+
+def test_thumb_url_does_not_ask_storage(app, mask_only_composition, monkeypatch):
+    comp = mask_only_composition
+
+    def no_lookups(key):
+        raise AssertionError(f"storage lookup for {key}")
+
+    with app.test_request_context():
+        monkeypatch.setattr(storage.backend, "exists", no_lookups)
+        assert thumb_url(comp, 320) == f"/thumb/{comp.id}/320"
+
+        refresh_derivatives(comp)
+        assert comp.thumbs_key == derivative_key(comp)
+        assert thumb_url(comp, 320).startswith("/media/")
+
+
+def test_composition_format():
+    assert composition_format(Composition(output_path="")) == "PNG"
+    assert composition_format(Composition(output_path="uploads/composed/a.webp")) == "WEBP"
+    assert composition_format(Composition(output_path="compositions/b.jpg")) == "JPEG"
+
+
+def test_concurrent_thumbnail_writes_do_not_interleave(app, mask_only_composition):
+    comp = mask_only_composition
+    key = derivative_rel_path(comp, 200)
+    with app.test_request_context():
+        generate_derivatives(comp, widths=[200])
+    with storage.open(key) as f:
+        rendered = f.read()
+
+    # Two requests render the same missing thumbnail; the slower one finishes last.
+    with storage.writer(key) as slow, storage.writer(key) as fast:
+        slow.write(rendered[: len(rendered) // 2])
+        fast.write(rendered)
+        assert storage.exists(key)
+        slow.write(rendered[len(rendered) // 2:])
+
+    with pytest.raises(RuntimeError), storage.writer(key) as failed:
+        failed.write(b"partial")
+        raise RuntimeError("render failed")
+
+    with storage.open(key) as f:
+        assert f.read() == rendered
+    assert [k for k, _, _ in storage.list(storage.folder_key(app.config["THUMB_FOLDER"]))] == [key]
@@ -0,0 +1,21 @@
+from app.models import Comment
+
+
+def test_like_and_comment_refresh_the_anonymous_feed(app, client, mask_only_composition):
+    comp_id = mask_only_composition.id
+    anonymous = app.test_client()
+    assert "0 comments" in anonymous.get("/gallery/page").get_data(as_text=True)
+
+    client.post(f"/composition/{comp_id}/like")
+    client.post(f"/composition/{comp_id}", data={"text": "nice"})
+
+    page = anonymous.get("/gallery/page").get_data(as_text=True)
+    assert "&#9825; 1" in page
+    assert "1 comments" in page
+
+    client.post(f"/composition/{comp_id}/unlike")
+    client.post(f"/comment/{Comment.query.one().id}/delete")
+
+    page = anonymous.get("/gallery/page").get_data(as_text=True)
+    assert "&#9825; 0" in page
+    assert "0 comments" in page
@@ -0,0 +1,47 @@
+import json
+import subprocess
+import sys
+
+from conftest import TESTS_DIR
+
+# Builds the app at import time, as run.py used to, so spawned workers
+# re-importing __main__ run the factory again.
+SCRIPT = """
+import json
+import sys
+import time
+
+sys.path.insert(0, {tests_dir!r})
+from conftest import make_app
+
+app = make_app({root!r}, INFERENCE_EXECUTOR="process", INFERENCE_WORKERS=2, REMBG_PRELOAD=True)
+
+if __name__ == "__main__":
+    from PIL import Image
+    from app import inference
+
+    client = app.test_client()
+    for _ in range(600):
+        status = client.get("/ready").get_json()
+        if status["ready"] or status["error"]:
+            break
+        time.sleep(0.1)
+    with app.app_context():
+        masks = inference.predict_masks([Image.new("RGB", (90, 60)), Image.new("RGB", (40, 30))])
+    status["mask_sizes"] = [list(mask.size) for mask in masks]
+    inference.shutdown()
+    print(json.dumps(status))
+"""
+
+
+def test_process_executor_warms_up_under_spawn(tmp_path):
+    script = tmp_path / "serve.py"
+    script.write_text(SCRIPT.format(tests_dir=TESTS_DIR, root=str(tmp_path)))
+
+    done = subprocess.run([sys.executable, str(script)], capture_output=True, text=True, timeout=120)
+
+    assert done.returncode == 0, done.stderr
+    status = json.loads(done.stdout.strip().splitlines()[-1])
+    assert status["executor"] == "process"
+    assert status["ready"] and status["error"] is None
+    assert status["mask_sizes"] == [[90, 60], [40, 30]]
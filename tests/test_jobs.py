@@ -0,0 +1,66 @@
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from app import db, jobs
+from app.jobs import JobQueue
+from app.models import Job
+
+
+def _job(user, **fields):
+    job = Job(kind="noop", user_id=user.id, payload="{}", **fields)
+    db.session.add(job)
+    db.session.commit()
+    return job.id
+
+
+# SystemExit is how the test stops the otherwise endless worker loop.
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_worker_survives_database_errors(app, user, monkeypatch):
+    monkeypatch.setitem(jobs.handlers, "noop", lambda job, payload: None)
+    monkeypatch.setattr(jobs, "backend", "sqlite")
+    monkeypatch.setattr(jobs, "poll_seconds", 0.01)
+    job_id = _job(user)
+
+    claim = jobs._claim
+    calls = []
+
+    def flaky_claim():
+        calls.append(1)
+        if len(calls) == 1:
+            raise OperationalError("SELECT", {}, Exception("database is locked"))
+        if len(calls) > 2:
+            raise SystemExit
+        return claim()
+
+    monkeypatch.setattr(jobs, "_claim", flaky_claim)
+    worker = threading.Thread(target=jobs._work, daemon=True)
+    worker.start()
+    worker.join(timeout=5)
+
+    assert not worker.is_alive()
+    db.session.expire_all()
+    assert db.session.get(Job, job_id).status == "done"
+
+
+def test_workers_start_with_the_first_request(app):
+    app.config["JOB_WORKERS"] = 1
+    queue = JobQueue(app)
+    assert queue._workers == []
+
+    app.test_client().get("/ping")
+    assert len(queue._workers) == 1
+
+
+def test_stale_jobs_are_reclaimed_by_heartbeat(app, user, monkeypatch):
+    monkeypatch.setattr(jobs, "backend", "sqlite")
+    old = datetime.utcnow() - timedelta(seconds=jobs.stale_seconds + 60)
+    _job(user, status="running", started_at=old, heartbeat_at=datetime.utcnow())
+    assert jobs._claim() is None
+
+    stale_id = _job(user, status="running", started_at=old, heartbeat_at=old)
+    assert jobs._claim() == stale_id
+    db.session.expire_all()
+    assert db.session.get(Job, stale_id).heartbeat_at > old
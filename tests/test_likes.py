@@ -0,0 +1,61 @@
+from app import db
+from app.gallery.likes import add_like, has_liked, liked_ids, remove_like
+from app.models import Comment, Composition, User, user_likes
+
+
+def _like_rows() -> int:
+    return db.session.execute(db.select(db.func.count()).select_from(user_likes)).scalar()
+
+
+def test_like_count_follows_the_like_rows(app, user, mask_only_composition):
+    comp_id = mask_only_composition.id
+
+    assert add_like(user.id, comp_id)
+    assert not add_like(user.id, comp_id)
+    db.session.commit()
+    assert has_liked(user.id, comp_id)
+    assert (db.session.get(Composition, comp_id, populate_existing=True).like_count, _like_rows()) == (1, 1)
+
+    assert remove_like(user.id, comp_id)
+    assert not remove_like(user.id, comp_id)
+    db.session.commit()
+    assert not has_liked(user.id, comp_id)
+    assert (db.session.get(Composition, comp_id, populate_existing=True).like_count, _like_rows()) == (0, 0)
+
+
+def test_liked_ids_is_per_user(app, user, mask_only_composition):
+    other = Composition(image=mask_only_composition.image, output_path="")
+    bob = User(username="bob", email="bob@example.com", password_hash="x")
+    db.session.add_all([other, bob])
+    db.session.commit()
+    add_like(user.id, mask_only_composition.id)
+    add_like(bob.id, other.id)
+    db.session.commit()
+
+    comp_ids = [mask_only_composition.id, other.id]
+    assert liked_ids(user.id, comp_ids) == {mask_only_composition.id}
+    assert liked_ids(bob.id, comp_ids) == {other.id}
+    assert liked_ids(None, comp_ids) == set()
+
+
+def test_comment_count_follows_comments(app, client, mask_only_composition):
+    comp_id = mask_only_composition.id
+    client.post(f"/composition/{comp_id}", data={"text": "first"})
+    client.post(f"/composition/{comp_id}", data={"text": "second"})
+    client.post(f"/composition/{comp_id}", data={"text": "   "})
+    client.post(f"/comment/{Comment.query.first().id}/delete")
+
+    assert db.session.get(Composition, comp_id, populate_existing=True).comment_count == 1
+    assert Comment.query.count() == 1
+
+
+def test_deleting_a_composition_drops_its_likes_and_comments(app, user, client, mask_only_composition):
+    comp_id = mask_only_composition.id
+    add_like(user.id, comp_id)
+    db.session.commit()
+    client.post(f"/composition/{comp_id}", data={"text": "bye"})
+
+    client.post(f"/composition/{comp_id}/delete")
+
+    assert db.session.get(Composition, comp_id) is None
+    assert (_like_rows(), Comment.query.count()) == (0, 0)
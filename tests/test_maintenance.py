@@ -0,0 +1,31 @@
+import pytest
+from PIL import Image as PILImage
+
+from app import db, storage
+from app.gallery.derivatives import derivative_exists
+from app.maintenance import TaskPool, rebuild_chunk
+from app.models import Composition
+
+
+@pytest.mark.parametrize("masks_only", [True, False])
+def test_rebuild_without_background(app, mask_only_composition, masks_only):
+    app.config["STORE_MASKS_ONLY"] = masks_only
+    state = {"done": 0, "failed": []}
+
+    rebuild_chunk(TaskPool(0), [mask_only_composition.id], state)
+
+    assert state == {"done": 1, "failed": []}
+    db.session.expire_all()
+    comp = db.session.get(Composition, mask_only_composition.id)
+    if masks_only:
+        assert comp.output_path == ""
+        assert comp.image.cutout_path is None
+    else:
+        assert comp.output_path == comp.image.cutout_path
+        with storage.open(comp.output_path) as f:
+            cutout = PILImage.open(f)
+            cutout.load()
+        assert cutout.mode == "RGBA"
+        assert cutout.getpixel((0, 0))[3] == 0
+        assert cutout.getpixel((60, 40))[3] == 255
+    assert all(derivative_exists(comp, width) for width in app.config["THUMB_WIDTHS"])
@@ -0,0 +1,36 @@
+from PIL import Image as PILImage
+
+from app import inference
+
+REMOTE = {"REMOTE_ADDR": "203.0.113.7"}
+
+
+def test_metrics_are_limited_to_allowed_addresses_or_the_token(app):
+    app.config["METRICS_TOKEN"] = "s3cret"
+    client = app.test_client()
+
+    for url in ("/metrics", "/stats"):
+        assert client.get(url).status_code == 200
+        assert client.get(url, environ_base=REMOTE).status_code == 403
+        assert client.get(url, environ_base=REMOTE, headers={"Authorization": "Bearer wrong"}).status_code == 403
+        assert client.get(url, environ_base=REMOTE, headers={"Authorization": "Bearer s3cret"}).status_code == 200
+    assert client.get("/metrics/profile", environ_base=REMOTE).status_code == 403
+
+
+def test_remote_access_needs_a_configured_token(app):
+    client = app.test_client()
+
+    assert client.get("/metrics", environ_base=REMOTE, headers={"Authorization": "Bearer "}).status_code == 403
+
+
+def test_stats_reports_the_metrics_registry(app):
+    inference.predict_masks([PILImage.new("RGB", (32, 32))] * 2, "u2net")
+    client = app.test_client()
+
+    stats = client.get("/stats").get_json()
+    text = client.get("/metrics").get_data(as_text=True)
+
+    images = next(s["value"] for s in stats["app_events_total"] if s["labels"] == {"event": "inference.u2net.images"})
+    assert f'app_events_total{{event="inference.u2net.images"}} {images}' in text
+    calls = next(s["count"] for s in stats["inference_image_duration_seconds"] if s["labels"] == {"model": "u2net"})
+    assert f'inference_image_duration_seconds_count{{model="u2net"}} {calls}' in text
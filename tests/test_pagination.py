@@ -0,0 +1,70 @@
+from datetime import datetime
+
+from sqlalchemy import event
+
+from app import db
+from app.gallery.fragments import gallery_page
+from app.models import Composition
+
+
+def _feed(image, count, private=()):
+    # Equal timestamps, so only the id tiebreaker keeps the order stable.
+    created_at = datetime(2024, 1, 1)
+    comps = [
+        Composition(image=image, output_path="", created_at=created_at, is_public=i not in private)
+        for i in range(count)
+    ]
+    db.session.add_all(comps)
+    db.session.commit()
+    return [comp.id for comp in comps]
+
+
+def test_cursor_walk_visits_every_public_card_once(app, mask_only_composition):
+    ids = _feed(mask_only_composition.image, 7, private={3})
+    db.session.delete(mask_only_composition)
+    db.session.commit()
+
+    seen, cursor, pages = [], None, 0
+    while True:
+        rows, cursor = gallery_page(None, cursor, page_size=2)
+        seen += [comp.id for comp in rows]
+        pages += 1
+        if cursor is None:
+            break
+
+    assert seen == sorted(set(ids) - {ids[3]}, reverse=True)
+    assert pages == 3
+
+
+def test_page_is_one_query(app, mask_only_composition):
+    _feed(mask_only_composition.image, 5)
+    db.session.expunge_all()
+
+    statements = []
+
+    def count(*args):
+        statements.append(1)
+
+    event.listen(db.engine, "before_cursor_execute", count)
+    try:
+        rows, _ = gallery_page(None, None, page_size=3)
+        assert {comp.image.user.username for comp in rows} == {"alice"}
+    finally:
+        event.remove(db.engine, "before_cursor_execute", count)
+
+    assert len(rows) == 3
+    assert len(statements) == 1
+
+
+def test_fragment_links_the_next_page(app, mask_only_composition):
+    app.config["GALLERY_PAGE_SIZE"] = 2
+    _feed(mask_only_composition.image, 2)
+    client = app.test_client()
+
+    first = client.get("/gallery/page")
+    last = client.get(first.headers["X-Next-Page"])
+    garbage = client.get("/gallery/page?cursor=not-a-cursor")
+
+    assert "X-Next-Page" not in last.headers
+    assert last.get_data() != first.get_data()
+    assert garbage.get_data() == first.get_data()
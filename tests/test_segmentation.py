@@ -0,0 +1,60 @@
+import numpy as np
+from PIL import Image as PILImage, ImageDraw
+
+from app.gallery.segmentation import refine_tiles, tile_starts
+
+TILE, OVERLAP = 256, 32
+
+
+def _subject(size=(1000, 700)) -> PILImage.Image:
+    """A red subject that crosses tile seams and runs off the right and bottom edges."""
+    w, h = size
+    img = PILImage.new("RGB", size, (20, 40, 160))
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((w * 0.12, h * 0.13, w * 0.76, h * 0.87), fill=(220, 30, 30))
+    draw.rectangle((w * 0.6, h * 0.54, w, h), fill=(220, 30, 30))
+    return img
+
+
+def _predict(images):
+    """A per-pixel model, so a tile's mask is exactly the matching crop of the full mask."""
+    masks = []
+    for img in images:
+        red = np.asarray(img.convert("RGB"))[..., 0]
+        masks.append(PILImage.fromarray(np.where(red > 128, 255, 0).astype(np.uint8)))
+    return masks
+
+
+def test_tiled_mask_matches_untiled():
+    img = _subject()
+    untiled = np.asarray(_predict([img])[0])
+    coarse = _predict([img.resize((250, 175), PILImage.BILINEAR)])[0]
+
+    tiles = []
+
+    def predict(crops):
+        tiles.extend(crop.size for crop in crops)
+        return _predict(crops)
+
+    tiled = np.asarray(refine_tiles(img, coarse, predict, tile=TILE, overlap=OVERLAP, batch_size=3))
+
+    assert tiled.shape == untiled.shape
+    # Tiles on the subject's edge were refined, including the short edge tiles.
+    assert tiles and all(w <= TILE and h <= TILE for w, h in tiles)
+
+    diff = np.abs(tiled.astype(int) - untiled.astype(int))
+    xs, ys = tile_starts(img.width, TILE, OVERLAP), tile_starts(img.height, TILE, OVERLAP)
+    seam_cols = [x for start in xs[1:] for x in range(start, start + OVERLAP)]
+    seam_rows = [y for start in ys[1:] for y in range(start, start + OVERLAP)]
+    assert diff[:, seam_cols].max() <= 1
+    assert diff[seam_rows, :].max() <= 1
+    assert diff[:, -TILE:].max() <= 1
+    assert diff[-TILE:, :].max() <= 1
+    assert diff.max() <= 1
+
+
+def test_image_smaller_than_a_tile():
+    img = _subject((200, 150))
+    coarse = _predict([img])[0]
+    tiled = refine_tiles(img, coarse, _predict, tile=TILE, overlap=OVERLAP)
+    assert np.array_equal(np.asarray(tiled), np.asarray(coarse))
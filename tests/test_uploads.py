@@ -0,0 +1,70 @@
+import io
+import json
+import os
+
+import numpy as np
+from PIL import Image as PILImage
+
+from app import storage
+from app.models import Job
+
+JSON = {"Accept": "application/json"}
+
+
+def _noise_png(size) -> bytes:
+    pixels = np.random.default_rng(0).integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    buf = io.BytesIO()
+    PILImage.fromarray(pixels).save(buf, "PNG")
+    return buf.getvalue()
+
+
+def _upload(client, data: bytes):
+    return client.post(
+        "/", data={"subject": (io.BytesIO(data), "subject.png")}, content_type="multipart/form-data", headers=JSON,
+    )
+
+
+def _stored_files(app) -> list:
+    folders = (app.config["ORIGINAL_FOLDER"], app.config["UPLOAD_TMP_FOLDER"])
+    return [name for folder in folders for name in os.listdir(folder)]
+
+
+def test_oversized_image_is_refused(app, client):
+    app.config.update(UPLOAD_MAX_PIXELS=10_000, UPLOAD_OVERSIZE="reject")
+
+    resp = _upload(client, _noise_png((600, 400)))
+
+    assert resp.status_code == 400
+    assert "600x400" in resp.get_json()["error"]
+    assert _stored_files(app) == []
+
+
+def test_file_over_byte_limit_is_refused(app, client):
+    app.config["UPLOAD_MAX_BYTES"] = 64 * 1024
+
+    resp = _upload(client, _noise_png((600, 400)))
+
+    assert resp.status_code == 400
+    assert "larger than" in resp.get_json()["error"]
+    assert _stored_files(app) == []
+
+
+def test_request_over_content_length_is_refused(app, client):
+    app.config["MAX_CONTENT_LENGTH"] = 64 * 1024
+
+    resp = _upload(client, _noise_png((600, 400)))
+
+    assert resp.status_code == 413
+    assert _stored_files(app) == []
+
+
+def test_oversized_image_is_downscaled(app, client):
+    app.config.update(UPLOAD_MAX_PIXELS=10_000, UPLOAD_OVERSIZE="downscale")
+
+    resp = _upload(client, _noise_png((600, 400)))
+
+    assert resp.status_code == 202
+    payload = json.loads(Job.query.one().payload)
+    with storage.open(payload["original_path"]) as f, PILImage.open(f) as img:
+        assert img.width * img.height <= 10_000
+        assert img.width > img.height